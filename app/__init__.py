@@ -5,6 +5,8 @@ from flask_cors import CORS
 from app.config import Config
 from app.extensions import mongo, api
 from app.main.routes import register_namespaces
+from app.main.indexes import bootstrap_indexes
+from app.main.usage import usage_aggregator
 
 def create_app() -> Flask:
     """Create the Flask application and initialize the configuration."""
@@ -24,6 +26,13 @@ def create_app() -> Flask:
         print("❌ Error connecting to MongoDB:", e)
         raise  # Stop the application if MongoDB is not reachable
 
+    # Create and verify the indexes of every collection
+    with app.app_context():
+        bootstrap_indexes()
+
+    # Write the usage of requests behind, in batches
+    usage_aggregator.start(app)
+
     # Create the Blueprint for the main API
     main_bp = Blueprint("api", __name__)
     
@@ -6,4 +6,5 @@ load_dotenv()
 
 class Config:
     DEBUG = True
-    MONGO_URI = os.getenv("MONGO_URI")  # Load from .env
\ No newline at end of file
+    MONGO_URI = os.getenv("MONGO_URI")  # Load from .env
+    ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # required by the admin endpoints, e.g. /drain; loopback only if not set
\ No newline at end of file
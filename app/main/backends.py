@@ -0,0 +1,342 @@
+import os
+import json
+import requests
+from typing import Callable, Iterator
+
+from .constants import (
+    LOCAL_HOST_URL,
+    JUDGE_BACKEND,
+    OPENAI_COMPATIBLE_URL,
+)
+
+class JudgeBackend:
+    """
+    Base class of the chat backends used by the judge.
+
+    Every backend returns responses in the same shape:
+        {"content": "answer", "thinking": "", "prompt_tokens": 120, "completion_tokens": 40}
+
+    Capabilities tell the engine which path is the fastest for a backend:
+        supports_json_schema: Output can be constrained to a JSON schema.
+        supports_logprobs: Token log probabilities can be returned.
+        supports_streaming: Responses can be streamed chunk by chunk.
+
+    Backends are sent to the scoring processes, so they must be picklable, except
+    `in_process` ones, e.g. fakes recording their calls, which are scored in threads.
+    """
+    name = "base"
+    supports_json_schema = False
+    supports_logprobs = False
+    supports_streaming = False
+    in_process = False
+
+    def get_capabilities(self) -> dict:
+        """Get the capabilities of the backend."""
+        return {
+            "json_schema": self.supports_json_schema,
+            "logprobs": self.supports_logprobs,
+            "streaming": self.supports_streaming,
+        }
+
+    def chat(self, model: str, messages: list[dict], response_format=None, options: dict = None, **kwargs) -> dict:
+        """
+        Send a chat request and return the complete response.
+
+        Args:
+            model (str): Name of the model.
+            messages (list[dict]): The chat messages.
+            response_format (str | dict, optional): "json" for any JSON object, or a JSON schema.
+            options (dict, optional): Decoding options, e.g. {"temperature": 0}.
+
+        Returns:
+            dict: The normalized response.
+        """
+        raise NotImplementedError
+
+    def stream_chat(self, model: str, messages: list[dict], response_format=None, options: dict = None, **kwargs) -> Iterator[dict]:
+        """
+        Send a chat request and yield the response chunk by chunk.
+
+        Closing the generator aborts the request.
+
+        Yields:
+            dict: The normalized chunk, with an additional "done" flag.
+        """
+        raise NotImplementedError
+
+class OllamaBackend(JudgeBackend):
+    """Backend for Ollama's /api/chat endpoint."""
+    name = "ollama"
+    supports_json_schema = True
+    supports_logprobs = False
+    supports_streaming = True
+
+    def __init__(self, url: str = LOCAL_HOST_URL):
+        self.url = url
+
+    def build_payload(self, model: str, messages: list[dict], response_format=None, options: dict = None, stream: bool = False, keep_alive: str = None, think: bool = None) -> dict:
+        """Build the Ollama request payload."""
+        data = {
+            "model": model,
+            "messages": messages,
+            "stream": stream,
+        }
+        if response_format:
+            data["format"] = response_format
+        if options:
+            data["options"] = options
+        if keep_alive:
+            data["keep_alive"] = keep_alive
+        if think is not None:
+            data["think"] = think
+        return data
+
+    def chat(self, model: str, messages: list[dict], response_format=None, options: dict = None, **kwargs) -> dict:
+        data = self.build_payload(model, messages, response_format, options, stream=False, **kwargs)
+
+        print(f"\nSending request to {self.url} with data: {data.keys()} and model: {model}")
+
+        try:
+            response = requests.post(self.url, json=data, headers={'Content-Type': 'application/json'})
+            response.raise_for_status()  # Raises HTTPError for bad responses (4xx or 5xx)
+            response_data = response.json()
+        except requests.exceptions.RequestException as e:
+            raise RuntimeError(f"Request failed: {e}") from e
+        except ValueError as e:
+            raise RuntimeError(f"Invalid JSON in response: {e}") from e
+
+        message = response_data.get("message", {})
+        return {
+            "content": message.get("content", ""),
+            "thinking": message.get("thinking", ""),
+            "prompt_tokens": response_data.get("prompt_eval_count", 0),
+            "completion_tokens": response_data.get("eval_count", 0),
+        }
+
+    def stream_chat(self, model: str, messages: list[dict], response_format=None, options: dict = None, **kwargs) -> Iterator[dict]:
+        data = self.build_payload(model, messages, response_format, options, stream=True, **kwargs)
+
+        print(f"\nStreaming request to {self.url} with data: {data.keys()} and model: {model}")
+
+        try:
+            with requests.post(self.url, json=data, headers={'Content-Type': 'application/json'}, stream=True) as response:
+                response.raise_for_status()
+
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+
+                    chunk = json.loads(line)
+                    message = chunk.get("message", {})
+                    yield {
+                        "content": message.get("content", ""),
+                        "thinking": message.get("thinking", ""),
+                        "prompt_tokens": chunk.get("prompt_eval_count", 0),
+                        "completion_tokens": chunk.get("eval_count", 0),
+                        "done": chunk.get("done", False),
+                    }
+        except requests.exceptions.RequestException as e:
+            raise RuntimeError(f"Request failed: {e}") from e
+        except ValueError as e:
+            raise RuntimeError(f"Invalid JSON in response: {e}") from e
+
+class OpenAICompatibleBackend(JudgeBackend):
+    """Backend for OpenAI-compatible /v1/chat/completions servers, e.g. vLLM or llama.cpp."""
+    name = "openai"
+    supports_json_schema = True
+    supports_logprobs = True
+    supports_streaming = True
+
+    def __init__(self, url: str = OPENAI_COMPATIBLE_URL, api_key: str = None):
+        self.url = url
+        self.api_key = api_key
+
+    def get_headers(self) -> dict:
+        headers = {'Content-Type': 'application/json'}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def build_payload(self, model: str, messages: list[dict], response_format=None, options: dict = None, stream: bool = False, think: bool = None, **kwargs) -> dict:
+        """
+        Build the chat completions request payload, other Ollama-only arguments are ignored.
+
+        `think` is sent as the `enable_thinking` argument of the chat template, supported by
+        vLLM and llama.cpp for models like Qwen3. Servers or models without it keep thinking.
+        """
+        data = {
+            "model": model,
+            "messages": messages,
+            "stream": stream,
+        }
+        if response_format == "json":
+            data["response_format"] = {"type": "json_object"}
+        elif response_format:
+            data["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "judge_response", "schema": response_format},
+            }
+        if options:
+            data.update(options)
+        if stream:
+            data["stream_options"] = {"include_usage": True}
+        if think is not None:
+            data["chat_template_kwargs"] = {"enable_thinking": think}
+        return data
+
+    def chat(self, model: str, messages: list[dict], response_format=None, options: dict = None, **kwargs) -> dict:
+        data = self.build_payload(model, messages, response_format, options, stream=False, think=kwargs.get("think"))
+
+        print(f"\nSending request to {self.url} with data: {data.keys()} and model: {model}")
+
+        try:
+            response = requests.post(self.url, json=data, headers=self.get_headers())
+            response.raise_for_status()
+            response_data = response.json()
+        except requests.exceptions.RequestException as e:
+            raise RuntimeError(f"Request failed: {e}") from e
+        except ValueError as e:
+            raise RuntimeError(f"Invalid JSON in response: {e}") from e
+
+        choices = response_data.get("choices") or [{}]
+        message = choices[0].get("message", {})
+        usage = response_data.get("usage") or {}
+        return {
+            "content": message.get("content") or "",
+            "thinking": message.get("reasoning_content") or "",
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+        }
+
+    def stream_chat(self, model: str, messages: list[dict], response_format=None, options: dict = None, **kwargs) -> Iterator[dict]:
+        data = self.build_payload(model, messages, response_format, options, stream=True, think=kwargs.get("think"))
+
+        print(f"\nStreaming request to {self.url} with data: {data.keys()} and model: {model}")
+
+        try:
+            with requests.post(self.url, json=data, headers=self.get_headers(), stream=True) as response:
+                response.raise_for_status()
+
+                for line in response.iter_lines():
+                    # Server-sent events, e.g. b'data: {...}'
+                    if not line or not line.startswith(b"data:"):
+                        continue
+
+                    line = line[len(b"data:"):].strip()
+                    if line == b"[DONE]":
+                        break
+
+                    chunk = json.loads(line)
+                    choices = chunk.get("choices") or [{}]
+                    delta = choices[0].get("delta", {})
+                    usage = chunk.get("usage") or {}
+                    yield {
+                        "content": delta.get("content") or "",
+                        "thinking": delta.get("reasoning_content") or "",
+                        "prompt_tokens": usage.get("prompt_tokens", 0),
+                        "completion_tokens": usage.get("completion_tokens", 0),
+                        "done": choices[0].get("finish_reason") is not None,
+                    }
+        except requests.exceptions.RequestException as e:
+            raise RuntimeError(f"Request failed: {e}") from e
+        except ValueError as e:
+            raise RuntimeError(f"Invalid JSON in response: {e}") from e
+
+class FakeBackend(JudgeBackend):
+    """
+    In-process backend for tests, no model server required.
+
+    Responses come from a callable receiving the messages, every request is recorded in `calls`.
+    While it is set, items are scored in threads of the process that set it.
+    """
+    name = "fake"
+    in_process = True
+
+    def __init__(self, respond: Callable[[list[dict]], str] = None, supports_json_schema: bool = False, supports_streaming: bool = False):
+        self.respond = respond or (lambda messages: '{"Total rating": 5, "Reason": "Fake response"}')
+        self.supports_json_schema = supports_json_schema
+        self.supports_streaming = supports_streaming
+        self.calls = []
+
+    def chat(self, model: str, messages: list[dict], response_format=None, options: dict = None, **kwargs) -> dict:
+        self.calls.append({"model": model, "messages": messages, "response_format": response_format, **kwargs})
+        content = self.respond(messages)
+        return {
+            "content": content,
+            "thinking": "",
+            "prompt_tokens": sum(len(message["content"]) for message in messages),
+            "completion_tokens": len(content),
+        }
+
+    def stream_chat(self, model: str, messages: list[dict], response_format=None, options: dict = None, **kwargs) -> Iterator[dict]:
+        response = self.chat(model, messages, response_format, options, **kwargs)
+        for word in response["content"].split(" "):
+            yield {"content": word + " ", "thinking": "", "prompt_tokens": 0, "completion_tokens": 0, "done": False}
+        yield {
+            "content": "",
+            "thinking": "",
+            "prompt_tokens": response["prompt_tokens"],
+            "completion_tokens": response["completion_tokens"],
+            "done": True,
+        }
+
+def create_backend(backend_name: str) -> JudgeBackend:
+    """
+    Create a backend by name.
+
+    Args:
+        backend_name (str): One of "ollama", "openai" or "fake".
+
+    Returns:
+        JudgeBackend: The created backend.
+
+    Raises:
+        ValueError: If the backend name is unknown.
+    """
+    if backend_name == "ollama":
+        return OllamaBackend()
+    elif backend_name == "openai":
+        return OpenAICompatibleBackend(api_key=os.getenv("OPENAI_COMPATIBLE_API_KEY"))
+    elif backend_name == "fake":
+        return FakeBackend()
+
+    raise ValueError(f"Unknown judge backend: {backend_name}")
+
+_backends = {}
+
+def get_backend(backend_name: str = None) -> JudgeBackend:
+    """
+    Get a backend by name, created on first use.
+
+    Args:
+        backend_name (str, optional): Name of the backend, defaults to JUDGE_BACKEND.
+
+    Returns:
+        JudgeBackend: The backend.
+    """
+    backend_name = backend_name or JUDGE_BACKEND
+    if backend_name not in _backends:
+        _backends[backend_name] = create_backend(backend_name)
+    return _backends[backend_name]
+
+def set_backend(backend: JudgeBackend, backend_name: str = None) -> None:
+    """
+    Replace a backend, e.g. with a FakeBackend in tests.
+
+    Args:
+        backend (JudgeBackend): The backend to use.
+        backend_name (str, optional): Name to register the backend under, defaults to JUDGE_BACKEND.
+    """
+    _backends[backend_name or JUDGE_BACKEND] = backend
+
+def get_backends() -> dict:
+    """The backends created or set in this process, keyed by name."""
+    return dict(_backends)
+
+def set_backends(backends: dict) -> None:
+    """Use the backends of another process, e.g. in the initializer of the scoring processes."""
+    _backends.update(backends)
+
+def has_in_process_backend() -> bool:
+    """Whether a backend that can only be used in this process is set, e.g. a FakeBackend."""
+    return any(backend.in_process for backend in _backends.values())
@@ -0,0 +1,245 @@
+import threading
+import time
+from collections import OrderedDict
+
+import bson
+
+from app import mongo
+from .constants import (
+    CREDITS_CACHE_TTL_SECONDS,
+    CREDITS_NEGATIVE_CACHE_TTL_SECONDS,
+    CREDITS_CACHE_MAX_ENTRIES,
+    METADATA_CACHE_TTL_SECONDS,
+    METADATA_CACHE_MAX_ENTRIES,
+    METADATA_CACHE_MAX_BYTES,
+    METADATA_CACHE_SYNC_WITH_MONGO,
+)
+
+_MISSING = object()
+
+class TTLCache:
+    """
+    In-process cache whose entries expire after a TTL, evicting the least recently used
+    entries once `max_entries` or `max_bytes` is reached.
+
+    A key can also be cached as not found, with its own shorter or longer TTL, so lookups
+    of unknown keys do not reach Mongo every time. Entries can be tagged, to invalidate
+    every entry of a tag at once.
+
+    Args:
+        name (str): Name of the cache in the stats.
+        ttl_seconds (float): Seconds an entry is served.
+        negative_ttl_seconds (float): Seconds a key is known not to exist.
+        max_entries (int): Max number of cached keys.
+        max_bytes (int, optional): Max BSON size of the cached values, None for no limit.
+    """
+    def __init__(self, name: str, ttl_seconds: float, negative_ttl_seconds: float, max_entries: int, max_bytes: int = None):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key: (value, expires_at, size, tags), value None for a key not found
+        self.keys_by_tag = {}
+        self.bytes = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=_MISSING):
+        """
+        Get a cached value.
+
+        Returns:
+            The value, None if the key is cached as not found, `default` if not cached.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            if entry[0] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, tags: tuple = ()) -> None:
+        """Cache a value, or None to cache the key as not found."""
+        size = self.get_size(value)
+        with self.lock:
+            self.store(key, value, size, tags)
+
+    def get_size(self, value) -> int:
+        return len(bson.encode({"value": value})) if self.max_bytes else 0
+
+    def store(self, key, value, size: int, tags: tuple) -> None:
+        """Cache a value of a known size, the lock must be held."""
+        if self.max_bytes and size > self.max_bytes:
+            return
+
+        ttl_seconds = self.ttl_seconds if value is not None else self.negative_ttl_seconds
+        self.remove(key)
+        self.entries[key] = (value, time.monotonic() + ttl_seconds, size, tags)
+        self.bytes += size
+        for tag in tags:
+            self.keys_by_tag.setdefault(tag, set()).add(key)
+
+        while len(self.entries) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes):
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key) -> bool:
+        """Remove an entry, the lock must be held."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+
+        self.bytes -= entry[2]
+        for tag in entry[3]:
+            keys = self.keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_tag[tag]
+        return True
+
+    def get_or_load(self, key, load):
+        """Get a cached value, or load it with `load()` and cache it."""
+        value = self.get(key)
+        if value is _MISSING:
+            value = load()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, *keys) -> None:
+        with self.lock:
+            for key in keys:
+                if self.remove(key):
+                    self.invalidations += 1
+
+    def invalidate_tags(self, *tags) -> None:
+        """Remove every entry of the tags."""
+        with self.lock:
+            for tag in tags:
+                for key in list(self.keys_by_tag.get(tag, ())):
+                    if self.remove(key):
+                        self.invalidations += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_tag.clear()
+            self.bytes = 0
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class MetadataCache(TTLCache):
+    """
+    Cache of the project and QA set reads of tenants, e.g. the ones polled by dashboards.
+
+    The writes of a project invalidate its entries and the tenant-wide ones, like the
+    list of projects. With `sync_with_mongo`, writes also increment a version of the tenant
+    in the cache_versions collection, which is part of the cache keys, so the writes of
+    other server processes invalidate the entries of the tenant too, for one small read
+    per lookup.
+
+    Args:
+        sync_with_mongo (bool): Share invalidations across server processes.
+    """
+    def __init__(self, name: str, ttl_seconds: float, max_entries: int, max_bytes: int, sync_with_mongo: bool = METADATA_CACHE_SYNC_WITH_MONGO):
+        super().__init__(name, ttl_seconds, negative_ttl_seconds=0, max_entries=max_entries, max_bytes=max_bytes)
+        self.sync_with_mongo = sync_with_mongo
+        self.generations = {}  # invalidations per tenant, a read loaded during one is not cached
+
+    def get_version(self, key_token: str) -> int:
+        if not self.sync_with_mongo:
+            return 0
+
+        versions = mongo.db.cache_versions.find_one({"key_token": key_token}, {"version": 1})
+        return versions["version"] if versions else 0
+
+    def read_through(self, key_token: str, key: tuple, load):
+        """
+        Get a cached read of a tenant, or load it.
+
+        Args:
+            key_token (str): The tenant.
+            key (tuple): The read and its arguments, e.g. ("set_ids", project_identifier).
+            load (Callable): Returns the value and the ID of the project it belongs to,
+                None for tenant-wide reads.
+
+        Returns:
+            The value.
+        """
+        # The version is read before loading, a write during the load leaves the entry stale
+        cache_key = (key_token, self.get_version(key_token), *key)
+        value = self.get(cache_key)
+        if value is not _MISSING:
+            return value
+
+        generation = self.generations.get(key_token, 0)
+        value, project_id = load()
+
+        tags = [("tenant", key_token)]
+        tags.append(("projects", key_token) if project_id is None else ("project", key_token, project_id))
+        size = self.get_size(value)
+        with self.lock:
+            # Not cached if a write invalidated the tenant while it was loaded
+            if self.generations.get(key_token, 0) == generation:
+                self.store(cache_key, value, size, tuple(tags))
+        return value
+
+    def invalidate_project(self, key_token: str, project_id: str) -> None:
+        """Invalidate the reads of a project, and the tenant-wide reads including it."""
+        self.increment_generation(key_token)
+        self.invalidate_tags(("project", key_token, project_id), ("projects", key_token))
+        self.increment_version(key_token)
+
+    def invalidate_tenant(self, key_token: str) -> None:
+        self.increment_generation(key_token)
+        self.invalidate_tags(("tenant", key_token))
+        self.increment_version(key_token)
+
+    def increment_generation(self, key_token: str) -> None:
+        with self.lock:
+            self.generations[key_token] = self.generations.get(key_token, 0) + 1
+
+    def increment_version(self, key_token: str) -> None:
+        if self.sync_with_mongo:
+            mongo.db.cache_versions.update_one({"key_token": key_token}, {"$inc": {"version": 1}}, upsert=True)
+
+
+# Credits of a user keyed by (key_token, month), read by every scoring request
+credits_cache = TTLCache(
+    "credits",
+    ttl_seconds=CREDITS_CACHE_TTL_SECONDS,
+    negative_ttl_seconds=CREDITS_NEGATIVE_CACHE_TTL_SECONDS,
+    max_entries=CREDITS_CACHE_MAX_ENTRIES,
+)
+
+# Projects and QA sets of tenants
+metadata_cache = MetadataCache(
+    "metadata",
+    ttl_seconds=METADATA_CACHE_TTL_SECONDS,
+    max_entries=METADATA_CACHE_MAX_ENTRIES,
+    max_bytes=METADATA_CACHE_MAX_BYTES,
+)
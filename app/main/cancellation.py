@@ -0,0 +1,169 @@
+import select
+import socket
+import threading
+from contextlib import contextmanager
+from typing import Callable
+
+from .constants import CLIENT_DISCONNECT_POLL_INTERVAL
+
+class Cancelled(Exception):
+    """Raised when work is cancelled, e.g. because its client disconnected."""
+    pass
+
+class CancellationToken:
+    """
+    Signals that the work of a request is no longer needed.
+
+    Callbacks added with `add_callback` are called once, with the reason, when the
+    token is cancelled, e.g. to drop the queued items of a batch.
+    """
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.reason = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def cancel(self, reason: str = "Cancelled.") -> None:
+        with self.lock:
+            if self.cancelled.is_set():
+                return
+            self.reason = reason
+            self.cancelled.set()
+            callbacks = list(self.callbacks)
+
+        print(f"Cancelling: {reason}")
+        for callback in callbacks:
+            callback(reason)
+
+    def is_cancelled(self) -> bool:
+        return self.cancelled.is_set()
+
+    def add_callback(self, callback: Callable[[str], None]) -> None:
+        with self.lock:
+            if not self.cancelled.is_set():
+                self.callbacks.append(callback)
+                return
+
+        callback(self.reason)
+
+def is_client_disconnected(environ: dict) -> bool:
+    """
+    Check, without blocking, whether the client of a request closed its connection.
+
+    Only possible on servers exposing the socket, e.g. the werkzeug server, always
+    False otherwise.
+    """
+    sock = environ.get("werkzeug.socket")
+    if sock is None:
+        return False
+
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        # Readable with no data to peek means the connection is closed
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except (OSError, ValueError):
+        return True
+
+def watch_client_disconnect(token: CancellationToken, environ: dict, interval: float = CLIENT_DISCONNECT_POLL_INTERVAL) -> threading.Event:
+    """
+    Cancel the token if the client of a request disconnects.
+
+    Args:
+        token (CancellationToken): The token of the request.
+        environ (dict): The WSGI environ of the request.
+        interval (float): Seconds between checks.
+
+    Returns:
+        threading.Event: Set it when the request is done to stop watching.
+    """
+    done = threading.Event()
+
+    def watch():
+        while not done.wait(interval):
+            if is_client_disconnected(environ):
+                token.cancel("Client disconnected.")
+                return
+
+    threading.Thread(target=watch, daemon=True).start()
+    return done
+
+class CancellationRegistry:
+    """Tokens of the running requests by key, e.g. run ID, so they can be cancelled from another request."""
+    def __init__(self):
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def register(self, key: str, token: CancellationToken) -> None:
+        with self.lock:
+            self.tokens[key] = token
+
+    def unregister(self, key: str) -> None:
+        with self.lock:
+            self.tokens.pop(key, None)
+
+    def cancel(self, key: str, reason: str = "Cancelled.") -> bool:
+        """
+        Cancel the token registered under a key.
+
+        Returns:
+            bool: Whether a token was registered under the key.
+        """
+        with self.lock:
+            token = self.tokens.get(key)
+
+        if not token:
+            return False
+
+        token.cancel(reason)
+        return True
+
+
+cancellation_registry = CancellationRegistry()
+
+@contextmanager
+def cancellable_request(environ: dict, keys: list = ()):
+    """
+    Give the work of a request a cancellation token, cancelled when the client disconnects
+    or when one of the keys is cancelled in the registry.
+
+    Args:
+        environ (dict): The WSGI environ of the request.
+        keys (list): Keys to register the token under, e.g. the run ID, None values are skipped.
+
+    Yields:
+        CancellationToken: The token of the request.
+    """
+    token = CancellationToken()
+    keys = [key for key in keys if key]
+    for key in keys:
+        cancellation_registry.register(key, token)
+    done = watch_client_disconnect(token, environ)
+
+    try:
+        yield token
+    finally:
+        done.set()
+        for key in keys:
+            cancellation_registry.unregister(key)
+
+# Scoring processes, or threads, check the flag of the item they score, set by the parent process.
+# Each scoring thread runs the initializer, so concurrent batches scored in threads keep their own flags.
+_scoring = threading.local()
+
+def init_process_cancel_flags(cancel_flags) -> None:
+    """Initializer of the scoring processes or threads, `cancel_flags` has one flag per item of the batch."""
+    _scoring.cancel_flags = cancel_flags
+
+def set_current_item(index: int) -> None:
+    """Set the index of the item this process or thread is scoring."""
+    _scoring.index = index
+
+def is_current_item_cancelled() -> bool:
+    """Whether the item this process or thread is scoring was cancelled, always False outside scoring."""
+    cancel_flags = getattr(_scoring, "cancel_flags", None)
+    index = getattr(_scoring, "index", None)
+    if cancel_flags is None or index is None:
+        return False
+    return bool(cancel_flags[index])
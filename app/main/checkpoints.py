@@ -0,0 +1,163 @@
+import datetime
+import threading
+import time
+import uuid
+
+from app import mongo
+from .constants import RUN_LEASE_SECONDS, RUN_LEASE_REFRESH_SECONDS, RUN_TTL_SECONDS
+from .utils import get_current_datetime
+
+# Last time this process extended the lease of each of its running runs
+_lease_refreshed_at = {}
+_lease_lock = threading.Lock()
+
+def get_active_until() -> datetime.datetime:
+    """Time until which a run is considered in progress without saving a new result."""
+    return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=RUN_LEASE_SECONDS)
+
+def get_expires_at() -> datetime.datetime:
+    """Time at which Mongo removes a finished run and its items."""
+    return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=RUN_TTL_SECONDS)
+
+def create_run(key_token: str, queries_data: dict, summary_accepted: bool = True, judge_profile: str = None, priority: str = "bulk") -> str:
+    """
+    Store a scoring run. The result of every item is saved as soon as it is scored, so
+    the run can be resumed without scoring it again. Finished runs expire after RUN_TTL_SECONDS.
+
+    Args:
+        key_token (str): The tenant submitting the queries.
+        queries_data (dict): The queries keyed by query ID.
+        summary_accepted (bool): Whether summaries are accepted.
+        judge_profile (str, optional): Name of the judge profile to score with.
+        priority (str): Priority class of the queries.
+
+    Returns:
+        str: The run ID.
+    """
+    run_id = str(uuid.uuid4())
+    with _lease_lock:
+        _lease_refreshed_at[run_id] = time.time()
+
+    mongo.db.runs.insert_one({
+        "run_id": run_id,
+        "key_token": key_token,
+        "status": "running",
+        "total": len(queries_data),
+        "summary_accepted": summary_accepted,
+        "judge_profile": judge_profile,
+        "priority": priority,
+        "error": None,
+        "active_until": get_active_until(),
+        "created_at": get_current_datetime(),
+        "updated_at": get_current_datetime(),
+    })
+
+    if queries_data:
+        mongo.db.run_items.insert_many([
+            {"run_id": run_id, "query_id": query_id, "query_data": query, "status": "pending", "result": None}
+            for query_id, query in queries_data.items()
+        ])
+
+    return run_id
+
+def save_item_result(run_id: str, query_id: str, score_data: dict) -> None:
+    """
+    Save the result of a scored item of a run. The lease of the run is extended at most
+    every RUN_LEASE_REFRESH_SECONDS, so most results are saved in one round trip.
+    """
+    mongo.db.run_items.update_one(
+        {"run_id": run_id, "query_id": query_id},
+        {"$set": {"status": "done", "result": score_data}}
+    )
+
+    now = time.time()
+    with _lease_lock:
+        refresh = now - _lease_refreshed_at.get(run_id, 0) >= RUN_LEASE_REFRESH_SECONDS
+        if refresh:
+            _lease_refreshed_at[run_id] = now
+    if refresh:
+        mongo.db.runs.update_one({"run_id": run_id}, {"$set": {"active_until": get_active_until()}})
+
+def finish_run(run_id: str, error: str = None) -> None:
+    """
+    Mark a run done, or failed with the error. Items not scored yet are kept for resuming,
+    the run and its items expire after RUN_TTL_SECONDS unless it is resumed.
+    """
+    with _lease_lock:
+        _lease_refreshed_at.pop(run_id, None)
+
+    expires_at = get_expires_at()
+    mongo.db.runs.update_one(
+        {"run_id": run_id},
+        {"$set": {
+            "status": "failed" if error else "done",
+            "error": error,
+            "expires_at": expires_at,
+            "updated_at": get_current_datetime(),
+        }}
+    )
+    mongo.db.run_items.update_many({"run_id": run_id}, {"$set": {"expires_at": expires_at}})
+
+def get_run(key_token: str, run_id: str) -> dict:
+    """
+    Get a run of a tenant.
+
+    Raises:
+        ValueError: If the run does not exist.
+    """
+    run = mongo.db.runs.find_one({"run_id": run_id, "key_token": key_token}, {"_id": 0})
+    if not run:
+        raise ValueError(f"Run '{run_id}' not found.")
+    return run
+
+def get_pending_queries(run_id: str) -> dict:
+    """Get the queries of a run that were not scored, keyed by query ID."""
+    return {
+        item["query_id"]: item["query_data"]
+        for item in mongo.db.run_items.find(
+            {"run_id": run_id, "status": {"$ne": "done"}}, {"query_id": 1, "query_data": 1}
+        )
+    }
+
+def get_run_scores(run_id: str) -> dict:
+    """Get the saved scores of a run, keyed by query ID."""
+    return {
+        item["query_id"]: item["result"]
+        for item in mongo.db.run_items.find(
+            {"run_id": run_id, "status": "done"}, {"query_id": 1, "result": 1}
+        )
+    }
+
+def mark_run_resumed(run_id: str) -> bool:
+    """
+    Mark a failed run, or a run abandoned by a crashed server, as running again, so only
+    one request resumes it. The run and its items no longer expire.
+
+    Returns:
+        bool: Whether the run is now resumed by the caller.
+    """
+    result = mongo.db.runs.update_one(
+        {
+            "run_id": run_id,
+            "$or": [
+                {"status": "failed"},
+                {"status": "running", "active_until": {"$lt": datetime.datetime.now(datetime.timezone.utc)}},
+            ],
+        },
+        {
+            "$set": {
+                "status": "running",
+                "error": None,
+                "active_until": get_active_until(),
+                "updated_at": get_current_datetime(),
+            },
+            "$unset": {"expires_at": ""},
+        }
+    )
+    if result.modified_count != 1:
+        return False
+
+    with _lease_lock:
+        _lease_refreshed_at[run_id] = time.time()
+    mongo.db.run_items.update_many({"run_id": run_id}, {"$unset": {"expires_at": ""}})
+    return True
@@ -1,6 +1,89 @@
 LOCAL_HOST_URL = "http://localhost:11434/api/chat"
+# Judge backend: "ollama", "openai" (OpenAI-compatible server, e.g. vLLM or llama.cpp) or "fake"
+JUDGE_BACKEND = "ollama"
+OPENAI_COMPATIBLE_URL = "http://localhost:8000/v1/chat/completions"
 # MODEL_NAME = "llama3"
 MODEL_NAME = "qwen2.5:14b"
 # MODEL_NAME = "deepseek-r1:14b"
 DEFAULT_MAX_TOKEN_LIMIT = 500000
-MAX_PROJECTS_ALLOWED = 10
\ No newline at end of file
+# Characters per token of the local estimate checked before scoring, the backend's counts are charged
+ESTIMATED_CHARS_PER_TOKEN = 4
+MAX_PROJECTS_ALLOWED = 10
+
+# Reasoning models think before answering, keyed by model name prefix.
+# thinking_token_budget: max streamed thinking tokens before the thinking is cut off.
+# max_answer_tokens: max streamed answer tokens after the thinking.
+REASONING_MODEL_PROFILES = {
+    "deepseek-r1": {
+        "thinking_token_budget": 1024,
+        "max_answer_tokens": 512,
+    },
+}
+
+DEFAULT_JUDGE_PROFILE = "default"
+
+# Scheduler
+DEFAULT_TENANT_WEIGHT = 1
+SCHEDULER_QUANTUM = 1
+MAX_IN_FLIGHT_PER_TENANT = 2
+MAX_QUEUED_ITEMS = 1000
+MAX_QUEUED_BYTES = 20 * 1024 * 1024
+JUDGE_CONCURRENCY = 2  # items scored at once by a worker pool
+ADMISSION_SLA_SECONDS = {"interactive": 60, "bulk": 1800, "background": None}  # max queue + scoring time, None for no limit
+PRIORITY_CLASSES = ["interactive", "bulk", "background"]  # served in this order
+RETRY_LANE = "retry"  # failed items wait here, after fresh bulk work
+SCHEDULER_LANES = ["interactive", "bulk", RETRY_LANE, "background"]
+MAX_ITEM_RETRIES = 1
+DEFAULT_ITEM_LATENCY = 5  # seconds, until the latency of scored items is measured
+
+# Rate limits, per key token
+DEFAULT_REQUESTS_PER_MINUTE = 60
+DEFAULT_TOKENS_PER_MINUTE = 200000
+RATE_LIMIT_SYNC_WITH_MONGO = False  # share the limits across server processes
+
+# Usage
+USAGE_FLUSH_INTERVAL_SECONDS = 2  # usage of requests is buffered and written at this interval
+LATENCY_HISTOGRAM_BOUNDS = [0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300]  # upper bounds of the processing time buckets, seconds
+DEFAULT_USAGE_PERCENTILES = [50, 90, 99]
+
+# Durable queue
+DURABLE_QUEUE_LEASE_SECONDS = 60  # an item leased by a worker that stops heartbeating is claimable again after this
+DURABLE_QUEUE_MAX_ATTEMPTS = 3
+DURABLE_QUEUE_RETRY_BACKOFF_SECONDS = 5  # doubled on every attempt
+WORKER_POLL_INTERVAL = 1
+
+# Checkpoints
+RUN_LEASE_SECONDS = 600  # a running run that saved no result for this long can be resumed
+RUN_LEASE_REFRESH_SECONDS = 60  # saved results extend the lease of their run at most this often
+RUN_TTL_SECONDS = 24 * 60 * 60  # finished runs and their items are removed after this, at least the idempotency key retention
+
+# Cancellation
+CLIENT_DISCONNECT_POLL_INTERVAL = 1  # seconds
+
+# Idempotency keys
+IDEMPOTENCY_KEY_TTL_SECONDS = 24 * 60 * 60  # retention window of the keys and their responses
+IDEMPOTENCY_MAX_WAIT_SECONDS = 600  # max wait of a repeat submission on its original request
+# Query fields derived by the server, e.g. the key facts /compare-qna-sets adds once they are extracted,
+# left out of the request hash so a repeat is not rejected when they change
+IDEMPOTENCY_UNHASHED_QUERY_FIELDS = ("baseline_facts", "estimated_tokens")
+
+# Drain
+DRAIN_TIMEOUT_SECONDS = 120  # max wait for in-flight items before they are aborted
+DRAIN_RETRY_AFTER_SECONDS = 10  # Retry-After of requests rejected while draining
+
+# Storage
+STORAGE_SCHEMA_VERSION = 2  # 1: everything of a user in one qa_data document, 2: projects, qa_sets, qa_items and scores collections
+MIGRATION_LEASE_SECONDS = 60  # a tenant whose migration started this long ago can be migrated again
+MIGRATION_WAIT_SECONDS = 30  # max wait of a request on the migration of its tenant by another request
+
+# Key facts
+KEY_FACTS_RETRY_SECONDS = 300  # a failed extraction is retried by the next comparison after this
+
+# Caches
+CREDITS_CACHE_TTL_SECONDS = 5  # max staleness of the usage and limits of a user read by another process
+CREDITS_NEGATIVE_CACHE_TTL_SECONDS = 30  # unknown key tokens are rejected without reading Mongo for this long
+CREDITS_CACHE_MAX_ENTRIES = 10000
+METADATA_CACHE_TTL_SECONDS = 300  # writes invalidate the entries, the TTL bounds the staleness of writes by other processes
+METADATA_CACHE_MAX_ENTRIES = 10000
+METADATA_CACHE_MAX_BYTES = 64 * 1024 * 1024
+METADATA_CACHE_SYNC_WITH_MONGO = False  # share invalidations across server processes
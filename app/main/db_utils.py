@@ -1,12 +1,32 @@
 
 from pprint import pprint
+import datetime
+import math
+import threading
 import uuid
 
+from flask import current_app
+from pymongo import ReplaceOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
 from app import mongo
-from .constants import DEFAULT_MAX_TOKEN_LIMIT, MAX_PROJECTS_ALLOWED
+from .constants import LATENCY_HISTOGRAM_BOUNDS, DEFAULT_USAGE_PERCENTILES, DEFAULT_MAX_TOKEN_LIMIT, MAX_PROJECTS_ALLOWED, DEFAULT_TENANT_WEIGHT, STORAGE_SCHEMA_VERSION, KEY_FACTS_RETRY_SECONDS
+from .judge_utilities import get_key_facts_for_set
+from .queues import queue_manager
+from .cache import credits_cache, metadata_cache
+from .usage import (
+    USAGE_COUNTERS,
+    usage_aggregator,
+    get_utc_now,
+    get_month_start,
+    get_bucket_filter,
+)
+from .migrations import ensure_migrated, migrate_usage
+from .profiles import get_profile
+from .prompts import KEY_FACTS_PROMPT_VERSION
 from .utils import (
-    get_number_of_tokens,
     post_score_for_queries,
+    ScoringRequestFailed,
     get_current_datetime,
     get_current_month_year,
     generate_unique_project_id
@@ -23,12 +43,15 @@ def update_key_token(email: str) -> tuple:
     Returns:
         tuple: The result of the update operation and the generated key_token.
     """
+    previous_user = mongo.db.credits.find_one({"email": email}, {"key_token": 1})
+    previous_key_token = previous_user.get("key_token") if previous_user else None
+
     while True:
         # Generate a new unique key_token
         key_token = str(uuid.uuid4())
 
         # Check if the key_token already exists in the collection
-        existing_token = mongo.db.credits.find_one({"key_token": key_token})
+        existing_token = mongo.db.credits.find_one({"key_token": key_token}, {"_id": 1})
         if existing_token:
             # If the key_token already exists, retry with a new token
             continue
@@ -42,131 +65,387 @@ def update_key_token(email: str) -> tuple:
             upsert=True,  # Insert if the document does not exist
         )
 
-        qa_data_exist = mongo.db.credits.find_one({"key_token": key_token})
+        # The previous key token is no longer valid, the new one may have been cached as unknown
+        current_month_year = get_current_month_year()
+        credits_cache.invalidate((previous_key_token, current_month_year), (key_token, current_month_year))
+
+        qa_data_exist = mongo.db.credits.find_one({"key_token": key_token}, {"_id": 1})
 
         if qa_data_exist:
             #     If the key_token is unique, update the document or create a new one
             result = mongo.db.qa_data.update_one(
                 {"email": email},  # Query to find the document
                 {
-                    "$set": {"key_token": key_token, "email": email}
+                    "$set": {"key_token": key_token, "email": email},
+                    # New users start with the normalized collections, nothing to migrate
+                    "$setOnInsert": {"schema_version": STORAGE_SCHEMA_VERSION},
                 },  # Update the key_token field
                 upsert=True,  # Insert if the document does not exist
             )
 
+            # Projects, QA sets and scores of the user are keyed by its key_token
+            if previous_key_token and previous_key_token != key_token:
+                for collection in (mongo.db.projects, mongo.db.qa_sets, mongo.db.qa_items, mongo.db.scores, mongo.db.usage):
+                    collection.update_many({"key_token": previous_key_token}, {"$set": {"key_token": key_token}})
+                metadata_cache.invalidate_tenant(previous_key_token)
+
         return result, key_token
     
-def check_token_limit(input_usage_str: str, key_token: str) -> bool:
+def get_credits_projection(current_month_year: str) -> dict:
+    """Fields of the credits of a user read by requests, with the usage of the current month if not migrated yet."""
+    return {"_id": 0, "queue_weight": 1, "rate_limits": 1, "usage_migrated": 1, current_month_year: 1}
+
+def get_credits(key_token: str) -> dict:
     """
-    Checks if the number of tokens in input_usage_str exceeds the token usage for the current month.
-    Creates or updates the document if email or current month's token limit is missing.
+    Get the credits of a user, with the usage of the current month if not migrated yet.
 
-    Args:
-        input_usage_str (str): The input string for which tokens are calculated.
-        email (str): The email used to retrieve or initialize the token limit.
+    Credits are cached for CREDITS_CACHE_TTL_SECONDS, and unknown key tokens for
+    CREDITS_NEGATIVE_CACHE_TTL_SECONDS.
 
     Returns:
-        bool: True if the token usage is within the limit, False otherwise.
+        dict: The credits, None if the key token does not exist.
     """
-    # Calculate tokens from the input string
-    number_of_tokens = get_number_of_tokens(input_usage_str)
-
-    # Get the field name for the current month and year
     current_month_year = get_current_month_year()
+    return credits_cache.get_or_load(
+        (key_token, current_month_year),
+        lambda: mongo.db.credits.find_one({"key_token": key_token}, get_credits_projection(current_month_year))
+    )
+
+class TokenReservation:
+    """
+    Tokens of a request counted against the monthly limit of a user before it is scored.
+
+    `commit` records the actual usage of the request, adjusting the reserved tokens,
+    `release` gives them back if the request failed. Both are written behind.
+
+    Args:
+        key_token (str): User identifier.
+        tokens (int): The reserved tokens.
+    """
+    def __init__(self, key_token: str, tokens: int):
+        self.key_token = key_token
+        self.tokens = tokens
+        self.settled = False
+
+    def commit(self, input_tokens: int, output_tokens: int, processing_time: float, avg_queue_time: float = 0.0) -> None:
+        update_usage(
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            processing_time=processing_time,
+            key_token=self.key_token,
+            avg_queue_time=avg_queue_time,
+            reserved_tokens=self.tokens,
+        )
+        self.settled = True
+
+    def release(self) -> None:
+        """Give the reserved tokens back, unless the usage was committed."""
+        if self.settled:
+            return
+
+        self.settled = True
+        if self.tokens:
+            usage_aggregator.add(self.key_token, tokens=-self.tokens)
+
+def reserve_tokens(estimated_tokens: int, key_token: str) -> TokenReservation:
+    """
+    Reserve the input tokens of a request if the usage of the current month stays within
+    the limit. The check and the reservation are one conditional update, so concurrent
+    requests cannot both pass the check.
 
-    # Ensure the email document exists and has the current month's token limit
-    user_data = mongo.db.credits.find_one({"key_token": key_token})
+    Args:
+        estimated_tokens (int): The estimated input tokens of the request, see `get_estimated_tokens`.
+        key_token (str): User identifier.
+
+    Returns:
+        TokenReservation: The reservation, None if the tokens would exceed the limit.
 
+    Raises:
+        ValueError: If the user is not found.
+    """
+    user_data = get_credits(key_token)
     if not user_data:
-        # If the document doesn't exist, create it
         raise ValueError(f"Document not found for token: {key_token}")
-    elif current_month_year not in user_data:
-        # If the document exists but the current month's token usage is missing, update it
-        mongo.db.credits.update_one({"key_token": key_token},
-                                    {"$set": {current_month_year: {"token_used" : 0}}})
-        tokens_used = 0
-    else:
-        # Retrieve the existing token limit for the current month
-        tokens_used = user_data[current_month_year]["token_used"]
 
-    print(f"\nTokens Used till now(including this request): {tokens_used + number_of_tokens}")
-    # Compare input tokens with the stored limit
-    return number_of_tokens + tokens_used <= DEFAULT_MAX_TOKEN_LIMIT
+    # The usage of the month is counted in its bucket once moved out of the credits
+    if get_current_month_year() in user_data:
+        migrate_usage(key_token)
+
+    max_tokens_used = DEFAULT_MAX_TOKEN_LIMIT - estimated_tokens
+    if max_tokens_used < 0:
+        return None
+
+    # The first request of the month inserts its bucket, a bucket over the limit does
+    # not match and its insert fails on the unique index
+    try:
+        mongo.db.usage.update_one(
+            {**get_bucket_filter(key_token, "month", get_month_start(get_utc_now())), "token_used": {"$lte": max_tokens_used}},
+            {"$inc": {"token_used": estimated_tokens}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return None
+
+    print(f"\nReserved {estimated_tokens} tokens")
+    return TokenReservation(key_token, estimated_tokens)
 
-def update_usage(input_str: str, output_str: str, processing_time: float, key_token: str, avg_queue_time: float = 0.0) -> None:
+def update_usage(input_tokens: int, output_tokens: int, processing_time: float, key_token: str, avg_queue_time: float = 0.0, reserved_tokens: int = 0) -> None:
     """
-    Updates the database with the token usage for the current month, increments the number of requests, 
-    and updates average processing and queue times.
-    
-    If the email document or the required fields are not present, it raises an error.
+    Adds the token usage of a request to the current hour and month buckets, with its processing
+    time and queue time. The usage is buffered and written behind by `usage_aggregator`, averages
+    and percentiles are computed when read.
 
     Args:
-        input_str (str): The input string for which tokens are calculated.
-        output_str (str): The output string for which tokens are calculated.
+        input_tokens (int): The prompt tokens counted by the backend.
+        output_tokens (int): The completion tokens counted by the backend.
         processing_time (float): The time taken to process the request.
-        email (str): The email for which the usage is being updated.
-        project_id (int): The project ID associated with the email.
+        key_token (str): User identifier.
         avg_queue_time (float, optional): The average time spent in the queue. Defaults to 0.0.
+        reserved_tokens (int, optional): Tokens already counted by `reserve_tokens`.
 
     Returns:
         None
     """
     print("\nUpdating usage...")
 
-    # Calculate tokens for input and output strings
-    input_tokens = get_number_of_tokens(input_str)
-    output_tokens = get_number_of_tokens(output_str)
     total_tokens = input_tokens + output_tokens
 
-    # Get the field name for the current month and year
-    current_month_year = get_current_month_year()
+    counters = {
+        "requests": 1,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "processing_time": processing_time,
+    }
+    if avg_queue_time > 0:
+        counters["queue_time"] = avg_queue_time
+
+    # Summed with the usage of other requests and written as one $inc,
+    # only the difference with the reserved tokens is added to the month
+    usage_aggregator.add(key_token, tokens=total_tokens - reserved_tokens, counters=counters, latency=processing_time)
+    print(f"\nUsage added: {counters}")
+
+def get_usage_with_averages(usage: dict) -> dict:
+    """The usage of a date range with the averages per request of its totals."""
+    usage = dict(usage)
+    number_of_requests = usage.get("number_of_requests", 0)
+    if not number_of_requests:
+        return usage
+
+    for total, average in (
+        ("total_input_token", "avg_input_token"),
+        ("total_output_token", "avg_output_token"),
+        ("total_processing_time", "avg_processing_time"),
+        ("total_queue_time", "avg_queue_time"),
+    ):
+        if total in usage:
+            usage[total] = round(usage[total], 2)
+            usage[average] = round(usage[total] / number_of_requests, 2)
+
+    return usage
+
+def get_queue_weight(key_token: str) -> float:
+    """
+    Get the share of the judge a user gets relative to other users when queued.
 
-    # Retrieve the document for the email and project_id
-    user_data = mongo.db.credits.find_one({"key_token": key_token})
-    print("\nUser Data before update: ")
-    pprint(user_data)
+    Args:
+        key_token (str): User identifier.
+
+    Returns:
+        float: The `queue_weight` of the user, DEFAULT_TENANT_WEIGHT if not set.
+    """
+    user_data = get_credits(key_token)
+
+    if not user_data:
+        raise ValueError(f"Document not found for token: {key_token}")
+
+    return user_data.get("queue_weight", DEFAULT_TENANT_WEIGHT)
+
+def get_rate_limits(key_token: str) -> dict:
+    """
+    Get the short-window rate limits of a user.
+
+    Args:
+        key_token (str): User identifier.
+
+    Returns:
+        dict: The `requests_per_minute` and `tokens_per_minute` of the user, None when not set.
+    """
+    user_data = get_credits(key_token)
 
     if not user_data:
-        # If the document doesn't exist, raise an error
-        print(f"Document not found for token: {key_token}")
         raise ValueError(f"Document not found for token: {key_token}")
 
-    # Initialize or update the current month's usage
-    current_usage = user_data.get(current_month_year, {})
-    updated_total_token_used = current_usage.get("token_used", 0) + total_tokens
-    updated_number_of_requests = current_usage.get("number_of_requests", 0) + 1
-    updated_input_token_used = current_usage.get("total_input_token", 0) + input_tokens
-    updated_output_tokens_used = current_usage.get("total_output_token", 0) + output_tokens
-    updated_processing_time = current_usage.get("total_processing_time", 0) + processing_time
-
-    print(f"Upd Processing time: {updated_processing_time}, Request: {updated_number_of_requests}")
-    # Prepare the update operation with calculated averages
-    update_fields = {
-        f"{current_month_year}.token_used": updated_total_token_used,
-        f"{current_month_year}.number_of_requests": updated_number_of_requests,
-
-        f"{current_month_year}.total_input_token": round(updated_input_token_used, 2),
-        f"{current_month_year}.avg_input_token": round(updated_input_token_used / updated_number_of_requests, 2),
-
-        f"{current_month_year}.total_output_token": round(updated_output_tokens_used,2),
-        f"{current_month_year}.avg_output_token": round(updated_output_tokens_used / updated_number_of_requests, 2),
-
-        f"{current_month_year}.last_request_processing_time": round(processing_time, 2),
-        f"{current_month_year}.total_processing_time": round(updated_processing_time, 2),
-        f"{current_month_year}.avg_processing_time": round(updated_processing_time / updated_number_of_requests, 2),
+    rate_limits = user_data.get("rate_limits") or {}
+    return {
+        "requests_per_minute": rate_limits.get("requests_per_minute"),
+        "tokens_per_minute": rate_limits.get("tokens_per_minute"),
     }
 
-    if avg_queue_time > 0:
-        # Update the average queue time if provided
-        updated_avg_queue_time = current_usage.get("total_queue_time", 0) + avg_queue_time
+def find_project(key_token: str, project_identifier: str) -> dict:
+    """
+    Get a project of a tenant by ID or name, migrating the tenant to the normalized collections first if needed.
+
+    Raises:
+        ValueError: If the user or project is not found.
+    """
+    ensure_migrated(key_token)
+
+    project = mongo.db.projects.find_one(
+        {
+            "key_token": key_token,
+            "$or": [{"project_id": project_identifier}, {"project_name": project_identifier}],
+        },
+        {"_id": 0, "key_token": 1, "project_id": 1, "project_name": 1, "judge_profile": 1}
+    )
+    if not project:
+        raise ValueError(f"Project '{project_identifier}' not found.")
+
+    return project
+
+def get_set_key(key_token: str, project_id: str, set_id) -> dict:
+    """Filter of a QA set, and of its items and scores."""
+    return {"key_token": key_token, "project_id": project_id, "set_id": set_id}
+
+def insert_qa_items(key_token: str, project_id: str, set_id, qa_set: list[dict]) -> None:
+    mongo.db.qa_items.insert_many([
+        {**get_set_key(key_token, project_id, set_id), "position": position, **qa}
+        for position, qa in enumerate(qa_set)
+    ])
+
+def get_lookup_stage(collection: str, key_token: str, output: str, sort: dict = None, fields: tuple = None) -> dict:
+    """$lookup stage joining the items of a QA set, e.g. its question-answers or scores."""
+    pipeline = [{"$match": {
+        "key_token": key_token,
+        "$expr": {"$and": [{"$eq": ["$project_id", "$$project_id"]}, {"$eq": ["$set_id", "$$set_id"]}]},
+    }}]
+    if sort:
+        pipeline.append({"$sort": sort})
+    pipeline.append({"$project": {"_id": 0, **{field: 1 for field in fields}}})
+
+    return {"$lookup": {
+        "from": collection,
+        "let": {"project_id": "$project_id", "set_id": "$set_id"},
+        "pipeline": pipeline,
+        "as": output,
+    }}
+
+def get_qa_sets(key_token: str, project_id: str = None, match: dict = None, set_fields: tuple = None, include_items: bool = True, item_fields: tuple = ("id", "question", "answer"), include_scores: bool = False) -> list[dict]:
+    """
+    Get QA sets in the layout of the API in one aggregation, with their question-answers
+    under "qa_set" and their saved scores under "scores". Only the requested fields are
+    sent by the server.
+
+    Args:
+        key_token (str): User identifier.
+        project_id (str, optional): ID of the project, None for every project of the user.
+        match (dict, optional): Filter of the sets, e.g. {"set_id": 1} or {"baseline": True}.
+        set_fields (tuple, optional): Fields of the sets to return, None for all.
+        include_items (bool): Whether to join the question-answers.
+        item_fields (tuple): Fields of the question-answers to return.
+        include_scores (bool): Whether to join the saved scores, sets without scores have no "scores".
+
+    Returns:
+        list[dict]: The QA sets, in the order they were added. "project_id" is only
+        included when no project is given.
+    """
+    query = {"key_token": key_token, **(match or {})}
+    if project_id is not None:
+        query["project_id"] = project_id
+
+    pipeline = [{"$match": query}, {"$sort": {"_id": 1}}]
+    if include_items:
+        pipeline.append(get_lookup_stage("qa_items", key_token, "qa_set", sort={"position": 1}, fields=item_fields))
+    if include_scores:
+        pipeline.append(get_lookup_stage("scores", key_token, "scores", fields=("question_id", "score_data")))
+
+    if set_fields is None:
+        projection = {"_id": 0, "key_token": 0}
+        if project_id is not None:
+            projection["project_id"] = 0
+    else:
+        projection = {"_id": 0, "set_id": 1, **{field: 1 for field in set_fields}}
+        if project_id is None:
+            projection["project_id"] = 1
+        if include_items:
+            projection["qa_set"] = 1
+        if include_scores:
+            projection["scores"] = 1
+    pipeline.append({"$project": projection})
+
+    qa_sets = list(mongo.db.qa_sets.aggregate(pipeline))
+
+    if include_scores:
+        for qa_set in qa_sets:
+            scores = {score["question_id"]: score["score_data"] for score in qa_set.pop("scores")}
+            if scores:
+                qa_set["scores"] = scores
+
+    return qa_sets
+
+def get_project_details(project: dict) -> dict:
+    """A project in the layout of the API, with its QA sets."""
+    details = {
+        key: value for key, value in project.items()
+        if key not in ("_id", "key_token", "project_id")
+    }
+    details["qa_sets"] = get_qa_sets(project["key_token"], project["project_id"], include_scores=True)
+    return details
+
+def find_qa_set(key_token: str, project_id: str, set_id=None, set_fields: tuple = None, item_fields: tuple = ("id", "question", "answer")) -> dict:
+    """
+    Get a QA set of a project by ID, or its baseline, with its question-answers under "qa_set".
+
+    Returns:
+        dict: The QA set, None if not found.
+    """
+    match = {"set_id": set_id} if set_id is not None else {"baseline": True}
+    qa_sets = get_qa_sets(key_token, project_id, match=match, set_fields=set_fields, item_fields=item_fields)
+    return qa_sets[0] if qa_sets else None
+
+def get_sets_to_compare(key_token: str, project_identifier: str, current_set_ids: list, baseline_set_id=None, include_key_facts: bool = False) -> tuple:
+    """
+    Get a project, its baseline QA set and the QA sets to compare against it, in one aggregation.
 
-        update_fields[f"{current_month_year}.avg_queue_time"] = round(updated_avg_queue_time / updated_number_of_requests, 2)
-        update_fields[f"{current_month_year}.total_queue_time"] = round(updated_avg_queue_time, 2)
+    Args:
+        key_token (str): User identifier.
+        project_identifier (str): Either the project ID or project name.
+        current_set_ids (list): IDs of the QA sets to compare.
+        baseline_set_id (optional): ID of the baseline QA set, the set flagged as baseline if not given.
+        include_key_facts (bool): Whether to fetch the key facts of the baseline.
+
+    Returns:
+        tuple: The project, the baseline set and the current sets in the order of `current_set_ids`.
+
+    Raises:
+        ValueError: If the project or a set is not found.
+    """
+    project = find_project(key_token, project_identifier)
+    project_key = project["project_id"]
+
+    baseline_match = {"set_id": baseline_set_id} if baseline_set_id else {"baseline": True}
+    set_fields = ("baseline", "last_updated", "key_facts") if include_key_facts else ("baseline",)
+    qa_sets = get_qa_sets(
+        key_token, project_key,
+        match={"$or": [baseline_match, {"set_id": {"$in": list(current_set_ids)}}]},
+        set_fields=set_fields
+    )
+
+    if baseline_set_id:
+        baseline_set = next((qa_set for qa_set in qa_sets if qa_set["set_id"] == baseline_set_id), None)
+    else:
+        baseline_set = next((qa_set for qa_set in qa_sets if qa_set.get("baseline", False)), None)
 
-    # Perform the update operation in the database
-    print("\nUpdated Fields:")
-    pprint(update_fields)
-    mongo.db.credits.update_one({"key_token": key_token}, {"$set": update_fields})
+    if not baseline_set:
+        raise ValueError("Baseline QA set could not be found.")
+
+    sets_by_id = {qa_set["set_id"]: qa_set for qa_set in qa_sets}
+    current_sets = []
+    for current_set_id in current_set_ids:
+        if current_set_id not in sets_by_id:
+            raise ValueError(f"Current QA set with set_id '{current_set_id}' could not be found.")
+        current_sets.append(sets_by_id[current_set_id])
+
+    return project, baseline_set, current_sets
 
 def add_qa(key_token: str, project_identifier: str, qa_data: dict) -> None:
     """
@@ -192,57 +471,52 @@ def add_qa(key_token: str, project_identifier: str, qa_data: dict) -> None:
         raise ValueError("Both 'qa_set' and 'set_id' must be provided.")
 
     try:
-        # Retrieve user data
-        user_data = mongo.db.qa_data.find_one({"key_token": key_token})
-
-        if not user_data:
-            raise Exception(f"Document not found for user: {key_token}")
-
-        projects = user_data.get("projects", {})
-
-        if not projects:
-            raise Exception(f"No projects found for user. Add projects first.")
-
-        # Identify the correct project
-        project_key = None
-        for proj_id, project in projects.items():
-            if proj_id == project_identifier or project.get("project_name") == project_identifier:
-                project_key = proj_id
-                break
-
-        if not project_key:
+        ensure_migrated(key_token)
+
+        # Find the project and count the new set in one round trip, the first set of a
+        # project is its baseline, even if two sets are added at once
+        project = mongo.db.projects.find_one_and_update(
+            {"key_token": key_token, "$or": [{"project_id": project_identifier}, {"project_name": project_identifier}]},
+            {"$inc": {"qa_set_count": 1}},
+            projection={"project_id": 1, "qa_set_count": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        if not project:
             raise ValueError(f"Project '{project_identifier}' not found.")
 
-        project = projects[project_key]
-
-        # Initialize "qa_sets" if it does not exist in the project
-        if "qa_sets" not in project:
-            project["qa_sets"] = []
-
-        # Check if the set_id already exists within this project
-        existing_set = next((entry for entry in project["qa_sets"] if entry["set_id"] == set_id), None)
-
-        if existing_set:
-            raise ValueError(f"QA set with set_id '{set_id}' already exists in project '{project_identifier}'.")
-
-        # Determine baseline status
-        is_baseline = len(project["qa_sets"]) == 0
+        project_key = project["project_id"]
+        is_baseline = not project.get("qa_set_count")
+
+        try:
+            # Add new QA set, the unique key rejects an existing set_id
+            try:
+                mongo.db.qa_sets.insert_one({
+                    **get_set_key(key_token, project_key, set_id),
+                    "last_updated": get_current_datetime(),
+                    "baseline": is_baseline
+                })
+            except DuplicateKeyError:
+                raise ValueError(f"QA set with set_id '{set_id}' already exists in project '{project_identifier}'.")
+
+            try:
+                insert_qa_items(key_token, project_key, set_id, qa_set)
+            except Exception:
+                # Remove the set and the items inserted before the failure
+                set_key = get_set_key(key_token, project_key, set_id)
+                mongo.db.qa_items.delete_many(set_key)
+                mongo.db.qa_sets.delete_one(set_key)
+                raise
+        except Exception:
+            # The set was not added, undo its count
+            mongo.db.projects.update_one(
+                {"key_token": key_token, "project_id": project_key}, {"$inc": {"qa_set_count": -1}}
+            )
+            raise
 
-        # Add new QA set
-        new_qa_set = {
-            "set_id": set_id,
-            "qa_set": qa_set,
-            "last_updated": get_current_datetime(),
-            "baseline": is_baseline
-        }
+        metadata_cache.invalidate_project(key_token, project_key)
 
-        project["qa_sets"].append(new_qa_set)
-
-        # Save updated projects data back to the database
-        mongo.db.qa_data.update_one(
-            {"key_token": key_token},
-            {"$set": {f"projects.{project_key}.qa_sets": project["qa_sets"]}}
-        )
+        if is_baseline:
+            start_key_facts_extraction(key_token, project_key, set_id)
 
     except Exception as e:
         print(f"An error occurred while adding QA: {e}")
@@ -265,53 +539,29 @@ def update_baseline(key_token: str, project_identifier: str, set_id: int) -> Non
         raise ValueError("'set_id' must be provided to update the baseline.")
 
     try:
-        # Retrieve user data
-        user_data = mongo.db.qa_data.find_one({"key_token": key_token})
-
-        if not user_data:
-            raise ValueError(f"No data found for {key_token}")
-
-        projects = user_data.get("projects", {})
-
-        if not projects:
-            raise ValueError(f"No projects found for user. Add projects first.")
-
-        # Identify the correct project
-        project_key = None
-        for proj_id, project in projects.items():
-            if proj_id == project_identifier or project.get("project_name") == project_identifier:
-                project_key = proj_id
-                break
-
-        if not project_key:
-            raise ValueError(f"Project '{project_identifier}' not found.")
-
-        project = projects[project_key]
-
-        # Ensure the project has QA sets
-        if "qa_sets" not in project or not project["qa_sets"]:
-            raise ValueError(f"No QA sets found in project '{project_identifier}'.")
+        project = find_project(key_token, project_identifier)
+        project_key = project["project_id"]
 
         # Check if the set_id exists in the project’s QA sets
-        existing_set = next(
-            (entry for entry in project["qa_sets"] if entry["set_id"] == set_id),
-            None
+        existing_set = mongo.db.qa_sets.find_one(
+            get_set_key(key_token, project_key, set_id), {"key_facts": 1, "last_updated": 1}
         )
 
         if not existing_set:
             raise ValueError(f"Set ID '{set_id}' does not exist in project '{project_identifier}'.")
 
-        # Reset all `baseline` flags to False within this project
-        mongo.db.qa_data.update_one(
-            {"key_token": key_token},
-            {"$set": {f"projects.{project_key}.qa_sets.$[].baseline": False}}
+        # Flag the new baseline and unflag the others in one update, the project never has no baseline
+        mongo.db.qa_sets.update_many(
+            {"key_token": key_token, "project_id": project_key},
+            [{"$set": {"baseline": {"$eq": ["$set_id", {"$literal": set_id}]}}}]
         )
+        metadata_cache.invalidate_project(key_token, project_key)
 
-        # Set the new baseline
-        mongo.db.qa_data.update_one(
-            {"key_token": key_token, f"projects.{project_key}.qa_sets.set_id": set_id},
-            {"$set": {f"projects.{project_key}.qa_sets.$.baseline": True}}
-        )
+        # Extract the key facts unless they are already up to date with the set and the project's profile
+        key_facts = existing_set.get("key_facts", {})
+        facts_cache_key = get_profile(project.get("judge_profile")).get_key_facts_cache_key(existing_set.get("last_updated"))
+        if key_facts.get("status") != "ready" or key_facts.get("cache_key") != facts_cache_key:
+            start_key_facts_extraction(key_token, project_key, set_id)
 
     except Exception as e:
         print(f"An error occurred while updating the baseline: {e}")
@@ -339,56 +589,38 @@ def update_qa(key_token: str, project_identifier: str, qa_data: dict) -> None:
         raise ValueError("Both 'qa_set' and 'set_id' must be provided.")
 
     try:
-        # Retrieve user data
-        user_data = mongo.db.qa_data.find_one({"key_token": key_token})
-
-        if not user_data:
-            raise ValueError(f"No QA data found for user: {key_token}")
-
-        projects = user_data.get("projects", {})
-
-        if not projects:
-            raise ValueError(f"No projects found for user. Add projects first.")
-
-        # Identify the correct project
-        project_key = None
-        for proj_id, project in projects.items():
-            if proj_id == project_identifier or project.get("project_name") == project_identifier:
-                project_key = proj_id
-                break
-
-        if not project_key:
-            raise ValueError(f"Project '{project_identifier}' not found.")
-
-        project = projects[project_key]
-
-        # Ensure the project has QA sets
-        if "qa_sets" not in project or not project["qa_sets"]:
-            raise ValueError(f"No QA sets found in project '{project_identifier}'.")
-
-        # Locate the QA set within the project
-        qa_sets = project["qa_sets"]
-        qa_set_index = next((i for i, entry in enumerate(qa_sets) if entry["set_id"] == set_id), None)
+        project = find_project(key_token, project_identifier)
+        project_key = project["project_id"]
+
+        # Locate the QA set within the project and update it in one round trip. It is updated
+        # first, so key facts being extracted from the old answers are not saved
+        existing_set = mongo.db.qa_sets.find_one_and_update(
+            get_set_key(key_token, project_key, set_id),
+            {"$set": {"last_updated": get_current_datetime()}},
+            projection={"baseline": 1}
+        )
 
-        if qa_set_index is None:
+        if not existing_set:
             raise ValueError(f"Set ID '{set_id}' does not exist in project '{project_identifier}'.")
 
-        # Update the QA set
-        current_datetime = get_current_datetime()
-        qa_sets[qa_set_index]["qa_set"] = qa_set
-        qa_sets[qa_set_index]["last_updated"] = current_datetime
+        # Replace the question-answers in place, readers never see the set empty
+        set_key = get_set_key(key_token, project_key, set_id)
+        mongo.db.qa_items.bulk_write([
+            ReplaceOne({**set_key, "position": position}, {**set_key, "position": position, **qa}, upsert=True)
+            for position, qa in enumerate(qa_set)
+        ])
+        mongo.db.qa_items.delete_many({**set_key, "position": {"$gte": len(qa_set)}})
+        metadata_cache.invalidate_project(key_token, project_key)
 
-        # Save updated QA sets to the database
-        mongo.db.qa_data.update_one(
-            {"key_token": key_token},
-            {"$set": {f"projects.{project_key}.qa_sets": qa_sets}}
-        )
+        # Answers of the baseline changed, its key facts must be extracted again
+        if existing_set.get("baseline", False):
+            start_key_facts_extraction(key_token, project_key, set_id)
 
     except Exception as e:
         print(f"An error occurred while updating the QA set: {e}")
         raise Exception(f"Failed to update the QA set: {e}")
- 
-def compare_qa_sets(key_token: str, project_identifier: str, current_set_id: str, baseline_set_id: str = None) -> dict:
+
+def compare_qa_sets(key_token: str, project_identifier: str, current_set_id: str, baseline_set_id: str = None, use_key_facts: bool = True, cancel_key: str = None, idempotency_key: str = None) -> dict:
     """
     Compare two QA sets for a user within a specific project and return the comparison results.
 
@@ -397,9 +629,15 @@ def compare_qa_sets(key_token: str, project_identifier: str, current_set_id: str
         project_identifier (str): Either the project ID or project name.
         current_set_id (str): ID of the current QA set.
         baseline_set_id (str, optional): ID of the baseline QA set. If not provided, the baseline is auto-selected.
+        use_key_facts (bool, optional): Score against the precomputed key facts of the baseline when they are available.
+        cancel_key (str, optional): Key the scoring can be cancelled with, e.g. when the client disconnects.
+        idempotency_key (str, optional): Idempotency-Key of the comparison, a repeat reuses the scores of the original.
 
     Returns:
-        dict: A dictionary containing the comparison scores.
+        dict: The comparison scores under "scores", with the "status" of every question. Questions
+        that could not be scored have the "failed" status and an "error" instead of a score.
+        "key_facts" is the status of the key facts of the baseline: "used", "disabled", or why they
+        were not used, "pending", "failed" or "missing". Failed or outdated key facts are extracted again.
 
     Raises:
         ValueError: If the user, project, or QA sets are not found.
@@ -409,49 +647,14 @@ def compare_qa_sets(key_token: str, project_identifier: str, current_set_id: str
         raise ValueError("'current_set_id' must be provided.")
     
     try:
-        # Find user data by key_token
-        user_data = mongo.db.qa_data.find_one({"key_token": key_token})
-        if not user_data:
-            raise ValueError(f"No QA data found for: {key_token}")
-
-        projects = user_data.get("projects", {})
-        if not projects:
-            raise ValueError(f"No projects found for user: {key_token}")
-
-        # Identify the correct project
-        project_key = None
-        for proj_id, project in projects.items():
-            if proj_id == project_identifier or project.get("project_name") == project_identifier:
-                project_key = proj_id
-                break
-
-        if not project_key:
-            raise ValueError(f"Project '{project_identifier}' not found.")
-        project = projects[project_key]
-
-        # Ensure the project has QA sets
-        qa_sets = project.get("qa_sets", [])
-        if not qa_sets:
-            raise ValueError(f"No QA sets found in project '{project_identifier}'.")
-
-        # Retrieve baseline QA set
-        baseline_set = None
-        if baseline_set_id:
-            baseline_set = next((qa_set for qa_set in qa_sets if qa_set["set_id"] == baseline_set_id), None)
-        else:
-            baseline_set = next((qa_set for qa_set in qa_sets if qa_set.get("baseline", False)), None)
-
-        if not baseline_set:
-            raise ValueError("Baseline QA set could not be found.")
-
-        # Retrieve the current QA set
-        current_set = next((qa_set for qa_set in qa_sets if qa_set["set_id"] == current_set_id), None)
-
-        if not current_set:
-            raise ValueError(f"Current QA set with set_id '{current_set_id}' could not be found.")
+        # Retrieve the baseline QA set, the set flagged as baseline if no ID is given, and the current QA set
+        project, baseline_set, (current_set,) = get_sets_to_compare(
+            key_token, project_identifier, [current_set_id],
+            baseline_set_id=baseline_set_id, include_key_facts=use_key_facts
+        )
 
         # Both sets same
-        if current_set == baseline_set:
+        if current_set["set_id"] == baseline_set["set_id"]:
             raise ValueError("Both the sets are identical.")
 
         current_set_ids = {qa_set['id'] for qa_set in current_set["qa_set"]}
@@ -460,6 +663,24 @@ def compare_qa_sets(key_token: str, project_identifier: str, current_set_id: str
         if current_set_ids != baseline_set_ids:
             raise Exception("Question sets do not match.")
 
+        judge_profile = project.get("judge_profile")
+        profile = get_profile(judge_profile)
+
+        # Key facts are only used when they were extracted from the current baseline answers by the project's profile
+        baseline_facts = {}
+        key_facts = baseline_set.get("key_facts", {})
+        facts_cache_key = profile.get_key_facts_cache_key(baseline_set.get("last_updated"))
+        if not use_key_facts:
+            key_facts_status = "disabled"
+        elif key_facts.get("status") == "ready" and key_facts.get("cache_key") == facts_cache_key:
+            baseline_facts = key_facts.get("facts", {})
+            key_facts_status = "used"
+        else:
+            if restart_key_facts_extraction(key_token, project["project_id"], baseline_set["set_id"], key_facts):
+                key_facts_status = "pending"
+            else:
+                key_facts_status = key_facts.get("status", "missing")
+
         # Create a dictionary for query data
         queries_data = {}
         for baseline_qa, current_qa in zip(baseline_set["qa_set"], current_set["qa_set"]):
@@ -469,17 +690,25 @@ def compare_qa_sets(key_token: str, project_identifier: str, current_set_id: str
                 "baseline": baseline_qa["answer"],
                 "current": current_qa["answer"]
             }
+            if baseline_facts.get(str(question_id)):
+                query["baseline_facts"] = baseline_facts[str(question_id)]
             queries_data[str(question_id)] = query
 
         # Prepare the payload for the POST request
         payload = {
             "queries_data": queries_data,
+            "judge_profile": judge_profile,
         }
 
         headers = {
             "Content-Type": "application/json",
             "key-token" : key_token
         }
+        if cancel_key:
+            headers["cancel-key"] = cancel_key
+        if idempotency_key:
+            # Scoped to comparisons, so the same key sent to /calculate-score-for-queries is not a conflict
+            headers["Idempotency-Key"] = f"compare-qna-sets:{idempotency_key}"
 
         print("Payload:")
         pprint(payload)
@@ -493,56 +722,367 @@ def compare_qa_sets(key_token: str, project_identifier: str, current_set_id: str
         enriched_scores_data = {}
         for question_id, score_info in scores_data.get("scores", {}).items():
             query_info = queries_data.get(question_id, {})
+            status = score_info.get("status", "ok")
 
             enriched_scores_data[question_id] = {
-                "reason": score_info.get("reason", "No reason"),
-                "score": score_info.get("score", 0),
+                "status": status,
                 "question": query_info.get("question", ""),
                 "baseline": query_info.get("baseline", ""),
                 "current": query_info.get("current", "")
             }
 
+            # A question the judge failed to score has no score, not a score of 0
+            if status == "failed":
+                enriched_scores_data[question_id]["error"] = score_info.get("error", "")
+            else:
+                enriched_scores_data[question_id].update({
+                    "reason": score_info.get("reason", "No reason"),
+                    "score": score_info.get("score", 0),
+                    "prompt_version": score_info.get("prompt_version"),
+                })
+
         print("Updated Scores Data:")
         pprint(enriched_scores_data)
 
-        return enriched_scores_data
+        return {"scores": enriched_scores_data, "key_facts": key_facts_status}
+    except ScoringRequestFailed:
+        raise
     except Exception as e:
         print(f"An error occurred while comparing QA sets: {e}")
         raise Exception(f"Failed to compare QA sets: {e}")
 
+def compare_multiple_qa_sets(key_token: str, project_identifier: str, current_set_ids: list, baseline_set_id: str = None) -> dict:
+    """
+    Compare several QA sets against the same baseline QA set, scoring all the
+    candidate answers of a question in a single LLM call.
+
+    Args:
+        key_token (str): User identifier.
+        project_identifier (str): Either the project ID or project name.
+        current_set_ids (list): IDs of the QA sets to compare against the baseline.
+        baseline_set_id (str, optional): ID of the baseline QA set. If not provided, the baseline is auto-selected.
+
+    Returns:
+        dict: The comparison scores indexed by current set ID and then by question ID, with
+        their "status". Questions that could not be scored have the "failed" status and an "error".
+
+    Raises:
+        ValueError: If the user, project, or QA sets are not found.
+        Exception: If an error occurs while comparing QA sets.
+    """
+    if not current_set_ids:
+        raise ValueError("'current_set_ids' must be provided.")
+
+    try:
+        # Retrieve the baseline QA set, the set flagged as baseline if no ID is given, and the current QA sets
+        project, baseline_set, current_sets = get_sets_to_compare(
+            key_token, project_identifier, current_set_ids, baseline_set_id=baseline_set_id
+        )
+
+        baseline_set_ids = {qa['id'] for qa in baseline_set["qa_set"]}
+
+        # Retrieve the current QA sets, answers indexed by question ID
+        current_answers = {}
+        for current_set_id, current_set in zip(current_set_ids, current_sets):
+            if current_set["set_id"] == baseline_set["set_id"]:
+                raise ValueError(f"Set '{current_set_id}' is the baseline set.")
+
+            if {qa['id'] for qa in current_set["qa_set"]} != baseline_set_ids:
+                raise Exception(f"Question sets do not match for set '{current_set_id}'.")
+
+            current_answers[str(current_set_id)] = {
+                str(qa["id"]): qa["answer"] for qa in current_set["qa_set"]
+            }
+
+        # One query per question, with the answer of every current set as a candidate
+        queries_data = {}
+        for baseline_qa in baseline_set["qa_set"]:
+            question_id = str(baseline_qa["id"])
+            queries_data[question_id] = {
+                "question": baseline_qa["question"],
+                "baseline": baseline_qa["answer"],
+                "candidates": {
+                    set_id: answers[question_id] for set_id, answers in current_answers.items()
+                }
+            }
+
+        payload = {
+            "queries_data": queries_data,
+            "judge_profile": project.get("judge_profile"),
+        }
+
+        headers = {
+            "Content-Type": "application/json",
+            "key-token" : key_token
+        }
+
+        scores_data = post_score_for_queries(
+            payload, headers=headers, endpoint="calculate-score-for-candidates"
+        )
+
+        # Enrich the scores data with question, baseline, and current answers
+        enriched_scores_data = {set_id: {} for set_id in current_answers}
+        for question_id, candidate_scores in scores_data.get("scores", {}).items():
+            query_info = queries_data.get(question_id, {})
+
+            for set_id, score_info in candidate_scores.items():
+                enriched_scores_data[set_id][question_id] = {
+                    "status": "ok",
+                    "reason": score_info.get("reason", "No reason"),
+                    "score": score_info.get("score", 0),
+                    "prompt_version": score_info.get("prompt_version"),
+                    "question": query_info.get("question", ""),
+                    "baseline": query_info.get("baseline", ""),
+                    "current": query_info.get("candidates", {}).get(set_id, "")
+                }
+
+        # A question the judge failed to score has no score in any set
+        for question_id, error in scores_data.get("failed", {}).items():
+            query_info = queries_data.get(question_id, {})
+            for set_id in enriched_scores_data:
+                enriched_scores_data[set_id][question_id] = {
+                    "status": "failed",
+                    "error": error,
+                    "question": query_info.get("question", ""),
+                    "baseline": query_info.get("baseline", ""),
+                    "current": query_info.get("candidates", {}).get(set_id, "")
+                }
+
+        return enriched_scores_data
+    except ScoringRequestFailed:
+        raise
+    except Exception as e:
+        print(f"An error occurred while comparing multiple QA sets: {e}")
+        raise Exception(f"Failed to compare QA sets: {e}")
+
+def start_key_facts_extraction(key_token: str, project_key: str, set_id: int, expected: dict = None) -> bool:
+    """
+    Mark the key facts of a QA set as pending and extract them in a background thread.
+
+    Args:
+        key_token (str): User identifier.
+        project_key (str): ID of the project.
+        set_id (int): ID of the QA set, usually the new baseline.
+        expected (dict, optional): Filter the set must still match, so concurrent requests start one extraction.
+
+    Returns:
+        bool: Whether the extraction was started.
+    """
+    result = mongo.db.qa_sets.update_one(
+        {**get_set_key(key_token, project_key, set_id), **(expected or {})},
+        {"$set": {"key_facts": {"status": "pending"}}}
+    )
+    if result.matched_count == 0:
+        return False
+    metadata_cache.invalidate_project(key_token, project_key)
+
+    app = current_app._get_current_object()
+    thread = threading.Thread(
+        target=extract_and_save_key_facts,
+        args=(app, key_token, project_key, set_id),
+        daemon=True
+    )
+    thread.start()
+    return True
+
+def restart_key_facts_extraction(key_token: str, project_key: str, set_id: int, key_facts: dict) -> bool:
+    """
+    Extract again the key facts of a QA set that failed, at most every KEY_FACTS_RETRY_SECONDS,
+    or are outdated, e.g. extracted with another prompt version or profile.
+
+    Args:
+        key_facts (dict): The key facts of the set as read, unless another request changed them since.
+
+    Returns:
+        bool: Whether the extraction was started, False if they are pending or retried too recently.
+    """
+    status = key_facts.get("status")
+    if status == "pending":
+        return False
+
+    failed_at = key_facts.get("failed_at")
+    if status == "failed" and failed_at:
+        retry_at = failed_at.replace(tzinfo=datetime.timezone.utc) + datetime.timedelta(seconds=KEY_FACTS_RETRY_SECONDS)
+        if retry_at > datetime.datetime.now(datetime.timezone.utc):
+            return False
+
+    return start_key_facts_extraction(
+        key_token, project_key, set_id,
+        expected={"key_facts.status": status, "key_facts.cache_key": key_facts.get("cache_key")}
+    )
+
+def extract_and_save_key_facts(app, key_token: str, project_key: str, set_id: int) -> None:
+    """
+    Extract the key facts of every answer in a QA set and cache them alongside the set.
+
+    The facts are only saved if the set was not updated while they were being extracted.
+
+    Args:
+        app (Flask): The application, used to access the database outside of a request.
+        key_token (str): User identifier.
+        project_key (str): ID of the project.
+        set_id (int): ID of the QA set.
+    """
+    with app.app_context():
+        project = mongo.db.projects.find_one({"key_token": key_token, "project_id": project_key}, {"judge_profile": 1})
+        if not project:
+            return
+
+        qa_set = find_qa_set(key_token, project_key, set_id, set_fields=("last_updated",))
+        if not qa_set:
+            return
+
+        source_last_updated = qa_set.get("last_updated")
+
+        try:
+            profile = get_profile(project.get("judge_profile"))
+            facts = get_key_facts_for_set(
+                qa_set.get("qa_set", []), queue_manager,
+                key_token=key_token, judge_profile=profile.name
+            )
+            key_facts = {
+                "status": "ready",
+                "facts": facts,
+                "source_last_updated": source_last_updated,
+                "cache_key": profile.get_key_facts_cache_key(source_last_updated),
+                "prompt_version": KEY_FACTS_PROMPT_VERSION,
+                "extracted_at": get_current_datetime(),
+            }
+            print(f"Key facts extracted for set '{set_id}' of project '{project_key}'.")
+        except Exception as e:
+            print(f"An error occurred while extracting key facts: {e}")
+            key_facts = {
+                "status": "failed",
+                "error": str(e),
+                "source_last_updated": source_last_updated,
+                "prompt_version": KEY_FACTS_PROMPT_VERSION,
+                "failed_at": datetime.datetime.now(datetime.timezone.utc),
+            }
+
+        mongo.db.qa_sets.update_one(
+            {**get_set_key(key_token, project_key, set_id), "last_updated": source_last_updated},
+            {"$set": {"key_facts": key_facts}}
+        )
+        metadata_cache.invalidate_project(key_token, project_key)
+
 # is_baseline = baseline_set.get("baseline", False)
 # if not is_baseline:
 #     raise ValueError(f"Set with set_id {baseline_set_id} is not baseline.")
 
-def get_usage_details(key_token: str) -> dict:
+def get_usage_buckets(key_token: str, start: datetime.datetime, end: datetime.datetime = None) -> dict:
     """
-    Retrieve usage details for a given email and project ID for the current month.
+    Sum the hour buckets of a user in a date range with one indexed aggregation.
+
+    Returns:
+        dict: The USAGE_COUNTERS, the "latency_histogram" counts by bucket index
+        and the "last_request_processing_time" of the range.
+    """
+    bucket_start = {"$gte": start}
+    if end:
+        bucket_start["$lt"] = end
+
+    histogram_buckets = range(len(LATENCY_HISTOGRAM_BOUNDS) + 1)
+    result = list(mongo.db.usage.aggregate([
+        {"$match": {"key_token": key_token, "granularity": "hour", "bucket_start": bucket_start}},
+        {"$sort": {"bucket_start": 1}},
+        {"$group": {
+            "_id": None,
+            **{counter: {"$sum": f"${counter}"} for counter in USAGE_COUNTERS},
+            **{f"latency_{bucket}": {"$sum": f"$latency_histogram.{bucket}"} for bucket in histogram_buckets},
+            "last_request_processing_time": {"$last": "$last_request_processing_time"},
+        }},
+    ]))
+
+    totals = result[0] if result else {}
+    usage = {counter: totals.get(counter, 0) for counter in USAGE_COUNTERS}
+    usage["latency_histogram"] = {str(bucket): totals.get(f"latency_{bucket}", 0) for bucket in histogram_buckets}
+    usage["last_request_processing_time"] = totals.get("last_request_processing_time")
+    return usage
+
+def get_latency_percentiles(histogram: dict, percentiles: list) -> dict:
+    """
+    Estimate percentiles of the processing time from a histogram, as the upper bound of
+    the bucket reaching them. None for a percentile above the last bound, or without requests.
+    """
+    counts = [histogram.get(str(bucket), 0) for bucket in range(len(LATENCY_HISTOGRAM_BOUNDS) + 1)]
+    total = sum(counts)
+
+    estimates = {}
+    for percentile in percentiles:
+        estimate = None
+        if total:
+            rank = max(math.ceil(percentile / 100 * total), 1)
+            cumulative = 0
+            for bound, count in zip(LATENCY_HISTOGRAM_BOUNDS + [None], counts):
+                cumulative += count
+                if cumulative >= rank:
+                    estimate = bound
+                    break
+        estimates[f"p{percentile:g}"] = estimate
+
+    return estimates
+
+def get_usage_details(key_token: str, start: datetime.datetime = None, end: datetime.datetime = None, percentiles: list = DEFAULT_USAGE_PERCENTILES) -> dict:
+    """
+    Retrieve the usage details of a user for a date range, the current month by default.
 
     Args:
         key_token : user identifier
+        start (datetime, optional): Start of the range, UTC. Defaults to the start of the current month.
+        end (datetime, optional): End of the range, excluded, UTC. Defaults to now.
+        percentiles (list, optional): Percentiles of the processing time to estimate.
 
     Returns:
-        dict: A dictionary containing the usage details for the current month.
+        dict: The usage details for the range, with latency percentiles and histogram.
 
     Raises:
         ValueError: If no data is found for the provided email and project ID.
         Exception: If an error occurs while retrieving usage details.
     """
     try:
-        # Retrieve user data from the MongoDB collection
-        user_data = mongo.db.credits.find_one({"key_token" : key_token})
-        print("user_data in get_usage_details: ")
-        pprint(user_data)
+        user_data = get_credits(key_token)
 
         if not user_data:
             # Raise an error if no data is found
             raise ValueError(f"No data found for user: {key_token}")
 
-        # Get the current month and year in 'Month_Year' format
-        current_datetime = get_current_month_year()
+        # Usage of past months may still be in the credits
+        if not user_data.get("usage_migrated"):
+            migrate_usage(key_token)
+
+        start = start or get_month_start(get_utc_now())
+        usage = get_usage_buckets(key_token, start, end)
+
+        # With the usage not written yet
+        for field, value in usage_aggregator.get_pending(key_token, start, end).items():
+            if field.startswith("latency_histogram."):
+                bucket = field.split(".", 1)[1]
+                usage["latency_histogram"][bucket] = usage["latency_histogram"].get(bucket, 0) + value
+            else:
+                usage[field] = usage.get(field, 0) + value
+
+        print("usage in get_usage_details: ")
+        pprint(usage)
+
+        details = {
+            "start": start.isoformat(),
+            "end": end.isoformat() if end else None,
+            "token_used": usage["input_tokens"] + usage["output_tokens"],
+            "number_of_requests": usage["requests"],
+            "total_input_token": usage["input_tokens"],
+            "total_output_token": usage["output_tokens"],
+            "total_processing_time": usage["processing_time"],
+            "total_queue_time": usage["queue_time"],
+            "latency_percentiles": get_latency_percentiles(usage["latency_histogram"], percentiles),
+            "latency_histogram": [
+                {"le": bound, "count": usage["latency_histogram"].get(str(bucket), 0)}
+                for bucket, bound in enumerate(LATENCY_HISTOGRAM_BOUNDS + [None])
+            ],
+        }
+        if usage["last_request_processing_time"] is not None:
+            details["last_request_processing_time"] = usage["last_request_processing_time"]
 
-        # Return the usage details for the current month
-        return user_data.get(current_datetime, {})
+        return get_usage_with_averages(details)
     except Exception as e:
         # Print and raise an exception if an error occurs
         print(f"An error occurred while getting usage details: {e}")
@@ -559,44 +1099,26 @@ def get_set_ids(key_token: str, project_identifier: str) -> list[dict]:
     Returns:
         List[Dict]: A list of dictionaries containing the QA set IDs and their corresponding QA sets.
     """
-    # Find user data by key_token
-    user_data = mongo.db.qa_data.find_one({"key_token": key_token})
-
-    if not user_data:
-        raise ValueError(f"No user found for: {key_token}")
-
-    projects = user_data.get("projects", {})
-
-    if not projects:
-        raise ValueError(f"No projects found for user: {key_token}")
-
-    # Identify the correct project
-    project_key = None
-    for proj_id, project in projects.items():
-        if proj_id == project_identifier or project.get("project_name") == project_identifier:
-            project_key = proj_id
-            break
-
-    if not project_key:
-        raise ValueError(f"Project '{project_identifier}' not found.")
+    def load() -> tuple:
+        project = find_project(key_token, project_identifier)
 
-    project = projects[project_key]
+        # Ensure the project has QA sets
+        qa_sets = get_qa_sets(key_token, project["project_id"], set_fields=())
+        if not qa_sets:
+            raise ValueError(f"No QA sets found in project '{project_identifier}'.")
 
-    # Ensure the project has QA sets
-    qa_sets = project.get("qa_sets", [])
-    if not qa_sets:
-        raise ValueError(f"No QA sets found in project '{project_identifier}'.")
+        # Create a list of dictionaries containing the QA set IDs and their corresponding QA sets
+        set_ids = [
+            {
+                "set_id": qa_set.get("set_id", None),  # QA set ID
+                "qa_set": qa_set.get("qa_set", [])    # QA set data
+            }
+            for qa_set in qa_sets
+        ]
 
-    # Create a list of dictionaries containing the QA set IDs and their corresponding QA sets
-    set_ids = [
-        {
-            "set_id": qa_set.get("set_id", None),  # QA set ID
-            "qa_set": qa_set.get("qa_set", [])    # QA set data
-        }
-        for qa_set in qa_sets
-    ]
+        return set_ids, project["project_id"]
 
-    return set_ids
+    return metadata_cache.read_through(key_token, ("set_ids", project_identifier), load)
 
 def get_project_ids(key_token: str) -> list[dict]:
     """
@@ -608,25 +1130,31 @@ def get_project_ids(key_token: str) -> list[dict]:
     Returns:
         List[Dict]: A list of dictionaries containing the project IDs and their corresponding project data.
     """
-    # Find user data by key_token
-    user_data = mongo.db.qa_data.find_one({"key_token": key_token})
+    return metadata_cache.read_through(key_token, ("project_ids",), lambda: (load_project_ids(key_token), None))
 
-    if not user_data:
-        raise ValueError(f"No user found for: {key_token}")
+def load_project_ids(key_token: str) -> list[dict]:
+    ensure_migrated(key_token)
 
-    projects = user_data.get("projects", {})
+    projects = list(
+        mongo.db.projects.find({"key_token": key_token}, {"_id": 0, "project_id": 1, "project_name": 1}).sort("_id", 1)
+    )
 
     if not projects:
         raise ValueError(f"No projects found for user: {key_token}")
 
+    # The QA sets of every project in one aggregation, instead of one query per project
+    qa_sets_by_project = {}
+    for qa_set in get_qa_sets(key_token, include_scores=True):
+        qa_sets_by_project.setdefault(qa_set.pop("project_id"), []).append(qa_set)
+
     # Create a list of dictionaries containing the project IDs and their corresponding project data
     project_ids = [
         {
-            "project_id": project_id,  # Project ID
+            "project_id": project["project_id"],  # Project ID
             "project_name": project.get("project_name", "-"),  # Project name
-            "qa_sets": project.get("qa_sets", [])  # QA sets for the project
+            "qa_sets": qa_sets_by_project.get(project["project_id"], [])  # QA sets for the project
         }
-        for project_id, project in projects.items()
+        for project in projects
     ]
 
     return project_ids
@@ -642,30 +1170,11 @@ def get_specific_project_details(key_token: str, project_identifier: str) -> dic
     Returns:
         Dict: A dictionary containing the project details.
     """
-    # Find user data by key_token
-    user_data = mongo.db.qa_data.find_one({"key_token": key_token})
-
-    if not user_data:  
-        raise ValueError(f"No user found for: {key_token}")
-
-    projects = user_data.get("projects", {})
-
-    if not projects:
-        raise ValueError(f"No projects found for user: {key_token}")
-
-    # Identify the correct project
-    project_key = None
-    for proj_id, project in projects.items():
-        if proj_id == project_identifier or project.get("project_name") == project_identifier:
-            project_key = proj_id
-            break
+    def load() -> tuple:
+        project = find_project(key_token, project_identifier)
+        return get_project_details(project), project["project_id"]
 
-    if not project_key:
-        raise ValueError(f"Project '{project_identifier}' not found.")
-
-    project = projects[project_key]
-
-    return project
+    return metadata_cache.read_through(key_token, ("project_details", project_identifier), load)
 
 def create_project(key_token: str, project_name: str) -> dict:
     """
@@ -678,49 +1187,50 @@ def create_project(key_token: str, project_name: str) -> dict:
     Returns:
         dict: A dictionary containing the created project data.
     """
-    # Retrieve user data from MongoDB
-    user_data = mongo.db.qa_data.find_one({"key_token": key_token})
-    
-    if not user_data:
-        raise ValueError(f"No user found for: {key_token}")
+    ensure_migrated(key_token)
 
-    # Maximum number of projects allowed
-    if len(user_data.get("projects", {})) >= MAX_PROJECTS_ALLOWED:
+    # Check for duplicate project names, with the unique name index
+    if mongo.db.projects.find_one({"key_token": key_token, "project_name": project_name}, {"_id": 1}):
+        raise ValueError(f"A project with the name '{project_name}' already exists.")
+
+    # Maximum number of projects allowed, counted with a conditional increment so
+    # concurrent requests cannot exceed it
+    result = mongo.db.qa_data.update_one(
+        {"key_token": key_token, "$or": [
+            {"project_count": {"$lt": MAX_PROJECTS_ALLOWED}}, {"project_count": {"$exists": False}}
+        ]},
+        {"$inc": {"project_count": 1}}
+    )
+    if result.modified_count == 0:
         raise ValueError("You have reached the maximum number of projects.")
-    
-    # Initialize the "projects" field if it doesn't exist
-    if "projects" not in user_data:
-        user_data["projects"] = {}
 
-    # Check for duplicate project names
-    existing_project_names = {proj["project_name"] for proj in user_data["projects"].values()}
-    
-    if project_name in existing_project_names:
-        raise ValueError(f"A project with the name '{project_name}' already exists.")
+    # IDs found taken, the unique keys catch an ID or name taken by a concurrent request
+    existing_project_ids = set()
 
-    # Extract existing project IDs
-    existing_project_ids = set(user_data["projects"].keys())
+    while True:
+        # Generate a unique 4-digit project ID
+        project_id = generate_unique_project_id(existing_project_ids)
+
+        try:
+            mongo.db.projects.insert_one({
+                "key_token": key_token,
+                "project_id": project_id,
+                "project_name": project_name,
+            })
+            break
+        except DuplicateKeyError as e:
+            if "project_name" in (e.details or {}).get("keyPattern", {}):
+                mongo.db.qa_data.update_one({"key_token": key_token}, {"$inc": {"project_count": -1}})
+                raise ValueError(f"A project with the name '{project_name}' already exists.")
+            existing_project_ids.add(project_id)
 
-    # Generate a unique 4-digit project ID
-    project_id = generate_unique_project_id(existing_project_ids)
+    metadata_cache.invalidate_project(key_token, project_id)
 
-    # Create the new project
-    new_project = {
+    return {
         f"{project_id}" : {
             "project_name" : project_name
         }
     }
-    
-    # Append the new project
-    user_data["projects"].update(new_project)
-
-    # Save to the database (only updating the projects field)
-    mongo.db.qa_data.update_one(
-        {"key_token": key_token},
-        {"$set": {"projects": user_data["projects"]}}
-    )
-
-    return new_project
 
 def delete_project(key_token: str, project_id: str) -> None:
     """
@@ -733,26 +1243,19 @@ def delete_project(key_token: str, project_id: str) -> None:
     Raises:
         ValueError: If the user or project is not found.
     """
-    # Find user data
-    user_data = mongo.db.qa_data.find_one({"key_token": key_token})
-
-    if not user_data:
-        raise ValueError(f"No user found for: {key_token}")
+    ensure_migrated(key_token)
 
-    # Find the project to delete
-    project_to_delete = next((proj for proj_id, proj in user_data["projects"].items() if proj_id == project_id), None)
+    result = mongo.db.projects.delete_one({"key_token": key_token, "project_id": project_id})
 
-    if not project_to_delete:
+    if result.deleted_count == 0:
         raise ValueError(f"Project with ID {project_id} not found.")
 
-    # Delete the project
-    del user_data["projects"][project_id]
+    mongo.db.qa_data.update_one({"key_token": key_token}, {"$inc": {"project_count": -1}})
 
-    # Save to the database (only updating the projects field)
-    mongo.db.qa_data.update_one(
-        {"key_token": key_token},
-        {"$set": {"projects": user_data["projects"]}}
-    )
+    # Delete the QA sets of the project, with their question-answers and scores
+    for collection in (mongo.db.qa_sets, mongo.db.qa_items, mongo.db.scores):
+        collection.delete_many({"key_token": key_token, "project_id": project_id})
+    metadata_cache.invalidate_project(key_token, project_id)
 
 def update_project_name(key_token: str, project_id: str, project_name: str) -> None:
     """
@@ -766,26 +1269,54 @@ def update_project_name(key_token: str, project_id: str, project_name: str) -> N
     Raises:
         ValueError: If the user or project is not found.
     """
-    # Find user data
-    user_data = mongo.db.qa_data.find_one({"key_token": key_token})
+    ensure_migrated(key_token)
 
-    if not user_data:  
-        raise ValueError(f"No user found for: {key_token}")
+    try:
+        result = mongo.db.projects.update_one(
+            {"key_token": key_token, "project_id": project_id},
+            {"$set": {"project_name": project_name}}
+        )
+    except DuplicateKeyError:
+        raise ValueError(f"A project with the name '{project_name}' already exists.")
+
+    if result.matched_count == 0:
+        raise ValueError(f"Project with ID {project_id} not found.")
+
+    metadata_cache.invalidate_project(key_token, project_id)
+
+def update_project_judge_profile(key_token: str, project_id: str, judge_profile: str) -> None:
+    """
+    Select the judge profile used to score the QA sets of a project.
+
+    Args:
+        key_token (str): User identifier.
+        project_id (str): ID of the project to update.
+        judge_profile (str): Name of the judge profile.
 
-    # Find the project to update
-    project_to_update = next((proj for proj_id, proj in user_data["projects"].items() if proj_id == project_id), None)
+    Raises:
+        ValueError: If the user, project or judge profile is not found.
+    """
+    # Raises if the profile does not exist
+    profile = get_profile(judge_profile)
+
+    ensure_migrated(key_token)
 
-    if not project_to_update:
+    result = mongo.db.projects.update_one(
+        {"key_token": key_token, "project_id": project_id},
+        {"$set": {"judge_profile": profile.name}}
+    )
+
+    if result.matched_count == 0:
         raise ValueError(f"Project with ID {project_id} not found.")
 
-    # Update the project name
-    project_to_update["project_name"] = project_name
+    metadata_cache.invalidate_project(key_token, project_id)
 
-    # Save to the database (only updating the projects field)
-    mongo.db.qa_data.update_one(
-        {"key_token": key_token},
-        {"$set": {"projects": user_data["projects"]}}
+    # Key facts of the baseline are cached per profile
+    baseline_set = mongo.db.qa_sets.find_one(
+        {"key_token": key_token, "project_id": project_id, "baseline": True}, {"set_id": 1}
     )
+    if baseline_set:
+        start_key_facts_extraction(key_token, project_id, baseline_set["set_id"])
 
 def delete_qa_set(key_token: str, project_identifier: str, set_id: int) -> None:
     """
@@ -799,36 +1330,33 @@ def delete_qa_set(key_token: str, project_identifier: str, set_id: int) -> None:
     Raises:
         ValueError: If the user, project, or QA set is not found, or if the set is a baseline.
     """
-    # Fetch user data
-    user_data = mongo.db.qa_data.find_one({"key_token": key_token})
-    if not user_data:
-        print("No user data found for key_token:", key_token)
-        raise ValueError(f"User not found!")
-
-    # Fetch project data
-    project_to_update = user_data.get("projects", {}).get(project_identifier)
-    if not project_to_update:
-        raise ValueError(f"Project '{project_identifier}' not found for user.")
-
-    # Find the QA set
-    for qa_set in project_to_update["qa_sets"]:
-        if qa_set["set_id"] == set_id:
-            if qa_set.get("baseline", False):
-                raise ValueError(f"Baseline QA set cannot be deleted.")
-            
-            # Remove the QA set
-            project_to_update["qa_sets"] = [
-                s for s in project_to_update["qa_sets"] if s["set_id"] != set_id
-            ]
-
-            # Update the database only if deletion occurs
-            mongo.db.qa_data.update_one(
-                {"key_token": key_token},
-                {"$set": {"projects": user_data["projects"]}}
-            )
-            return
+    ensure_migrated(key_token)
+
+    set_key = get_set_key(key_token, project_identifier, set_id)
+
+    # Remove the QA set unless it is the baseline, checked by the same write
+    result = mongo.db.qa_sets.delete_one({**set_key, "baseline": {"$ne": True}})
+
+    if result.deleted_count == 0:
+        # Find out why nothing was deleted
+        if not mongo.db.projects.find_one({"key_token": key_token, "project_id": project_identifier}, {"_id": 1}):
+            raise ValueError(f"Project '{project_identifier}' not found for user.")
 
-    raise ValueError(f"QA set with ID {set_id} not found in project '{project_identifier}'.")
+        if mongo.db.qa_sets.find_one(set_key, {"_id": 1}):
+            raise ValueError(f"Baseline QA set cannot be deleted.")
+
+        raise ValueError(f"QA set with ID {set_id} not found in project '{project_identifier}'.")
+
+    # Only the request that deleted the set uncounts it
+    mongo.db.projects.update_one(
+        {"key_token": key_token, "project_id": project_identifier, "qa_set_count": {"$gt": 0}},
+        {"$inc": {"qa_set_count": -1}}
+    )
+
+    # Remove its question-answers and scores
+    mongo.db.qa_items.delete_many(set_key)
+    mongo.db.scores.delete_many(set_key)
+    metadata_cache.invalidate_project(key_token, project_identifier)
 
 def save_qa_scores(key_token: str, set_id: int, project_identifier: str, qa_scores: dict) -> None:
     """Save the QA scores for a given set in a project for a specific user.
@@ -838,37 +1366,38 @@ def save_qa_scores(key_token: str, set_id: int, project_identifier: str, qa_scor
         set_id (int): ID of the QA set to save scores for.
         project_identifier (str): Either the project ID or project name.
         qa_scores (dict): A dictionary of scores for the QA set. The keys are the question IDs and the values are the scores.
+            Questions with the "failed" status, e.g. from /compare-qna-sets, are not saved.
 
     Raises:
         ValueError: If the user, project or QA set is not found.
     """
-    # Fetch user data
-    user_data = mongo.db.qa_data.find_one({"key_token": key_token})
-    if not user_data:
-        raise ValueError(f"No user data found for key_token: {key_token}")
+    ensure_migrated(key_token)
 
-    # Check if the project exists for the user
-    project_data = user_data.get("projects", {}).get(project_identifier)
-    if not project_data:
-        raise ValueError(f"Project '{project_identifier}' not found for user.")
+    qa_scores = {
+        question_id: score_data for question_id, score_data in qa_scores.items()
+        if not (isinstance(score_data, dict) and score_data.get("status") == "failed")
+    }
 
-    # Get the QA sets list
-    qa_sets_list = project_data.get("qa_sets", [])
-    
-    # Locate the specific QA set by its set_id
-    for qa_set in qa_sets_list:
-        if qa_set.get("set_id") == set_id:
-            # Update the QA set with the scores
-            qa_set["scores"] = qa_scores
-            break
-    else:
+    set_key = get_set_key(key_token, project_identifier, set_id)
+
+    # Locate the specific QA set by its set_id, sets only exist in existing projects
+    if not mongo.db.qa_sets.find_one(set_key, {"_id": 1}):
+        if not mongo.db.projects.find_one({"key_token": key_token, "project_id": project_identifier}, {"_id": 1}):
+            raise ValueError(f"Project '{project_identifier}' not found for user.")
         raise ValueError(f"Set does not exist in this project.")
-    
-    # Save updated QA sets back to the database
-    mongo.db.qa_data.update_one(
-        {"key_token": key_token},
-        {"$set": {f"projects.{project_identifier}.qa_sets": qa_sets_list}}
-    )
+
+    # Replace the scores of the set in place, one upsert per question in a single round trip
+    if qa_scores:
+        mongo.db.scores.bulk_write([
+            ReplaceOne(
+                {**set_key, "question_id": question_id},
+                {**set_key, "question_id": question_id, "score_data": score_data},
+                upsert=True
+            )
+            for question_id, score_data in qa_scores.items()
+        ], ordered=False)
+    mongo.db.scores.delete_many({**set_key, "question_id": {"$nin": list(qa_scores)}})
+    metadata_cache.invalidate_project(key_token, project_identifier)
 
 def get_set_scores(key_token: str, set_id: int, project_id: str) -> dict:
     """
@@ -885,22 +1414,19 @@ def get_set_scores(key_token: str, set_id: int, project_id: str) -> dict:
     Raises:
         ValueError: If the user, project, or QA set is not found.
     """
-    # Fetch user data from the database using the key_token
-    user_data = mongo.db.qa_data.find_one({"key_token": key_token})
-    if not user_data:
-        raise ValueError(f"No user data found for key_token: {key_token}")
-
-    # Retrieve project data for the given project_id
-    project_data = user_data.get("projects", {}).get(project_id)
-    if not project_data:
-        raise ValueError(f"Project '{project_id}' not found for user.")
-
-    # Iterate over QA sets within the project to find the specified set_id
-    qa_sets_data = project_data.get("qa_sets", [])
-    for qa_set in qa_sets_data:
-        if qa_set.get("set_id", 0) == set_id:
-            # Return the scores if the QA set is found
-            return qa_set.get("scores", {})
-
-    # Raise an error if no scores data is found for the given set_id
-    raise ValueError("No previous scores data found.")
+    ensure_migrated(key_token)
+
+    qa_sets = get_qa_sets(
+        key_token, project_id, match={"set_id": set_id},
+        set_fields=(), include_items=False, include_scores=True
+    )
+
+    if not qa_sets:
+        # Only look the project up to tell which one is missing
+        if not mongo.db.projects.find_one({"key_token": key_token, "project_id": project_id}, {"_id": 1}):
+            raise ValueError(f"Project '{project_id}' not found for user.")
+
+        # Raise an error if the QA set is not found
+        raise ValueError("No previous scores data found.")
+
+    return qa_sets[0].get("scores", {})
@@ -0,0 +1,334 @@
+import datetime
+import uuid
+
+from pymongo import ReturnDocument
+
+from app import mongo
+from .db_utils import update_usage
+from .utils import get_charged_scores, get_token_usage
+from .constants import (
+    PRIORITY_CLASSES,
+    DURABLE_QUEUE_LEASE_SECONDS,
+    DURABLE_QUEUE_MAX_ATTEMPTS,
+    DURABLE_QUEUE_RETRY_BACKOFF_SECONDS,
+)
+
+def get_utc_now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+class DurableQueue:
+    """
+    Work queue stored in Mongo, shared by any number of worker processes.
+
+    A job is a submission of queries, stored in the `jobs` collection, with one document
+    per query in the `work_queue` collection:
+        {
+            "job_id": "...", "key_token": "...", "query_id": "q1", "query_data": {...},
+            "priority_rank": 1, "status": "queued" | "leased" | "done" | "failed" | "cancelled",
+            "attempts": 0, "lease_owner": None, "lease_expires_at": None, "available_at": ...,
+            "result": None, "error": None
+        }
+
+    Workers claim items with a lease they extend by heartbeating. An item whose lease
+    expired, e.g. because its worker died, is claimable again. Failed items are retried
+    with backoff until they reach `max_attempts`.
+
+    Args:
+        lease_seconds (int): Seconds a claimed item stays leased without heartbeat.
+        max_attempts (int): Max number of times an item is claimed.
+        retry_backoff_seconds (int): Delay before the first retry, doubled on every attempt.
+    """
+    def __init__(self, lease_seconds: int = DURABLE_QUEUE_LEASE_SECONDS, max_attempts: int = DURABLE_QUEUE_MAX_ATTEMPTS, retry_backoff_seconds: int = DURABLE_QUEUE_RETRY_BACKOFF_SECONDS):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_backoff_seconds = retry_backoff_seconds
+
+    def enqueue_job(self, key_token: str, queries_data: dict, summary_accepted: bool = True, judge_profile: str = None, priority: str = "bulk", reserved_tokens: int = 0) -> str:
+        """
+        Store a job and queue its queries.
+
+        Args:
+            key_token (str): The tenant submitting the queries.
+            queries_data (dict): The queries keyed by query ID.
+            summary_accepted (bool): Whether summaries are accepted.
+            judge_profile (str, optional): Name of the judge profile to score with.
+            priority (str): One of PRIORITY_CLASSES.
+            reserved_tokens (int): Tokens reserved for the job, adjusted to its usage once it finishes.
+
+        Returns:
+            str: The job ID.
+
+        Raises:
+            ValueError: If the priority class does not exist.
+        """
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Priority must be one of: {', '.join(PRIORITY_CLASSES)}")
+
+        job_id = str(uuid.uuid4())
+        now = get_utc_now()
+
+        mongo.db.jobs.insert_one({
+            "job_id": job_id,
+            "key_token": key_token,
+            "status": "running",
+            "total": len(queries_data),
+            "priority": priority,
+            "judge_profile": judge_profile,
+            "reserved_tokens": reserved_tokens,
+            "created_at": now,
+            "finished_at": None,
+        })
+
+        items = [
+            {
+                "job_id": job_id,
+                "key_token": key_token,
+                "query_id": query_id,
+                "query_data": {**query, "summary_accepted": summary_accepted, "judge_profile": judge_profile},
+                "priority_rank": PRIORITY_CLASSES.index(priority),
+                "status": "queued",
+                "attempts": 0,
+                "lease_owner": None,
+                "lease_expires_at": None,
+                "available_at": now,
+                "created_at": now,
+                "result": None,
+                "error": None,
+            }
+            for query_id, query in queries_data.items()
+        ]
+        if items:
+            mongo.db.work_queue.insert_many(items)
+
+        return job_id
+
+    def claim(self, worker_id: str, n: int = 1) -> list[dict]:
+        """
+        Lease up to n items to a worker, highest priority class first, oldest first.
+
+        Items whose lease expired are claimed again, unless they used up their attempts.
+
+        Args:
+            worker_id (str): The claiming worker.
+            n (int): Max number of items.
+
+        Returns:
+            list[dict]: The leased items.
+        """
+        items = []
+        for _ in range(n):
+            now = get_utc_now()
+            item = mongo.db.work_queue.find_one_and_update(
+                {
+                    "$or": [
+                        {"status": "queued", "available_at": {"$lte": now}},
+                        {"status": "leased", "lease_expires_at": {"$lt": now}},
+                    ],
+                    "attempts": {"$lt": self.max_attempts},
+                },
+                {
+                    "$set": {
+                        "status": "leased",
+                        "lease_owner": worker_id,
+                        "lease_expires_at": now + datetime.timedelta(seconds=self.lease_seconds),
+                    },
+                    "$inc": {"attempts": 1},
+                },
+                sort=[("priority_rank", 1), ("available_at", 1)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if not item:
+                break
+            items.append(item)
+
+        return items
+
+    def heartbeat(self, worker_id: str, item_ids: list) -> set:
+        """
+        Extend the leases of the items a worker is still processing.
+
+        Returns:
+            set: The IDs of the items still leased to the worker. The others were
+            cancelled or leased to another worker since, their processing can be aborted.
+        """
+        query = {"_id": {"$in": item_ids}, "status": "leased", "lease_owner": worker_id}
+        mongo.db.work_queue.update_many(
+            query,
+            {"$set": {"lease_expires_at": get_utc_now() + datetime.timedelta(seconds=self.lease_seconds)}}
+        )
+        return {item["_id"] for item in mongo.db.work_queue.find(query, {"_id": 1})}
+
+    def complete(self, worker_id: str, item: dict, result: dict) -> bool:
+        """
+        Store the result of an item, only if it is still leased to the worker.
+
+        Returns:
+            bool: Whether the result was stored.
+        """
+        update_result = mongo.db.work_queue.update_one(
+            {"_id": item["_id"], "status": "leased", "lease_owner": worker_id},
+            {"$set": {"status": "done", "result": result, "error": None, "lease_expires_at": None, "finished_at": get_utc_now()}}
+        )
+        return update_result.modified_count == 1
+
+    def fail(self, worker_id: str, item: dict, error: str) -> bool:
+        """
+        Record a failed attempt of an item, queued again with backoff unless it used up its attempts.
+
+        Returns:
+            bool: Whether the item will be retried.
+        """
+        retry = item["attempts"] < self.max_attempts
+        update = {"error": error, "lease_owner": None, "lease_expires_at": None}
+
+        if retry:
+            backoff = self.retry_backoff_seconds * 2 ** (item["attempts"] - 1)
+            update.update({"status": "queued", "available_at": get_utc_now() + datetime.timedelta(seconds=backoff)})
+        else:
+            update.update({"status": "failed", "finished_at": get_utc_now()})
+
+        mongo.db.work_queue.update_one(
+            {"_id": item["_id"], "status": "leased", "lease_owner": worker_id},
+            {"$set": update}
+        )
+        return retry
+
+    def fail_exhausted_items(self) -> set:
+        """
+        Fail the items whose lease expired after their last attempt.
+
+        Returns:
+            set: The IDs of the jobs of the failed items.
+        """
+        query = {"status": "leased", "lease_expires_at": {"$lt": get_utc_now()}, "attempts": {"$gte": self.max_attempts}}
+        job_ids = set(mongo.db.work_queue.distinct("job_id", query))
+        if job_ids:
+            mongo.db.work_queue.update_many(
+                query,
+                {"$set": {"status": "failed", "error": "Lease expired on the last attempt.", "finished_at": get_utc_now()}}
+            )
+        return job_ids
+
+    def finish_job_if_done(self, job_id: str) -> dict:
+        """
+        Mark a job finished once none of its items is queued or leased.
+
+        Only one caller finishes a job, e.g. to record its usage once.
+
+        Returns:
+            dict: The finished job, None if the job is not done or was finished by another caller.
+        """
+        remaining = mongo.db.work_queue.count_documents(
+            {"job_id": job_id, "status": {"$in": ["queued", "leased"]}}, limit=1
+        )
+        if remaining:
+            return None
+
+        if mongo.db.work_queue.count_documents({"job_id": job_id, "status": "cancelled"}, limit=1):
+            status = "cancelled"
+        elif mongo.db.work_queue.count_documents({"job_id": job_id, "status": "failed"}, limit=1):
+            status = "failed"
+        else:
+            status = "done"
+
+        return mongo.db.jobs.find_one_and_update(
+            {"job_id": job_id, "status": "running"},
+            {"$set": {"status": status, "finished_at": get_utc_now()}},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def record_job_usage(self, job: dict) -> None:
+        """Record the usage of a finished job, charging only the items scored by the LLM."""
+        done_items = self.get_job_items(job["job_id"], status="done")
+        scores_data = {"scores": {item["query_id"]: item["result"] for item in done_items}}
+        input_tokens, output_tokens = get_token_usage(get_charged_scores(scores_data))
+        processing_time = (job["finished_at"] - job["created_at"]).total_seconds()
+
+        update_usage(
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            processing_time=processing_time,
+            avg_queue_time=round(processing_time / max(len(done_items), 1), 2),
+            key_token=job["key_token"],
+            reserved_tokens=job.get("reserved_tokens", 0),
+        )
+        print(f"Job '{job['job_id']}' finished with status '{job['status']}'.")
+
+    def cancel_job(self, key_token: str, job_id: str) -> int:
+        """
+        Cancel the items of a job not scored yet. Workers scoring one of them abort it
+        at their next heartbeat and their result is discarded.
+
+        Args:
+            key_token (str): The tenant owning the job.
+            job_id (str): The job ID.
+
+        Returns:
+            int: The number of cancelled items.
+
+        Raises:
+            ValueError: If the job does not exist.
+        """
+        if not mongo.db.jobs.find_one({"job_id": job_id, "key_token": key_token}, {"_id": 1}):
+            raise ValueError(f"Job '{job_id}' not found.")
+
+        result = mongo.db.work_queue.update_many(
+            {"job_id": job_id, "status": {"$in": ["queued", "leased"]}},
+            {"$set": {"status": "cancelled", "lease_owner": None, "lease_expires_at": None, "finished_at": get_utc_now()}}
+        )
+
+        job = self.finish_job_if_done(job_id)
+        if job:
+            self.record_job_usage(job)
+
+        return result.modified_count
+
+    def get_job_items(self, job_id: str, status: str = None) -> list[dict]:
+        """Get the items of a job, optionally only those with a status."""
+        query = {"job_id": job_id}
+        if status:
+            query["status"] = status
+        return list(mongo.db.work_queue.find(query))
+
+    def get_job_status(self, key_token: str, job_id: str) -> dict:
+        """
+        Get the progress and results of a job.
+
+        Args:
+            key_token (str): The tenant owning the job.
+            job_id (str): The job ID.
+
+        Returns:
+            dict: The job status (running, done, failed or cancelled), item counts by status,
+            scores of done items and errors of failed items.
+
+        Raises:
+            ValueError: If the job does not exist.
+        """
+        job = mongo.db.jobs.find_one({"job_id": job_id, "key_token": key_token}, {"_id": 0})
+        if not job:
+            raise ValueError(f"Job '{job_id}' not found.")
+
+        counts = {"queued": 0, "leased": 0, "done": 0, "failed": 0, "cancelled": 0}
+        scores = {}
+        errors = {}
+        for item in mongo.db.work_queue.find(
+            {"job_id": job_id}, {"query_id": 1, "status": 1, "result": 1, "error": 1}
+        ):
+            counts[item["status"]] += 1
+            if item["status"] == "done":
+                scores[item["query_id"]] = item["result"]
+            elif item["status"] == "failed":
+                errors[item["query_id"]] = item["error"]
+
+        return {
+            "job_id": job_id,
+            "status": job["status"],
+            "total": job["total"],
+            "counts": counts,
+            "scores": scores,
+            "errors": errors,
+        }
+
+
+durable_queue = DurableQueue()
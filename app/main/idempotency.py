@@ -0,0 +1,101 @@
+import datetime
+import hashlib
+import json
+import time
+
+from pymongo.errors import DuplicateKeyError
+
+from app import mongo
+from .constants import IDEMPOTENCY_MAX_WAIT_SECONDS, IDEMPOTENCY_UNHASHED_QUERY_FIELDS
+
+def get_request_hash(data: dict) -> str:
+    """Hash of a request body, to detect a key reused for a different request. Server derived query fields are left out."""
+    queries_data = data.get("queries_data")
+    if isinstance(queries_data, dict):
+        data = {**data, "queries_data": {
+            query_id: {field: value for field, value in query.items() if field not in IDEMPOTENCY_UNHASHED_QUERY_FIELDS}
+            if isinstance(query, dict) else query
+            for query_id, query in queries_data.items()
+        }}
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+def get_key_filter(key_token: str, endpoint: str, idempotency_key: str) -> dict:
+    return {"key_token": key_token, "endpoint": endpoint, "idempotency_key": idempotency_key}
+
+def claim_idempotency_key(key_token: str, endpoint: str, idempotency_key: str, request_hash: str) -> dict:
+    """
+    Claim an idempotency key for a new request.
+
+    Args:
+        key_token (str): The tenant making the request.
+        endpoint (str): The endpoint of the request.
+        idempotency_key (str): The Idempotency-Key header of the request.
+        request_hash (str): Hash of the request body.
+
+    Returns:
+        dict: None if the key was claimed by this request, the record of the original
+        request otherwise, e.g. {"status": "done", "response": {...}, "status_code": 200}.
+    """
+    try:
+        mongo.db.idempotency_keys.insert_one({
+            **get_key_filter(key_token, endpoint, idempotency_key),
+            "request_hash": request_hash,
+            "status": "in_progress",
+            "run_id": None,
+            "job_id": None,
+            "response": None,
+            "status_code": None,
+            "created_at": datetime.datetime.now(datetime.timezone.utc),
+        })
+        return None
+    except DuplicateKeyError:
+        return mongo.db.idempotency_keys.find_one(get_key_filter(key_token, endpoint, idempotency_key), {"_id": 0})
+
+def attach_run(key_token: str, endpoint: str, idempotency_key: str, run_id: str) -> None:
+    """Attach the run of a request to its key, repeat submissions wait for or resume it."""
+    mongo.db.idempotency_keys.update_one(
+        get_key_filter(key_token, endpoint, idempotency_key),
+        {"$set": {"run_id": run_id}}
+    )
+
+def save_idempotent_response(key_token: str, endpoint: str, idempotency_key: str, response: dict, status_code: int, run_id: str = None) -> None:
+    """
+    Store the response of a request, returned to repeat submissions. Error responses
+    mark the key failed, repeat submissions then resume the attached run.
+    """
+    fields = {
+        "status": "done" if status_code < 400 else "failed",
+        "response": response,
+        "status_code": status_code,
+    }
+    if run_id:
+        fields["run_id"] = run_id
+
+    mongo.db.idempotency_keys.update_one(get_key_filter(key_token, endpoint, idempotency_key), {"$set": fields})
+
+def release_idempotency_key(key_token: str, endpoint: str, idempotency_key: str) -> None:
+    """Remove a key whose request did no work, e.g. rejected by rate limits, so it can be retried."""
+    mongo.db.idempotency_keys.delete_one(get_key_filter(key_token, endpoint, idempotency_key))
+
+def wait_for_original_request(record: dict, max_wait: float = IDEMPOTENCY_MAX_WAIT_SECONDS) -> dict:
+    """
+    Wait for the original request of a key to finish, as long as its run is active.
+
+    Returns:
+        dict: The latest record of the key, still "in_progress" if the original request
+        did not finish in time or its run was abandoned, e.g. by a crashed server.
+    """
+    key_filter = get_key_filter(record["key_token"], record["endpoint"], record["idempotency_key"])
+    started_at = time.time()
+
+    while record["status"] == "in_progress" and time.time() - started_at < max_wait:
+        if record.get("run_id"):
+            run = mongo.db.runs.find_one({"run_id": record["run_id"]}, {"active_until": 1})
+            active_until = run["active_until"].replace(tzinfo=datetime.timezone.utc) if run else None
+            if not active_until or active_until < datetime.datetime.now(datetime.timezone.utc):
+                break
+
+        time.sleep(1)
+        record = mongo.db.idempotency_keys.find_one(key_filter, {"_id": 0}) or record
+
+    return record
@@ -0,0 +1,164 @@
+"""
+Indexes of every collection, created and verified once when the app starts.
+
+Each entry is the keys of an index and its options, e.g. `unique` or `expireAfterSeconds`
+for the collections whose documents Mongo removes once expired.
+"""
+import datetime
+
+from pymongo.errors import OperationFailure
+
+from app import mongo
+from .constants import IDEMPOTENCY_KEY_TTL_SECONDS
+
+INDEXES = {
+    "credits": [
+        ([("key_token", 1)], {"unique": True}),
+        ([("email", 1)], {"unique": True, "sparse": True}),
+    ],
+    "qa_data": [
+        ([("key_token", 1)], {"unique": True}),
+        ([("email", 1)], {"unique": True, "sparse": True}),
+        ([("schema_version", 1)], {}),
+    ],
+    "projects": [
+        ([("key_token", 1), ("project_id", 1)], {"unique": True}),
+        ([("key_token", 1), ("project_name", 1)], {"unique": True}),
+    ],
+    "qa_sets": [
+        ([("key_token", 1), ("project_id", 1), ("set_id", 1)], {"unique": True}),
+    ],
+    "qa_items": [
+        ([("key_token", 1), ("project_id", 1), ("set_id", 1), ("position", 1)], {"unique": True}),
+    ],
+    "scores": [
+        ([("key_token", 1), ("project_id", 1), ("set_id", 1), ("question_id", 1)], {"unique": True}),
+    ],
+    "runs": [
+        ([("run_id", 1)], {"unique": True}),
+        ([("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ],
+    "run_items": [
+        ([("run_id", 1), ("query_id", 1)], {"unique": True}),
+        ([("run_id", 1), ("status", 1)], {}),
+        ([("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ],
+    "work_queue": [
+        ([("status", 1), ("priority_rank", 1), ("available_at", 1)], {}),
+        ([("status", 1), ("lease_expires_at", 1)], {}),
+        ([("job_id", 1), ("query_id", 1)], {"unique": True}),
+    ],
+    "jobs": [
+        ([("job_id", 1)], {"unique": True}),
+    ],
+    "idempotency_keys": [
+        ([("key_token", 1), ("endpoint", 1), ("idempotency_key", 1)], {"unique": True}),
+        ([("created_at", 1)], {"expireAfterSeconds": IDEMPOTENCY_KEY_TTL_SECONDS}),
+    ],
+    "cache_versions": [
+        ([("key_token", 1)], {"unique": True}),
+    ],
+    "usage": [
+        ([("key_token", 1), ("granularity", 1), ("bucket_start", 1)], {"unique": True}),
+    ],
+    "rate_limits": [
+        ([("key_token", 1), ("window_start", 1)], {"unique": True}),
+        ([("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ],
+}
+
+def get_query_plans() -> dict:
+    """
+    Queries of the hot paths, whose plans must use an index, keyed by label.
+
+    Returns:
+        dict: (collection, filter) keyed by label.
+    """
+    return {
+        "project by ID or name": (
+            "projects",
+            {"key_token": "", "$or": [{"project_id": ""}, {"project_name": ""}]},
+        ),
+        "credits by key token": ("credits", {"key_token": ""}),
+        "credits by email": ("credits", {"email": ""}),
+        "tenant by key token": ("qa_data", {"key_token": ""}),
+        "QA set": ("qa_sets", {"key_token": "", "project_id": "", "set_id": 1}),
+        "baseline of a project": ("qa_sets", {"key_token": "", "project_id": "", "baseline": True}),
+        "question-answers of a set": ("qa_items", {"key_token": "", "project_id": "", "set_id": 1}),
+        "scores of a set": ("scores", {"key_token": "", "project_id": "", "set_id": 1}),
+        "usage of a date range": ("usage", {"key_token": "", "granularity": "hour", "bucket_start": {"$gte": datetime.datetime(2024, 1, 1)}}),
+    }
+
+def has_collection_scan(plan) -> bool:
+    """Whether a plan returned by explain(), or any of its input stages, scans the collection."""
+    if isinstance(plan, dict):
+        return plan.get("stage") == "COLLSCAN" or any(has_collection_scan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(has_collection_scan(value) for value in plan)
+    return False
+
+def check_query_plans() -> list[str]:
+    """
+    Explain the queries of the hot paths.
+
+    Returns:
+        list[str]: The labels of the queries whose winning plan scans a collection.
+    """
+    collection_scans = []
+    for label, (collection, query) in get_query_plans().items():
+        explanation = mongo.db[collection].find(query).explain()
+        if has_collection_scan(explanation["queryPlanner"]["winningPlan"]):
+            collection_scans.append(label)
+
+    return collection_scans
+
+def get_missing_indexes() -> list[str]:
+    """
+    Compare the indexes of the collections with INDEXES.
+
+    Returns:
+        list[str]: The indexes that do not exist, or exist with different options.
+    """
+    missing = []
+    for collection, indexes in INDEXES.items():
+        existing = {
+            tuple((field, int(direction)) for field, direction in index["key"]): index
+            for index in mongo.db[collection].index_information().values()
+        }
+
+        for keys, options in indexes:
+            index = existing.get(tuple(keys))
+            if not index or any(index.get(option) != value for option, value in options.items()):
+                missing.append(f"{collection} {keys} {options}")
+
+    return missing
+
+def bootstrap_indexes() -> bool:
+    """
+    Create the indexes of every collection, then verify they exist and the hot paths use them.
+
+    An index that cannot be created, e.g. because of duplicate key tokens or an existing
+    index with other options, is reported instead of stopping the app.
+
+    Returns:
+        bool: Whether every index exists and no hot path scans a collection.
+    """
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                mongo.db[collection].create_index(keys, **options)
+            except OperationFailure as e:
+                print(f"❌ Could not create index {keys} of '{collection}': {e}")
+
+    missing = get_missing_indexes()
+    for index in missing:
+        print(f"❌ Missing index: {index}")
+
+    collection_scans = check_query_plans()
+    for label in collection_scans:
+        print(f"❌ Query '{label}' scans its collection.")
+
+    if not missing and not collection_scans:
+        print("✅ Indexes verified.")
+
+    return not missing and not collection_scans
@@ -3,62 +3,279 @@ import json
 import requests
 from pprint import pprint
 import time
-from typing import List, Dict
+from typing import List, Dict, Callable
 import concurrent.futures
+import multiprocessing
 
 from .constants import (
-    LOCAL_HOST_URL,
-    MODEL_NAME,
+    REASONING_MODEL_PROFILES,
+    JUDGE_CONCURRENCY,
 )
 from .prompts import (
-    SYSTEM_PROMPT,
-    SUMMARY_CHECK_PROMPT
+    SUMMARY_CHECK_PROMPT,
+    MULTI_CANDIDATE_PROMPT,
+    KEY_FACTS_PROMPT,
+    KEY_FACTS_SCORE_PROMPT,
+    KEY_FACTS_PROMPT_VERSION,
+    SCORE_RESPONSE_SCHEMA,
+    SUMMARY_CHECK_RESPONSE_SCHEMA,
+    KEY_FACTS_RESPONSE_SCHEMA
 )
+from .cancellation import (
+    Cancelled,
+    CancellationToken,
+    init_process_cancel_flags,
+    set_current_item,
+    is_current_item_cancelled
+)
+from .backends import JudgeBackend, get_backend, get_backends, set_backends, has_in_process_backend
+from .utils import estimate_tokens
+from .profiles import JudgeProfile, get_profile
 from .queues import (
-        QueueManager
+        QueueManager,
+        ScoringBatch
 )
 
-def retrieve_response_from_endpoint(data: dict) -> dict:
+def retrieve_response_from_endpoint(data: dict, backend: JudgeBackend = None) -> dict:
     """
-    Sends a POST request to a local endpoint with the provided data.
+    Sends a chat request to the judge backend with the provided data.
 
     Args:
-        data (dict): The data to send in the POST request.
+        data (dict): The request data, containing the model, messages and optionally
+            the response format, decoding options and keep alive duration.
+        backend (JudgeBackend, optional): The backend to send the request to, defaults to the default backend.
 
     Returns:
-        dict: The JSON response from the server.
+        dict: The normalized response from the backend.
+            e.g. {"content": "...", "thinking": "", "prompt_tokens": 120, "completion_tokens": 40}
 
     Raises:
         RuntimeError: If there is an issue with the request or the response is not JSON.
     """
+    backend = backend or get_backend()
+
     try:
-        headers = {'Content-Type': 'application/json'}
+        return backend.chat(
+            model=data["model"],
+            messages=data["messages"],
+            response_format=data.get("format"),
+            options=data.get("options"),
+            keep_alive=data.get("keep_alive"),
+        )
 
-        print(f"\nSending request to {LOCAL_HOST_URL} with data: {data.keys()} and model: {MODEL_NAME}")
+    except RuntimeError:
+        raise
 
-        response = requests.post(LOCAL_HOST_URL, json=data, headers=headers)
-        response.raise_for_status()  # Raises HTTPError for bad responses (4xx or 5xx)
-        return response.json()      # Convert response to JSON
-    
-    except requests.exceptions.RequestException as e:
-        # Handle specific request-related exceptions
-        raise RuntimeError(f"Request failed: {e}") from e
-    
-    except ValueError as e:
-        # Handle JSON decoding errors
-        raise RuntimeError(f"Invalid JSON in response: {e}") from e
-    
     except Exception as e:
         # Handle other exceptions
         raise RuntimeError(f"An error occurred: {e}") from e
-    
-def check_if_summary(baseline: str, current: str):
+
+def add_token_usage(token_usage: dict, response: dict) -> dict:
+    """Add the prompt and completion tokens counted by the backend for a response to `token_usage`."""
+    token_usage["input"] = token_usage.get("input", 0) + response.get("prompt_tokens", 0)
+    token_usage["output"] = token_usage.get("output", 0) + response.get("completion_tokens", 0)
+    return token_usage
+
+def get_response_format(schema: dict, backend: JudgeBackend = None):
+    """
+    Get the response format to request from the backend.
+
+    Args:
+        schema (dict): The JSON schema of the expected response.
+        backend (JudgeBackend, optional): The backend the request is sent to.
+
+    Returns:
+        dict | str: The schema if the backend can constrain its output to it, otherwise "json".
+    """
+    if (backend or get_backend()).supports_json_schema:
+        return schema
+    return "json"
+
+def get_reasoning_profile(model_name: str) -> dict:
+    """
+    Get the reasoning profile of a model.
+
+    Args:
+        model_name (str): Name of the model, e.g. 'deepseek-r1:14b'.
+
+    Returns:
+        dict: The reasoning profile, or None if the model is not a reasoning model.
+    """
+    for model_prefix, profile in REASONING_MODEL_PROFILES.items():
+        if model_name.startswith(model_prefix):
+            return profile
+    return None
+
+def find_json_end(text: str) -> int:
+    """
+    Find the end of the first complete JSON object in the text.
+
+    Args:
+        text (str): The text to search.
+
+    Returns:
+        int: The index of the closing brace of the first JSON object, -1 if it is not complete yet.
+    """
+    depth = 0
+    in_string = False
+    escaped = False
+
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"' and depth > 0:
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}" and depth > 0:
+            depth -= 1
+            if depth == 0:
+                return index
+    return -1
+
+def strip_thinking(content: str) -> str:
+    """
+    Strip the <think></think> block from the content of a reasoning model.
+
+    Args:
+        content (str): The raw content streamed so far.
+
+    Returns:
+        str: The answer after the thinking, empty while the model is still thinking.
+    """
+    if "<think>" not in content:
+        return content
+    if "</think>" not in content:
+        return ""
+    return content.split("</think>", 1)[1]
+
+def stream_reasoning_response(data: dict, thinking_token_budget: int, max_answer_tokens: int, retry_without_thinking: bool = True, backend: JudgeBackend = None) -> dict:
+    """
+    Stream a chat response from a reasoning model, stripping its thinking.
+
+    The thinking is either streamed in the `thinking` field of a message or wrapped in
+    <think></think> tags in the content. Generation is stopped as soon as the answer
+    contains a complete JSON object, or when a token budget is exceeded.
+
+    Args:
+        data (dict): The data to send in the POST request.
+        thinking_token_budget (int): Max number of thinking tokens to read.
+        max_answer_tokens (int): Max number of answer tokens to read.
+        retry_without_thinking (bool): Ask again with thinking disabled when the thinking budget is exceeded.
+        backend (JudgeBackend, optional): The backend to stream from, defaults to the default backend.
+
+    Returns:
+        dict: The answer without the thinking and the token counts of the call.
+            e.g. {"content": "...", "thinking_tokens": 120, "answer_tokens": 40, "thinking_truncated": False,
+                  "prompt_tokens": 300, "completion_tokens": 160}
+            The backend only counts the tokens of a stream read to the end, the prompt of a stream
+            stopped early is estimated and its completion tokens are the chunks read.
+
+    Raises:
+        RuntimeError: If there is an issue with the request or the thinking budget is exceeded twice.
+        Cancelled: If the item being scored is cancelled while streaming.
+    """
+    backend = backend or get_backend()
+
+    raw_content = ""
+    thinking_tokens = 0
+    answer_tokens = 0
+    thinking_truncated = False
+    prompt_tokens = 0
+    completion_tokens = 0
+
+    stream = backend.stream_chat(
+        model=data["model"],
+        messages=data["messages"],
+        response_format=data.get("format"),
+        options=data.get("options"),
+        keep_alive=data.get("keep_alive"),
+        think=data.get("think"),
+    )
+
+    try:
+        for chunk in stream:
+            if is_current_item_cancelled():
+                raise Cancelled("Cancelled while streaming.")
+
+            prompt_tokens = chunk.get("prompt_tokens") or prompt_tokens
+            completion_tokens = chunk.get("completion_tokens") or completion_tokens
+
+            if chunk.get("thinking"):
+                thinking_tokens += 1
+            elif chunk.get("content"):
+                raw_content += chunk["content"]
+                is_thinking = "<think>" in raw_content and "</think>" not in raw_content
+                if is_thinking or chunk["content"].strip() == "</think>":
+                    thinking_tokens += 1
+                else:
+                    answer_tokens += 1
+
+            if find_json_end(strip_thinking(raw_content)) != -1:
+                # Final JSON is complete, stop generating
+                break
+
+            if thinking_tokens > thinking_token_budget:
+                thinking_truncated = True
+                break
+
+            if answer_tokens > max_answer_tokens or chunk.get("done"):
+                break
+    finally:
+        # Closing the stream aborts the generation on the backend
+        stream.close()
+
+    answer = strip_thinking(raw_content)
+
+    if not prompt_tokens:
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in data["messages"])
+    if not completion_tokens:
+        completion_tokens = thinking_tokens + answer_tokens
+
+    if thinking_truncated:
+        if not retry_without_thinking:
+            raise RuntimeError(f"Thinking token budget ({thinking_token_budget}) exceeded")
+
+        # Ask again without thinking, the budget has been spent
+        print(f"Thinking token budget ({thinking_token_budget}) exceeded, retrying without thinking.")
+        retry_response = stream_reasoning_response(
+            {**data, "think": False},
+            thinking_token_budget=thinking_token_budget,
+            max_answer_tokens=max_answer_tokens,
+            retry_without_thinking=False,
+            backend=backend,
+        )
+        answer = retry_response["content"]
+        answer_tokens = retry_response["answer_tokens"]
+        thinking_tokens += retry_response["thinking_tokens"]
+        prompt_tokens += retry_response["prompt_tokens"]
+        completion_tokens += retry_response["completion_tokens"]
+
+    print(f"Thinking tokens: {thinking_tokens}, Answer tokens: {answer_tokens}")
+
+    return {
+        "content": answer.strip(),
+        "thinking_tokens": thinking_tokens,
+        "answer_tokens": answer_tokens,
+        "thinking_truncated": thinking_truncated,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+    }
+
+def check_if_summary(baseline: str, current: str, profile: JudgeProfile = None, token_usage: dict = None):
     """
     Check if the summary is present in the current string.
 
     Args:
         baseline (str): The baseline string.
         current (str): The current string to check for the summary.
+        profile (JudgeProfile, optional): The judge profile to use, defaults to the default profile.
+        token_usage (dict, optional): The tokens of the call are added to it.
 
     Returns:
         bool: True if the current is a summary of the baseline or viceversa.
@@ -76,25 +293,33 @@ def check_if_summary(baseline: str, current: str):
         }
     ]  
 
+    profile = profile or get_profile()
+    backend = profile.get_backend()
+
     data = {
-        "model": MODEL_NAME,
+        "model": profile.model,
         "messages": messages,
         "stream": False,
+        "format": get_response_format(SUMMARY_CHECK_RESPONSE_SCHEMA, backend),
+        "options": profile.options,
         "keep_alive": "30m",
     }   
 
     try:
-        response = retrieve_response_from_endpoint(data)
+        response = retrieve_response_from_endpoint(data, backend)
     except Exception as e:
         print(f"Error in get_response_from_llm: {e}")
         # Add context to the exception
         raise Exception(f"Failed to get response from LLM: {e}") from e
+
+    if token_usage is not None:
+        add_token_usage(token_usage, response)
     
     try:
-        summary_data = json.loads(response.get("message", {}).get("content", ""))
-    except json.JSONDecodeError as e:
+        summary_data = extract_json(response.get("content", ""))
+    except Exception as e:
         print("Issue decoding JSON response:", e)
-        summary_data = response.get("message", {}).get("content", "")
+        summary_data = {}
  
     print("\nIs summary:")
     pprint(summary_data)
@@ -112,14 +337,17 @@ def extract_json(text):
            raise Exception(f"Invalid JSON in response: {e}") from e
     raise Exception("No JSON found in response")
 
-def get_score_from_llm(question: str, baseline: str, current: str) -> dict:
+def get_score_from_llm(question: str, baseline: str, current: str, baseline_facts: list = None, profile: JudgeProfile = None) -> dict:
     """
     Get the score from the LLM.
 
     Args:
         baseline (str): The baseline string to evaluate against.
         current (str): The current string to score against the baseline.
-        summary_accepted (bool): Whether the summary is accepted or not (not used).
+        baseline_facts (list, optional): Precomputed key facts of the baseline. When
+            provided, the current string is scored against these facts instead of
+            the full baseline text.
+        profile (JudgeProfile, optional): The judge profile to use, defaults to the default profile.
 
     Returns:
         str: The response/score from the LLM, containing the score as a string (e.g. '3').
@@ -128,9 +356,17 @@ def get_score_from_llm(question: str, baseline: str, current: str) -> dict:
         Exception: If the endpoint returns an error or response processing fails.
     """
 
-    user_message_str = f"question: {question}\nbaseline: {baseline}\ncurrent: {current}"
+    profile = profile or get_profile()
 
-    system_prompt = SYSTEM_PROMPT
+    if baseline_facts:
+        facts_str = "\n".join(f"- {fact}" for fact in baseline_facts)
+        user_message_str = f"question: {question}\nkey facts:\n{facts_str}\ncurrent: {current}"
+        system_prompt = KEY_FACTS_SCORE_PROMPT
+        prompt_version = KEY_FACTS_PROMPT_VERSION
+    else:
+        user_message_str = f"question: {question}\nbaseline: {baseline}\ncurrent: {current}"
+        system_prompt = profile.get_system_prompt()
+        prompt_version = profile.prompt_version
 
     messages = [
         {
@@ -143,16 +379,44 @@ def get_score_from_llm(question: str, baseline: str, current: str) -> dict:
         }
     ]
 
+    backend = profile.get_backend()
+
     data = {
-        "model": MODEL_NAME,
+        "model": profile.model,
         "messages": messages,
         "stream": False,
-        "keep_alive": "6h",
+        "options": profile.options,
+        "keep_alive": profile.keep_alive,
         # "OLLAMA_NUM_PARALLEL" : 4
     }
 
+    # Constrained decoding guarantees a parsable score when the backend supports it
+    if backend.supports_json_schema:
+        data["format"] = SCORE_RESPONSE_SCHEMA
+
+    reasoning_profile = get_reasoning_profile(profile.model)
+    token_counts = None
+
     try:
-        response = retrieve_response_from_endpoint(data)
+        if reasoning_profile and backend.supports_streaming:
+            reasoning_response = stream_reasoning_response(
+                data,
+                thinking_token_budget=reasoning_profile["thinking_token_budget"],
+                max_answer_tokens=reasoning_profile["max_answer_tokens"],
+                backend=backend,
+            )
+            token_counts = {
+                "thinking": reasoning_response["thinking_tokens"],
+                "answer": reasoning_response["answer_tokens"],
+            }
+            response = {
+                "content": reasoning_response["content"],
+                "prompt_tokens": reasoning_response["prompt_tokens"],
+                "completion_tokens": reasoning_response["completion_tokens"],
+            }
+        else:
+            response = retrieve_response_from_endpoint(data, backend)
+            response["content"] = strip_thinking(response.get("content", ""))
     except Exception as e:
         print(f"Error in get_response_from_llm: {e}")
         # Add context to the exception
@@ -160,9 +424,9 @@ def get_score_from_llm(question: str, baseline: str, current: str) -> dict:
 
     # print("\nResults:")
     # pprint(response)
-    content = response.get("message", {}).get("content", "")
+    content = response.get("content", "")
 
-    if "deepseek" in MODEL_NAME:
+    if reasoning_profile or "deepseek" in profile.model or "format" not in data:
         result = extract_json(content)
     else:
         try:
@@ -179,11 +443,174 @@ def get_score_from_llm(question: str, baseline: str, current: str) -> dict:
     print("Question: ", question)
     print("Reason: ", reason)
 
-    return {
+    score_data = {
         "score": total_rating,
-        "reason": reason
+        "reason": reason,
+        "prompt_version": prompt_version,
+        # Counted by the backend, charged to the user
+        "token_usage": add_token_usage({}, response),
+    }
+
+    if token_counts:
+        score_data["token_counts"] = token_counts
+
+    return score_data
+
+def get_scores_from_llm_for_candidates(question: str, baseline: str, candidates: dict, profile: JudgeProfile = None, token_usage: dict = None) -> dict:
+    """
+    Score several candidate answers against one baseline in a single LLM call.
+
+    The question and baseline are placed first in the prompt so the shared prefix
+    is prefilled once, followed by every candidate answer.
+
+    Args:
+        question (str): The question string.
+        baseline (str): The baseline string to evaluate against.
+        candidates (dict): Candidate answers keyed by candidate ID.
+        profile (JudgeProfile, optional): The judge profile to use, defaults to the default profile.
+        token_usage (dict, optional): The tokens of the call are added to it.
+
+    Returns:
+        dict: The score, reason and prompt version for each candidate ID.
+            e.g. {"candidate_id": {"score": 3, "reason": "...", "prompt_version": "v1"}}
+
+    Raises:
+        Exception: If the endpoint returns an error or a candidate score is missing.
+    """
+    if not candidates:
+        raise ValueError("At least one candidate must be provided.")
+
+    user_message_str = f"question: {question}\nbaseline: {baseline}\n" + "".join(
+        f"candidate {candidate_id}: {candidate}\n" for candidate_id, candidate in candidates.items()
+    )
+
+    messages = [
+        {
+            "role": "system",
+            "content": MULTI_CANDIDATE_PROMPT
+        },
+        {
+            "role": "user",
+            "content": user_message_str
+        }
+    ]
+
+    candidates_schema = {
+        "type": "object",
+        "properties": {str(candidate_id): SCORE_RESPONSE_SCHEMA for candidate_id in candidates},
+        "required": [str(candidate_id) for candidate_id in candidates]
+    }
+
+    profile = profile or get_profile()
+    backend = profile.get_backend()
+
+    data = {
+        "model": profile.model,
+        "messages": messages,
+        "stream": False,
+        "format": get_response_format(candidates_schema, backend),
+        "options": profile.options,
+        "keep_alive": profile.keep_alive,
+    }
+
+    try:
+        response = retrieve_response_from_endpoint(data, backend)
+    except Exception as e:
+        print(f"Error in get_scores_from_llm_for_candidates: {e}")
+        raise Exception(f"Failed to get response from LLM: {e}") from e
+
+    if token_usage is not None:
+        add_token_usage(token_usage, response)
+
+    content = response.get("content", "")
+    result = extract_json(content)
+
+    scores = {}
+    for candidate_id in candidates:
+        candidate_result = result.get(str(candidate_id))
+        if not isinstance(candidate_result, dict):
+            raise Exception(f"Score missing for candidate '{candidate_id}'")
+
+        scores[str(candidate_id)] = {
+            "score": candidate_result.get("Total rating", 0),
+            "reason": candidate_result.get("Reason", ""),
+            "prompt_version": profile.prompt_version
+        }
+
+    print("\n\nCandidate ratings: ", {cid: s["score"] for cid, s in scores.items()})
+    print("Question: ", question)
+
+    return scores
+
+def extract_key_facts(question: str, answer: str, profile: JudgeProfile = None) -> list[str]:
+    """
+    Extract a compact list of key facts from an answer.
+
+    Args:
+        question (str): The question string.
+        answer (str): The answer to extract the key facts from.
+        profile (JudgeProfile, optional): The judge profile to use, defaults to the default profile.
+
+    Returns:
+        list[str]: The key facts of the answer.
+
+    Raises:
+        Exception: If the endpoint returns an error or the response has no facts.
+    """
+    messages = [
+        {
+            "role": "system",
+            "content": KEY_FACTS_PROMPT
+        },
+        {
+            "role": "user",
+            "content": f"question: {question}\nanswer: {answer}"
+        }
+    ]
+
+    profile = profile or get_profile()
+    backend = profile.get_backend()
+
+    data = {
+        "model": profile.model,
+        "messages": messages,
+        "stream": False,
+        "format": get_response_format(KEY_FACTS_RESPONSE_SCHEMA, backend),
+        "options": profile.options,
+        "keep_alive": profile.keep_alive,
     }
 
+    try:
+        response = retrieve_response_from_endpoint(data, backend)
+    except Exception as e:
+        print(f"Error in extract_key_facts: {e}")
+        raise Exception(f"Failed to get response from LLM: {e}") from e
+
+    content = response.get("content", "")
+    key_facts = extract_json(content).get("key_facts", [])
+
+    if not key_facts or not isinstance(key_facts, list):
+        raise Exception("No key facts found in response")
+
+    return [str(fact) for fact in key_facts]
+
+def extract_key_facts_for_set(qa_set: list[dict], profile: JudgeProfile = None) -> dict:
+    """
+    Extract the key facts of every answer in a QA set.
+
+    Args:
+        qa_set (list[dict]): The QA set, each entry containing the id, question and answer.
+        profile (JudgeProfile, optional): The judge profile to use, defaults to the default profile.
+
+    Returns:
+        dict: The key facts indexed by question ID.
+    """
+    key_facts = {}
+    for qa in qa_set:
+        key_facts[str(qa["id"])] = extract_key_facts(qa.get("question", ""), qa.get("answer", ""), profile=profile)
+
+    return key_facts
+
 def get_score_from_llm_temp(question: str, baseline: str, current: str):
     
     return {
@@ -191,34 +618,47 @@ def get_score_from_llm_temp(question: str, baseline: str, current: str):
         "reason": "Dummmy reason"
     }
 
-def get_score_data(question: str, baseline: str, current: str, summary_accepted: bool) -> dict:
+def get_score_data(question: str, baseline: str, current: str, summary_accepted: bool, baseline_facts: list = None, judge_profile: str = None) -> dict:
     """ 
     Args:
         baseline (str): The baseline string to evaluate against.
         current (str): The current string to score against the baseline.
         summary_accepted (bool): Whether the summary is accepted or not (not used).
+        baseline_facts (list, optional): Precomputed key facts of the baseline.
+        judge_profile (str, optional): Name of the judge profile to use, defaults to the default profile.
 
     Returns:
         str: The response/score from the LLM, containing the score as a string (e.g. '3').
 
     """
-    score_data = get_score_from_llm(question, baseline, current)
+    profile = get_profile(judge_profile)
+    score_data = get_score_from_llm(question, baseline, current, baseline_facts=baseline_facts, profile=profile)
+    token_usage = score_data["token_usage"]
 
     if not summary_accepted:
         print("Question: ", question)
-        is_summary = check_if_summary(baseline, current)
+        is_summary = check_if_summary(baseline, current, profile=profile, token_usage=token_usage)
 
         if is_summary:
             return { 
                 "score": 0,
-                "reason": "We found summary in the string. Score updated."
+                "reason": "We found summary in the string. Score updated.",
+                "prompt_version": score_data["prompt_version"],
+                "token_usage": token_usage,
             }
 
-    return {
+    result = {
         "score": score_data.get("score", 0),
-        "reason": score_data.get("reason", "")
+        "reason": score_data.get("reason", ""),
+        "prompt_version": score_data["prompt_version"],
+        "token_usage": token_usage,
     }
 
+    if "token_counts" in score_data:
+        result["token_counts"] = score_data["token_counts"]
+
+    return result
+
 # temp function for testing
 def get_score_data_temp(question: str, baseline: str, current: str, summary_accepted: bool) -> dict:
     print("\nCalculating score...")
@@ -235,12 +675,15 @@ def get_score_data_temp(question: str, baseline: str, current: str, summary_acce
         "reason": "No reason"
     }
 
-def process_single_item(item: dict) -> dict:
+def process_single_item(item: dict, index: int = None) -> dict:
     """
-    Process a single item to retrieve the score.
+    Process a single item to retrieve the score, the key facts of an answer
+    for items with "task": "key_facts", or the scores of every candidate answer
+    for items with "task": "candidates".
 
     Args:
         item (dict): The item to process.
+        index (int, optional): Index of the item in its batch, to check whether it is cancelled.
 
     Returns:
         dict: The score for the item.
@@ -248,106 +691,368 @@ def process_single_item(item: dict) -> dict:
     query_id = list(item.keys())[0]
     query_data = item.get(query_id, {})
 
+    set_current_item(index)
+    if is_current_item_cancelled():
+        raise Cancelled("Cancelled before scoring.")
+
+    if query_data.get("task") == "key_facts":
+        key_facts = extract_key_facts(
+            query_data.get("question", ""), query_data.get("answer", ""),
+            profile=get_profile(query_data.get("judge_profile"))
+        )
+        return {query_id: {"key_facts": key_facts}}
+
+    if query_data.get("task") == "candidates":
+        return process_single_candidate_item(item)
+
     question = query_data.get("question", "")
     baseline = query_data.get("baseline", "")
     current = query_data.get("current", "")
     summary_accepted = query_data.get("summary_accepted", True)
+    baseline_facts = query_data.get("baseline_facts")
+    judge_profile = query_data.get("judge_profile")
 
     # score_data = get_score_data_temp(question, baseline, current, summary_accepted)
-    score_data = get_score_data(question, baseline, current, summary_accepted)
+    score_data = get_score_data(
+        question, baseline, current, summary_accepted,
+        baseline_facts=baseline_facts, judge_profile=judge_profile
+    )
 
     return {query_id: score_data}
 
-def process_items(items_list: list[dict]) -> dict:
+def init_scoring_process(cancel_flags, backends: dict) -> None:
+    """Initializer of the scoring processes, they use the backends set in the parent process."""
+    init_process_cancel_flags(cancel_flags)
+    set_backends(backends)
+
+def process_items(items_list: list[dict], is_cancelled: Callable[[int], bool] = None) -> list[dict]:
     """
     Process the items in the list using multiprocessing and return the scores.
 
+    The scoring processes get the backends of this process, whatever the start method.
+    While an in-process backend is set, e.g. a FakeBackend, items are scored in threads instead.
+
+    An item that could not be processed does not fail the others, its result is
+    {"status": "failed", "error": "..."} instead of its score, with "cancelled": True
+    if it was cancelled.
+
     Args:
         items_list (List[dict]): The list of items to process.
+        is_cancelled (Callable, optional): Called with the index of an item being processed,
+            returns whether it is no longer needed. Streaming calls of cancelled items are aborted.
 
     Returns:
-        Dict[str, dict]: The scores for each item.
+        List[dict]: The score of each item, in the same order as the items.
+            Items of different tenants may share a query ID, so results are not merged.
     """
-    scores_retrieved = {}
+    # Shared with the scoring processes, one flag per item
+    cancel_flags = multiprocessing.Array("b", len(items_list), lock=False)
+
+    if has_in_process_backend():
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=JUDGE_CONCURRENCY, initializer=init_process_cancel_flags, initargs=(cancel_flags,)
+        )
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=JUDGE_CONCURRENCY, initializer=init_scoring_process, initargs=(cancel_flags, get_backends())
+        )
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
-        results = list(executor.map(process_single_item, items_list))
+    with executor:
+        futures = [executor.submit(process_single_item, item, index) for index, item in enumerate(items_list)]
 
-    for result in results:
-        scores_retrieved.update(result)
+        pending = set(futures)
+        while pending:
+            _, pending = concurrent.futures.wait(pending, timeout=0.5)
+            if not is_cancelled:
+                continue
 
-    return scores_retrieved
+            for index, future in enumerate(futures):
+                if future in pending and not cancel_flags[index] and is_cancelled(index):
+                    cancel_flags[index] = 1
+                    future.cancel()
 
-def get_scores_for_queries(queries_data: dict, queue_manager: QueueManager) -> Dict[str, dict]:
+    results = []
+    for index, (item, future) in enumerate(zip(items_list, futures)):
+        query_id = list(item.keys())[0]
+        try:
+            results.append(future.result())
+        except (Cancelled, concurrent.futures.CancelledError):
+            results.append({query_id: {"status": "failed", "error": "Cancelled.", "cancelled": True}})
+        except Exception as e:
+            if cancel_flags[index]:
+                results.append({query_id: {"status": "failed", "error": "Cancelled.", "cancelled": True}})
+                continue
+            print(f"An error occurred while processing '{query_id}': {e}")
+            results.append({query_id: {"status": "failed", "error": str(e)}})
+
+    return results
+
+def process_single_candidate_item(item: dict) -> dict:
     """
-    Retrieve scores for a list of queries using the provided queue manager.
+    Process a single multi-candidate item to retrieve the candidate scores.
 
     Args:
-        queries_list (List[dict]): A list of dictionaries where each dictionary
-            contains the query ID and associated data, including the question,
-            baseline, current response, and whether the summary is accepted.
-            
+        item (dict): The item to process.
+            e.g. {"query_id": {"question": "...", "baseline": "...", "candidates": {"set_1": "..."}}}
+
+    Returns:
+        dict: The candidate scores for the item and the tokens counted by the backend.
+            e.g. {"query_id": {"candidate_scores": {"set_1": {...}}, "token_usage": {"input": 300, "output": 80}}}
+    """
+    query_id = list(item.keys())[0]
+    query_data = item.get(query_id, {})
+    token_usage = {}
+
+    scores = get_scores_from_llm_for_candidates(
+        question=query_data.get("question", ""),
+        baseline=query_data.get("baseline", ""),
+        candidates=query_data.get("candidates", {}),
+        profile=get_profile(query_data.get("judge_profile")),
+        token_usage=token_usage,
+    )
+
+    return {query_id: {"candidate_scores": scores, "token_usage": token_usage}}
+
+def get_scores_for_candidates(queries_data: dict, queue_manager: QueueManager, key_token: str = None, judge_profile: str = None, priority: str = "bulk", deadline: float = None, cancel_token: CancellationToken = None) -> Dict[str, dict]:
+    """
+    Retrieve candidate scores for every query, one LLM call per query.
+
+    The queries are queued for the tenant in their priority class, like the queries of
+    `get_scores_for_queries`, and a query that could not be scored does not fail the others.
+
+    Args:
+        queries_data (dict): Queries keyed by query ID, each containing the
+            question, the baseline and the candidate answers keyed by candidate ID.
+
             Example format:
-            [
-                {"query_id": {
-                        "question": "question string",
-                        "baseline": "baseline string",
-                        "current": "current string",
-                        "summary_accepted": true
-                    },
+            {
+                "query_id": {
+                    "question": "question string",
+                    "baseline": "baseline string",
+                    "candidates": {"set_1": "answer string", "set_2": "answer string"}
                 },
                 ...
-            ]
+            }
+        queue_manager (QueueManager): The queue manager to schedule the queries in.
+        key_token (str, optional): The tenant submitting the queries.
+        judge_profile (str, optional): Name of the judge profile to use, defaults to the default profile.
+        priority (str): Priority class of the queries, e.g. "interactive" or "bulk".
+        deadline (float, optional): Epoch time the queries must be scored by.
+        cancel_token (CancellationToken, optional): Cancelling it drops the queued queries.
 
-        queue_manager (QueueManager): An instance of QueueManager used to manage
-            and process the queries.
+    Returns:
+        Dict[str, dict]: The candidate scores for each query ID, the errors of the queries
+        that could not be scored under "failed", the average time spent per query and
+        the "token_usage" of the scored queries.
+
+    Raises:
+        DeadlineExceeded: If the queries could not be scored before the deadline.
+        Cancelled: If the cancel token was cancelled.
+    """
+    items = {query_id: {**query, "task": "candidates"} for query_id, query in queries_data.items()}
+
+    batch = queue_manager.create_and_insert_queries(
+        items, judge_profile=judge_profile, key_token=key_token, priority=priority, deadline=deadline
+    )
+
+    if cancel_token:
+        cancel_token.add_callback(lambda reason: queue_manager.cancel_batch(batch, reason))
+
+    run_batch(batch, queue_manager)
+
+    scores_data = {"scores": {}, "failed": {}, "token_usage": {"input": 0, "output": 0}}
+    for query_id, result in batch.scores.items():
+        if result["status"] == "failed":
+            scores_data["failed"][query_id] = result["error"]
+            continue
+
+        scores_data["scores"][query_id] = result["candidate_scores"]
+        scores_data["token_usage"]["input"] += result["token_usage"].get("input", 0)
+        scores_data["token_usage"]["output"] += result["token_usage"].get("output", 0)
+
+    scores_data["avg_queue_time"] = round(sum(batch.item_times) / max(len(batch.item_times), 1), 2)
+
+    return scores_data
+
+def get_fast_path_score(query: dict, judge_profile: str = None) -> dict:
+    """
+    Score a query without the LLM when its answer is the baseline, whitespace aside.
+
+    Args:
+        query (dict): The query, containing the question, baseline and current response.
+        judge_profile (str, optional): Name of the judge profile the query is scored with.
 
     Returns:
-        Dict[str, dict]: A dictionary mapping each query ID to its respective
-        scoring result and associated details.
+        dict: The score with the "fast_path" status, None if the query needs the LLM.
     """
-    scores_data = {"scores": {}}
-    
-    time_list = []
-    while True:
+    baseline = " ".join(query.get("baseline", "").split())
+    current = " ".join(query.get("current", "").split())
+
+    if not baseline or baseline != current:
+        return None
+
+    return {
+        "score": 5,
+        "reason": "The response is identical to the baseline.",
+        "prompt_version": get_profile(judge_profile).prompt_version,
+        "status": "fast_path",
+    }
+
+def run_batch(batch: ScoringBatch, queue_manager: QueueManager) -> None:
+    """
+    Score items handed out by the queue manager, which may belong to other tenants
+    or priority classes, until every item of the batch has been scored.
+
+    Args:
+        batch (ScoringBatch): The batch to wait for.
+        queue_manager (QueueManager): The queue manager the batch was queued in.
+
+    Raises:
+        DeadlineExceeded: If the batch could not be scored before its deadline.
+        Cancelled: If the batch was cancelled.
+    """
+    while not batch.is_done():
         items = queue_manager.get_items_to_process()
-        queue_manager.delete_empty_queues()
 
-        # No items to process
+        # Remaining items are queued behind other tenants or scored by other threads
         if not items:
-            break
-        
+            batch.wait(timeout=0.5)
+            continue
+
         start_time = time.time()
 
-        # process the retreived items
-        scores = process_items(items)
+        # process the retreived items, items of batches done meanwhile, e.g. cancelled, are aborted
+        results = process_items(
+            [queue_item.item for queue_item in items],
+            is_cancelled=lambda index: items[index].batch.is_done()
+        )
 
         end_time = time.time()
-        total_time = end_time - start_time
+        item_time = round((end_time - start_time) / len(items), 2)
+
+        # hand the scores to the batches they belong to, failed items are retried
+        for queue_item, result in zip(items, results):
+            score_data = result[queue_item.query_id]
+            if score_data.get("cancelled"):
+                queue_manager.complete_item(queue_item, error=Cancelled(score_data["error"]))
+            elif score_data.get("status") == "failed":
+                queue_manager.complete_item(queue_item, error=score_data["error"])
+            else:
+                queue_manager.complete_item(queue_item, score_data=score_data, processing_time=item_time)
+
+    if batch.error:
+        raise batch.error
+
+def get_scores_for_queries(queries_data: dict, queue_manager: QueueManager, key_token: str = None, summary_accepted: bool = True, judge_profile: str = None, priority: str = "bulk", deadline: float = None, checkpoint: Callable[[str, dict], None] = None, cancel_token: CancellationToken = None) -> Dict[str, dict]:
+    """
+    Retrieve scores for a list of queries using the provided queue manager.
+
+    The queries are queued for the tenant in their priority class, then this thread
+    scores items handed out by the queue manager until every query of its own batch
+    has been scored.
 
-        time_list.append(round(total_time / 2, 2))
+    Args:
+        queries_data (dict): A dictionary where each key is a query ID and each value
+            contains the question, baseline and current response.
+            
+            Example format:
+            {
+                "query_id": {
+                    "question": "question string",
+                    "baseline": "baseline string",
+                    "current": "current string"
+                },
+                ...
+            }
+
+        queue_manager (QueueManager): An instance of QueueManager used to manage
+            and process the queries.
+        key_token (str, optional): The tenant submitting the queries.
+        summary_accepted (bool): Whether summaries are accepted.
+        judge_profile (str, optional): Name of the judge profile to score with.
+        priority (str): Priority class of the queries, e.g. "interactive" or "bulk".
+        deadline (float, optional): Epoch time the queries must be scored by.
+        checkpoint (Callable, optional): Called with the query ID and score of every
+            scored item, as soon as it is scored.
+        cancel_token (CancellationToken, optional): Cancelling it drops the queued
+            queries and aborts the ones being streamed.
+
+    Returns:
+        Dict[str, dict]: A dictionary mapping each query ID to its respective
+        scoring result and associated details. The "status" of every result is
+        "ok", "retried" (scored after a retry), "fast_path" (scored without the LLM)
+        or "failed" (with the "error").
+
+    Raises:
+        DeadlineExceeded: If the queries could not be scored before the deadline.
+        Cancelled: If the cancel token was cancelled.
+    """
+    fast_path_scores = {}
+    queued_data = {}
+    for query_id, query in queries_data.items():
+        fast_path_score = get_fast_path_score(query, judge_profile=judge_profile)
+        if fast_path_score:
+            fast_path_scores[query_id] = fast_path_score
+            if checkpoint:
+                checkpoint(query_id, fast_path_score)
+        else:
+            queued_data[query_id] = query
 
-        # add the scores
-        scores_data["scores"].update(scores)
+    batch = queue_manager.create_and_insert_queries(
+        queued_data, summary_accepted=summary_accepted, judge_profile=judge_profile,
+        key_token=key_token, priority=priority, deadline=deadline, checkpoint=checkpoint
+    )
 
-        query_ids = list(queries_data.keys())
-        
-        # if all queries scores have been retrieved
-        print("\nQuery ids ",query_ids)
-        print("Scores data keys ", list(scores_data.get("scores", {}).keys()))
+    if cancel_token:
+        cancel_token.add_callback(lambda reason: queue_manager.cancel_batch(batch, reason))
 
-        if query_ids == list(scores_data.keys()):
-            print("Breaking...")
-            break
-        
-    print("Avg queue time: ", time_list)
-    scores_data["avg_queue_time"] = round(sum(time_list) / len(time_list), 2)
+    run_batch(batch, queue_manager)
+
+    scores_data = {"scores": {**fast_path_scores, **batch.scores}}
+
+    print("Avg queue time: ", batch.item_times)
+    scores_data["avg_queue_time"] = round(sum(batch.item_times) / max(len(batch.item_times), 1), 2)
 
     print("\nScores data: ")
     pprint(scores_data)
 
     return scores_data
 
+def get_key_facts_for_set(qa_set: list[dict], queue_manager: QueueManager, key_token: str = None, judge_profile: str = None) -> dict:
+    """
+    Extract the key facts of every answer in a QA set through the scheduler, as
+    background work that only runs when no interactive or bulk item is waiting.
+
+    Args:
+        qa_set (list[dict]): The QA set, each entry containing the id, question and answer.
+        queue_manager (QueueManager): The queue manager to schedule the extraction in.
+        key_token (str, optional): The tenant owning the QA set.
+        judge_profile (str, optional): Name of the judge profile to use.
+
+    Returns:
+        dict: The key facts indexed by question ID.
+    """
+    items = {
+        str(qa["id"]): {
+            "task": "key_facts",
+            "question": qa.get("question", ""),
+            "answer": qa.get("answer", ""),
+        }
+        for qa in qa_set
+    }
+
+    batch = queue_manager.create_and_insert_queries(
+        items, judge_profile=judge_profile, key_token=key_token, priority="background"
+    )
+
+    run_batch(batch, queue_manager)
+
+    failed = [query_id for query_id, result in batch.scores.items() if result["status"] == "failed"]
+    if failed:
+        raise Exception(f"Key facts could not be extracted for: {', '.join(failed)}")
+
+    return {query_id: result["key_facts"] for query_id, result in batch.scores.items()}
+
 def get_score_from_rag(base_url: str, questions: dict) -> dict:
     """
     Calls the RAG model's endpoint to retrieve answers for given questions.
@@ -0,0 +1,164 @@
+import os
+import signal
+import threading
+import time
+from typing import Callable
+
+from flask import Flask
+
+from .constants import DRAIN_TIMEOUT_SECONDS
+from .durable_queue import durable_queue
+from .queues import QueueManager, ScoringBatch, QueueItem, ServerDraining, queue_manager
+from .usage import usage_aggregator
+
+class DrainController:
+    """
+    Drains the server before a restart, so a rolling restart loses no inference.
+
+    Draining stops admitting new queries and hands the queued ones off: items of runs
+    stay pending in the checkpoint store and are resumed with /resume-run, other scoring
+    items are handed to the durable queue. Items in flight are scored until the timeout,
+    then aborted.
+    """
+    def __init__(self, queue_manager: QueueManager, timeout: float = DRAIN_TIMEOUT_SECONDS):
+        self.queue_manager = queue_manager
+        self.timeout = timeout
+        self.state = "serving"  # serving, draining or drained
+        self.reason = None
+        self.started_at = None
+        self.handed_off = {"checkpoint": 0, "durable_queue": 0, "failed": 0}
+        self.aborted_items = 0
+        self.on_drained = []
+        self.lock = threading.Lock()
+
+    def start(self, app: Flask, reason: str = "Drain requested.", on_drained: Callable[[], None] = None) -> bool:
+        """
+        Start draining in the background.
+
+        Args:
+            app (Flask): The app, hand-offs need its context.
+            reason (str): Why the server is drained.
+            on_drained (Callable, optional): Called once the server is drained, e.g. to exit.
+
+        Returns:
+            bool: False if the server was already draining or drained.
+        """
+        with self.lock:
+            if on_drained:
+                if self.state == "drained":
+                    threading.Thread(target=on_drained, daemon=True).start()
+                else:
+                    self.on_drained.append(on_drained)
+
+            if self.state != "serving":
+                return False
+
+            self.state = "draining"
+            self.reason = reason
+            self.started_at = time.time()
+
+        print(f"Draining: {reason}")
+        self.queue_manager.start_drain()
+        threading.Thread(target=self.drain, args=(app,), daemon=True).start()
+        return True
+
+    def drain(self, app: Flask) -> None:
+        with app.app_context():
+            self.hand_off_queued_items()
+
+            deadline = self.started_at + self.timeout
+            while self.queue_manager.get_in_flight_count() and time.time() < deadline:
+                time.sleep(0.5)
+                # Items that failed in flight are queued again for a retry
+                self.hand_off_queued_items()
+
+            self.aborted_items = self.queue_manager.abort_in_flight(
+                ServerDraining("Server restarted before the queries could be scored.")
+            )
+            self.hand_off_queued_items()
+
+            # Buffered usage is written before the process exits
+            usage_aggregator.stop()
+
+        with self.lock:
+            self.state = "drained"
+            callbacks, self.on_drained = self.on_drained, []
+
+        print(f"Drained, handed off: {self.handed_off}, aborted: {self.aborted_items}")
+        for callback in callbacks:
+            callback()
+
+    def hand_off_queued_items(self) -> None:
+        """Hand the queued items of every batch off to the checkpoint store or the durable queue."""
+        for batch, queue_items in self.queue_manager.take_queued_items().items():
+            self.hand_off_batch(batch, queue_items)
+
+    def hand_off_batch(self, batch: ScoringBatch, queue_items: list[QueueItem]) -> None:
+        query_ids = [queue_item.query_id for queue_item in queue_items]
+
+        if batch.checkpoint:
+            # The items are pending in the run, resuming it scores them
+            batch.hand_off(query_ids, ServerDraining("Server is restarting, resume the run to score the remaining queries."))
+            self.handed_off["checkpoint"] += len(query_ids)
+            return
+
+        query_data = queue_items[0].query_data
+        if not batch.key_token or query_data.get("task"):
+            # The durable queue only scores queries, other tasks, e.g. key facts or candidates, are retried by their clients
+            batch.hand_off(query_ids, ServerDraining("Server is restarting."))
+            self.handed_off["failed"] += len(query_ids)
+            return
+
+        try:
+            job_id = durable_queue.enqueue_job(
+                key_token=batch.key_token,
+                queries_data={
+                    queue_item.query_id: {
+                        key: value for key, value in queue_item.query_data.items()
+                        if key not in ("summary_accepted", "judge_profile")
+                    }
+                    for queue_item in queue_items
+                },
+                summary_accepted=query_data.get("summary_accepted", True),
+                judge_profile=query_data.get("judge_profile"),
+                priority=batch.priority,
+            )
+        except Exception as e:
+            print(f"An error occurred while handing off batch '{batch.batch_id}': {e}")
+            batch.hand_off(query_ids, ServerDraining("Server is restarting."))
+            self.handed_off["failed"] += len(query_ids)
+            return
+
+        batch.hand_off(
+            query_ids,
+            ServerDraining("Server is restarting, the queries were submitted as a job, poll /get-score-job-status.", job_id=job_id)
+        )
+        self.handed_off["durable_queue"] += len(query_ids)
+
+    def get_status(self) -> dict:
+        return {
+            "state": self.state,
+            "reason": self.reason,
+            "elapsed": round(time.time() - self.started_at, 2) if self.started_at else 0.0,
+            "in_flight": self.queue_manager.get_in_flight_count(),
+            "handed_off": dict(self.handed_off),
+            "aborted_items": self.aborted_items,
+            "usage": usage_aggregator.get_stats(),
+        }
+
+
+drain_controller = DrainController(queue_manager)
+
+def install_drain_signal_handler(app: Flask, signum: int = signal.SIGTERM) -> None:
+    """
+    Drain the server on SIGTERM, then exit. A second SIGTERM exits without waiting.
+    Must be called from the main thread.
+    """
+    def exit_process():
+        os.kill(os.getpid(), signum)
+
+    def handle(received_signum, frame):
+        signal.signal(signum, signal.SIG_DFL)
+        drain_controller.start(app, reason=f"Received signal {received_signum}.", on_drained=exit_process)
+
+    signal.signal(signum, handle)
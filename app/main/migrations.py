@@ -0,0 +1,284 @@
+"""
+Schema version 1 kept everything of a user in one `qa_data` document:
+    {
+        "key_token": "...", "email": "...",
+        "projects": {
+            "1234": {
+                "project_name": "...", "judge_profile": "...",
+                "qa_sets": [
+                    {
+                        "set_id": 1, "baseline": True, "last_updated": "...", "key_facts": {...},
+                        "qa_set": [{"id": 1, "question": "...", "answer": "..."}],
+                        "scores": {"1": {...}}
+                    }
+                ]
+            }
+        }
+    }
+
+Version 2 keeps the `qa_data` document as the tenant record, without "projects" but with
+their "project_count", and stores one document per project, QA set, question-answer and score:
+    projects: {"key_token", "project_id", "project_name", "judge_profile", "qa_set_count"}
+    qa_sets:  {"key_token", "project_id", "set_id", "baseline", "last_updated", "key_facts"}
+    qa_items: {"key_token", "project_id", "set_id", "position", "id", "question", "answer"}
+    scores:   {"key_token", "project_id", "set_id", "question_id", "score_data"}
+
+Tenants are migrated online, the first time they are accessed, or all at once with
+`python migrate.py`.
+
+The usage of a user was kept in its credits document, in one field per month, e.g.
+"January_2025": {"token_used", "number_of_requests", "total_input_token", ...}. It is moved
+to the hour and month buckets of the usage collection, see `usage.py`, the same way, and
+the credits are then marked "usage_migrated".
+"""
+import datetime
+import re
+import time
+
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from app import mongo
+from .constants import STORAGE_SCHEMA_VERSION, MIGRATION_LEASE_SECONDS, MIGRATION_WAIT_SECONDS
+from .cache import credits_cache
+from .usage import get_bucket_filter
+from .utils import get_current_datetime, get_current_month_year
+
+LEGACY_USAGE_FIELD = re.compile(r"^[A-Z][a-z]+_\d{4}$")  # e.g. January_2025
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+def get_normalized_documents(key_token: str, projects: dict) -> dict:
+    """
+    Split the projects of a version 1 document into the documents of the normalized collections.
+
+    Returns:
+        dict: The documents keyed by collection name.
+    """
+    documents = {"projects": [], "qa_sets": [], "qa_items": [], "scores": []}
+    project_names = set()
+
+    for project_id, project in projects.items():
+        # Names are unique per user in version 2, version 1 allowed renaming a project to a taken name
+        project_name = project.get("project_name", "-")
+        if project_name in project_names:
+            project_name = f"{project_name} ({project_id})"
+        project_names.add(project_name)
+
+        documents["projects"].append({
+            "key_token": key_token,
+            "project_id": project_id,
+            **{key: value for key, value in project.items() if key != "qa_sets"},
+            "project_name": project_name,
+            # Sets of the project, add_qa makes the first one the baseline
+            "qa_set_count": len(project.get("qa_sets", [])),
+        })
+
+        for qa_set in project.get("qa_sets", []):
+            set_key = {"key_token": key_token, "project_id": project_id, "set_id": qa_set["set_id"]}
+
+            documents["qa_sets"].append({
+                **set_key,
+                **{key: value for key, value in qa_set.items() if key not in ("qa_set", "scores")},
+            })
+            documents["qa_items"].extend(
+                {**set_key, "position": position, **qa}
+                for position, qa in enumerate(qa_set.get("qa_set", []))
+            )
+            documents["scores"].extend(
+                {**set_key, "question_id": question_id, "score_data": score_data}
+                for question_id, score_data in qa_set.get("scores", {}).items()
+            )
+
+    return documents
+
+def get_document_key(collection: str, document: dict) -> dict:
+    """The unique key of a normalized document."""
+    fields = {
+        "projects": ("key_token", "project_id"),
+        "qa_sets": ("key_token", "project_id", "set_id"),
+        "qa_items": ("key_token", "project_id", "set_id", "position"),
+        "scores": ("key_token", "project_id", "set_id", "question_id"),
+    }[collection]
+    return {field: document[field] for field in fields}
+
+def migrate_tenant(key_token: str, keep_legacy: bool = False) -> bool:
+    """
+    Move the projects of a version 1 tenant to the normalized collections.
+
+    The tenant is claimed first, so only one request or script migrates it. The documents
+    are upserted, so a migration interrupted by a crash is completed by the next one.
+
+    Args:
+        key_token (str): The tenant to migrate.
+        keep_legacy (bool): Keep the version 1 projects under "legacy_projects" instead of removing them.
+
+    Returns:
+        bool: Whether the tenant was migrated by this call, False if it is already migrated,
+        does not exist or is being migrated by another request.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    tenant = mongo.db.qa_data.find_one_and_update(
+        {
+            "key_token": key_token,
+            "schema_version": {"$ne": STORAGE_SCHEMA_VERSION},
+            "$or": [{"migrating_until": None}, {"migrating_until": {"$lt": now}}],
+        },
+        {"$set": {"migrating_until": now + datetime.timedelta(seconds=MIGRATION_LEASE_SECONDS)}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not tenant:
+        return False
+
+    documents = get_normalized_documents(key_token, tenant.get("projects", {}))
+    for collection, collection_documents in documents.items():
+        if collection_documents:
+            mongo.db[collection].bulk_write(
+                [ReplaceOne(get_document_key(collection, document), document, upsert=True) for document in collection_documents],
+                ordered=False
+            )
+
+    update = {
+        "$set": {
+            "schema_version": STORAGE_SCHEMA_VERSION,
+            "project_count": len(documents["projects"]),
+            "migrated_at": get_current_datetime(),
+        },
+        "$unset": {"projects": "", "migrating_until": ""},
+    }
+    if keep_legacy and "projects" in tenant:
+        update["$set"]["legacy_projects"] = tenant["projects"]
+
+    mongo.db.qa_data.update_one({"key_token": key_token}, update)
+
+    print(
+        f"Migrated tenant '{key_token}': "
+        + ", ".join(f"{len(collection_documents)} {collection}" for collection, collection_documents in documents.items())
+    )
+    return True
+
+def ensure_migrated(key_token: str) -> dict:
+    """
+    Get the record of a tenant, migrating it to the normalized collections first if needed.
+
+    Returns:
+        dict: The tenant record, with only its "schema_version".
+
+    Raises:
+        ValueError: If the tenant does not exist.
+        Exception: If another request is still migrating the tenant after MIGRATION_WAIT_SECONDS.
+    """
+    started_at = time.time()
+    while True:
+        tenant = mongo.db.qa_data.find_one({"key_token": key_token}, {"schema_version": 1})
+        if not tenant:
+            raise ValueError(f"No user found for: {key_token}")
+
+        if tenant.get("schema_version") == STORAGE_SCHEMA_VERSION:
+            return tenant
+
+        if migrate_tenant(key_token):
+            continue
+
+        if time.time() - started_at > MIGRATION_WAIT_SECONDS:
+            raise Exception(f"The data of user {key_token} is being migrated, please try again later.")
+        time.sleep(0.2)
+
+def migrate_all(keep_legacy: bool = False) -> int:
+    """
+    Migrate every version 1 tenant.
+
+    Returns:
+        int: The number of migrated tenants.
+    """
+    migrated = 0
+    for tenant in mongo.db.qa_data.find({"schema_version": {"$ne": STORAGE_SCHEMA_VERSION}}, {"key_token": 1}):
+        if tenant.get("key_token") and migrate_tenant(tenant["key_token"], keep_legacy=keep_legacy):
+            migrated += 1
+
+    return migrated
+
+def get_legacy_usage_updates(key_token: str, month: str, usage: dict) -> list[UpdateOne]:
+    """
+    The updates adding the usage of a legacy month field to the usage buckets.
+
+    The counters are added to one hour bucket at the start of the month, so ranges
+    including the month count them. There is no histogram for them. Each bucket lists
+    the months added to it in "legacy_months", a bucket that already has the month does
+    not match and its upsert fails on the unique index, so a month is never added twice.
+    """
+    month_start = datetime.datetime.strptime(month, "%B_%Y").replace(tzinfo=datetime.timezone.utc)
+    number_of_requests = usage.get("number_of_requests", 0)
+    not_added = {"legacy_months": {"$ne": month}}
+    mark_added = {"$addToSet": {"legacy_months": month}}
+
+    counters = {
+        "requests": number_of_requests,
+        "input_tokens": usage.get("total_input_token", 0),
+        "output_tokens": usage.get("total_output_token", 0),
+        "processing_time": usage.get("total_processing_time", usage.get("avg_processing_time", 0) * number_of_requests),
+        "queue_time": usage.get("total_queue_time", 0),
+    }
+    hour_update = {"$inc": counters, **mark_added}
+    if "last_request_processing_time" in usage:
+        hour_update["$set"] = {"last_request_processing_time": usage["last_request_processing_time"]}
+
+    return [
+        UpdateOne({**get_bucket_filter(key_token, "hour", month_start), **not_added}, hour_update, upsert=True),
+        UpdateOne(
+            {**get_bucket_filter(key_token, "month", month_start), **not_added},
+            {"$inc": {"token_used": usage.get("token_used", 0)}, **mark_added},
+            upsert=True
+        ),
+    ]
+
+def migrate_usage(key_token: str) -> int:
+    """
+    Move the usage of a user from the month fields of its credits to the usage collection.
+
+    The usage is added to the buckets first, at most once per month, see `get_legacy_usage_updates`.
+    The fields are only removed once it is, so a call that fails or is interrupted in between
+    is completed by the next one, and the credits are marked "usage_migrated".
+
+    Returns:
+        int: The number of months moved by this call.
+    """
+    credits = mongo.db.credits.find_one({"key_token": key_token})
+    if not credits:
+        return 0
+    months = [field for field, value in credits.items() if LEGACY_USAGE_FIELD.match(field) and isinstance(value, dict)]
+
+    if months:
+        updates = []
+        for month in months:
+            updates.extend(get_legacy_usage_updates(key_token, month, credits[month]))
+        try:
+            mongo.db.usage.bulk_write(updates, ordered=False)
+        except BulkWriteError as e:
+            # Buckets that already have their month, added by a concurrent or interrupted call
+            if any(error["code"] != DUPLICATE_KEY_ERROR_CODE for error in e.details.get("writeErrors", [])):
+                raise
+
+    update = {"$set": {"usage_migrated": True}}
+    if months:
+        update["$unset"] = {month: "" for month in months}
+    mongo.db.credits.update_one({"key_token": key_token}, update)
+
+    # The cached credits still have the month fields, and no marker
+    credits_cache.invalidate((key_token, get_current_month_year()))
+    if months:
+        print(f"Migrated the usage of '{key_token}': {', '.join(months)}")
+    return len(months)
+
+def migrate_all_usage() -> int:
+    """
+    Move the usage of every user still kept in its credits.
+
+    Returns:
+        int: The number of users whose usage was moved.
+    """
+    migrated = 0
+    for credits in mongo.db.credits.find({"usage_migrated": {"$ne": True}}, {"key_token": 1}):
+        if credits.get("key_token") and migrate_usage(credits["key_token"]):
+            migrated += 1
+
+    return migrated
@@ -0,0 +1,111 @@
+import hashlib
+import itertools
+import threading
+
+from .constants import MODEL_NAME, DEFAULT_JUDGE_PROFILE
+from .prompts import SYSTEM_PROMPTS, KEY_FACTS_PROMPT_VERSION
+from .backends import JudgeBackend, get_backend
+
+class JudgeProfile:
+    """
+    A judge configuration that projects can select.
+
+    Args:
+        name (str): Name of the profile.
+        model (str): Name of the model used for scoring.
+        prompt_version (str): Version of the scoring prompt, a key of SYSTEM_PROMPTS.
+        options (dict, optional): Decoding options sent to the backend, e.g. {"temperature": 0}.
+        backend_pool (list[str], optional): Names of the backends serving the model, used in turn.
+        keep_alive (str, optional): How long the model should stay loaded after a request.
+    """
+    def __init__(self, name: str, model: str, prompt_version: str, options: dict = None, backend_pool: list[str] = None, keep_alive: str = "6h"):
+        if prompt_version not in SYSTEM_PROMPTS:
+            raise ValueError(f"Unknown prompt version: {prompt_version}")
+
+        self.name = name
+        self.model = model
+        self.prompt_version = prompt_version
+        self.options = options or {}
+        self.backend_pool = backend_pool or [None]  # None is the default backend
+        self.keep_alive = keep_alive
+        self.backend_cycle = itertools.cycle(self.backend_pool)
+        self.lock = threading.Lock()
+
+    def get_system_prompt(self) -> str:
+        """Get the scoring prompt of the profile."""
+        return SYSTEM_PROMPTS[self.prompt_version]
+
+    def get_backend(self) -> JudgeBackend:
+        """Get the next backend of the pool."""
+        with self.lock:
+            backend_name = next(self.backend_cycle)
+        return get_backend(backend_name)
+
+    def get_cache_key(self, *parts) -> str:
+        """
+        Build a cache key for a result of this profile.
+
+        Args:
+            *parts: Values identifying the cached result, e.g. the question and answer.
+
+        Returns:
+            str: A key including the model and prompt version of the profile.
+        """
+        digest = hashlib.sha256()
+        for part in (self.model, self.prompt_version, *parts):
+            digest.update(str(part).encode("utf-8"))
+            digest.update(b"\x00")
+        return digest.hexdigest()
+
+    def get_key_facts_cache_key(self, source_last_updated) -> str:
+        """Cache key of the key facts extracted from a QA set last updated at `source_last_updated`."""
+        return self.get_cache_key("key_facts", KEY_FACTS_PROMPT_VERSION, source_last_updated)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "model": self.model,
+            "prompt_version": self.prompt_version,
+            "options": self.options,
+            "backend_pool": [backend_name or "default" for backend_name in self.backend_pool],
+        }
+
+JUDGE_PROFILES = {
+    "default": JudgeProfile(
+        name="default",
+        model=MODEL_NAME,
+        prompt_version="v1",
+    ),
+    "detailed": JudgeProfile(
+        name="detailed",
+        model=MODEL_NAME,
+        prompt_version="v2",
+    ),
+    "reasoning": JudgeProfile(
+        name="reasoning",
+        model="deepseek-r1:14b",
+        prompt_version="v1",
+    ),
+}
+
+def get_profile(profile_name: str = None) -> JudgeProfile:
+    """
+    Get a judge profile from the registry.
+
+    Args:
+        profile_name (str, optional): Name of the profile, defaults to DEFAULT_JUDGE_PROFILE.
+
+    Returns:
+        JudgeProfile: The profile.
+
+    Raises:
+        ValueError: If the profile does not exist.
+    """
+    profile_name = profile_name or DEFAULT_JUDGE_PROFILE
+    if profile_name not in JUDGE_PROFILES:
+        raise ValueError(f"Judge profile '{profile_name}' does not exist.")
+    return JUDGE_PROFILES[profile_name]
+
+def register_profile(profile: JudgeProfile) -> None:
+    """Add or replace a judge profile in the registry."""
+    JUDGE_PROFILES[profile.name] = profile
@@ -65,4 +65,112 @@ Output your answer in the following JSON format and nothing else:
   "Total rating": <integer 1-5>,
   "Reason": "<your concise reason for the score>"
 }
-"""
\ No newline at end of file
+"""
+# Versioned scoring prompts, the version is part of every result and cache key
+SYSTEM_PROMPTS = {
+    "v1": SYSTEM_PROMPT,
+    "v2": SYSTEM_PROMPT_1,
+}
+
+MULTI_CANDIDATE_PROMPT = """\
+You are a scoring assistant tasked with evaluating the relevancy of several candidate answers against one baseline answer.
+
+Keywords and what they mean:
+question: Actual question.
+baseline: Assume, It is a correct answer to the question.
+candidate <id>: A generated answer to the question, identified by <id>.
+
+Instructions:
+1. Score every candidate independently, based solely on how accurate it is compared to the baseline.
+2. Do not compare candidates with each other and do not let one candidate affect the score of another.
+3. Provide your exact reason for every score.
+
+Note: Never use the words baseline, candidate in your reason.
+
+Here is the scale you should use for every candidate:
+1: The candidate is terrible: Completely not relevant to the baseline, or very partial.
+2: The candidate is mostly not relevant: Misses relevancy and some key content of the baseline.
+3: The candidate is somehow relevant: Very few content of the baseline is present.
+4: The candidate is mostly relevant: Relevant, but very few content of the baseline are missing.
+5: The candidate is excellent: Complete content from the baseline is present.
+
+Provide the scoring in the string json format and nothing else, with one entry per candidate id:
+{
+  "<id>": {
+    "Total rating": <integer 1-5>,
+    "Reason": "<exact concise reason for score>"
+  }
+}
+"""
+
+# Version of the key facts extraction and scoring prompts, part of the results and cache keys using them
+KEY_FACTS_PROMPT_VERSION = "kf1"
+
+KEY_FACTS_PROMPT = """\
+You are an assistant tasked with extracting the key facts from an answer to a question.
+
+Instructions:
+1. List every distinct fact of the answer that is needed to answer the question.
+2. Keep every fact short and self contained, one fact per entry.
+3. Do not add facts that are not present in the answer.
+
+Provide the facts in the string json format and nothing else:
+{
+  "key_facts": ["<fact>", "<fact>"]
+}
+"""
+
+KEY_FACTS_SCORE_PROMPT = """\
+You are a scoring assistant tasked with evaluating how well the [current] answer covers the [key facts] of the correct answer to a question.
+
+Keywords and what they mean:
+[question]: Actual question.
+[key facts]: Assume, These are the key facts of a correct answer to the question.
+[current]: It is a generated answer to the question.
+
+Instructions:
+1. Score based solely on how many of the [key facts] are correctly present in the [current] answer.
+2. If the [current] answer contradicts a key fact, treat that fact as missing.
+3. Output should always contain just the score and reason, Nothing else.
+
+Note: Never use keywords [key facts], [current] in your reason, 
+
+Here is the scale you should use to build your answer:
+1: The [current] is terrible: None or almost none of the [key facts] are present.
+2: The [current] is mostly not relevant: Most of the [key facts] are missing.
+3: The [current] is somehow relevant: Some of the [key facts] are present.
+4: The [current] is mostly relevant: Very few of the [key facts] are missing.
+5: The [current] is excellent: All of the [key facts] are present.
+
+Provide the scoring in the string json format and nothing else:
+{
+  "Total rating": <integer 1-5>,
+  "Reason": "<exact concise reason for score>"
+}
+"""
+
+# JSON schemas used to constrain the output of backends that support it
+SCORE_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "Total rating": {"type": "integer", "minimum": 1, "maximum": 5},
+        "Reason": {"type": "string"}
+    },
+    "required": ["Total rating", "Reason"]
+}
+
+SUMMARY_CHECK_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "is_summary": {"type": "boolean"}
+    },
+    "required": ["is_summary"]
+}
+
+KEY_FACTS_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "key_facts": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["key_facts"]
+}
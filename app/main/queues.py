@@ -1,90 +1,734 @@
-from pprint import pprint
-from queue import Queue
+from collections import deque, defaultdict
+from typing import Callable
+import hashlib
+import heapq
+import itertools
+import math
 import threading
+import time
+import uuid
+
+from .constants import (
+    DEFAULT_TENANT_WEIGHT,
+    MAX_IN_FLIGHT_PER_TENANT,
+    SCHEDULER_QUANTUM,
+    PRIORITY_CLASSES,
+    RETRY_LANE,
+    SCHEDULER_LANES,
+    MAX_ITEM_RETRIES,
+    DEFAULT_ITEM_LATENCY,
+    JUDGE_CONCURRENCY,
+    MAX_QUEUED_ITEMS,
+    MAX_QUEUED_BYTES,
+    ADMISSION_SLA_SECONDS,
+    DRAIN_RETRY_AFTER_SECONDS,
+)
+from .profiles import get_profile
+from .cancellation import Cancelled
+
+class DeadlineExceeded(Exception):
+    """Raised when queued items can no longer be scored before their deadline."""
+    pass
+
+class AdmissionRejected(Exception):
+    """
+    Raised when queries are not admitted to the queue.
+
+    Attributes:
+        retry_after (int): Seconds after which the queries would likely be admitted.
+    """
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class ServerDraining(AdmissionRejected):
+    """
+    Raised when queries are rejected, or handed off, because the server is draining for a restart.
+
+    Attributes:
+        job_id (str): The durable queue job the queued queries were handed to, if any.
+    """
+    def __init__(self, message: str, retry_after: int = DRAIN_RETRY_AFTER_SECONDS, job_id: str = None):
+        super().__init__(message, retry_after)
+        self.job_id = job_id
+
+class ScoringBatch:
+    """
+    The queries of one submission. Scored items of the batch are collected here,
+    whichever thread processed them.
+
+    `checkpoint`, if given, is called with the query ID and score of every scored item,
+    e.g. to save it before the rest of the batch is done.
+    """
+    def __init__(self, key_token: str, query_ids: list, priority: str = "bulk", deadline: float = None, checkpoint: Callable[[str, dict], None] = None):
+        self.batch_id = str(uuid.uuid4())
+        self.key_token = key_token
+        self.priority = priority
+        self.deadline = deadline
+        self.checkpoint = checkpoint
+        self.pending = set(query_ids)
+        self.scores = {}
+        self.item_times = []
+        self.error = None
+        self.done = threading.Event()
+
+        if not self.pending:
+            self.done.set()
+
+    def set_result(self, query_id: str, score_data: dict, processing_time: float) -> None:
+        """Record the score, or "failed" status, of an item, the batch is done once every item has one."""
+        if self.checkpoint and score_data.get("status") != "failed":
+            try:
+                self.checkpoint(query_id, score_data)
+            except Exception as e:
+                # The score is still returned, only resuming would score the item again
+                print(f"An error occurred while saving the checkpoint of '{query_id}': {e}")
+
+        self.scores[query_id] = score_data
+        self.item_times.append(processing_time)
+        self.pending.discard(query_id)
+
+        if not self.pending:
+            self.done.set()
+
+    def set_error(self, error: Exception) -> None:
+        """Fail the batch, the first error is kept."""
+        if self.error is None:
+            self.error = error
+        self.done.set()
+
+    def hand_off(self, query_ids: list, error: Exception) -> None:
+        """
+        Give up items that are scored elsewhere, e.g. by the durable queue while draining. The
+        batch fails with the error once its other items, e.g. being scored, have a result.
+        """
+        if self.error is None:
+            self.error = error
+        self.pending.difference_update(query_ids)
+
+        if not self.pending:
+            self.done.set()
+
+    def is_done(self) -> bool:
+        return self.done.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self.done.wait(timeout)
+
+class QueueItem:
+    """A single query waiting to be scored."""
+    def __init__(self, query_id: str, query_data: dict, batch: ScoringBatch):
+        self.query_id = query_id
+        self.query_data = query_data
+        self.batch = batch
+        self.key_token = batch.key_token
+        self.priority = batch.priority
+        self.deadline = batch.deadline
+        self.model = get_profile(query_data.get("judge_profile")).model
+        self.attempts = 0
+        self.size = sum(len(str(value)) for value in query_data.values())
+        self.enqueued_at = time.time()
+        self.started_at = None
+
+    @property
+    def item(self) -> dict:
+        """The item in the format processed by the judge, {"query_id": {...}}."""
+        return {self.query_id: self.query_data}
+
+class TenantQueue:
+    """
+    The queued items of one tenant in one priority class, earliest deadline first.
+    Items without a deadline come after items with one, in arrival order.
+    """
+    def __init__(self, key_token: str, weight: float):
+        self.key_token = key_token
+        self.weight = weight
+        self.items = []  # heap of (deadline, sequence, QueueItem)
+        self.size = 0  # bytes of the queued items
+        self.deficit = 0.0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def push(self, queue_item: QueueItem, sequence: int) -> None:
+        deadline = queue_item.deadline if queue_item.deadline is not None else float("inf")
+        heapq.heappush(self.items, (deadline, sequence, queue_item))
+        self.size += queue_item.size
+
+    def peek(self) -> QueueItem:
+        return self.items[0][2]
+
+    def pop(self) -> QueueItem:
+        queue_item = heapq.heappop(self.items)[2]
+        self.size -= queue_item.size
+        return queue_item
+
+    def remove_batch(self, batch: ScoringBatch) -> int:
+        """Remove the queued items of a batch, returns the number of removed items."""
+        remaining = [entry for entry in self.items if entry[2].batch is not batch]
+        removed = len(self.items) - len(remaining)
+        heapq.heapify(remaining)
+        self.items = remaining
+        self.size = sum(entry[2].size for entry in remaining)
+        return removed
+
+    def get_oldest_age(self) -> float:
+        """Seconds the oldest queued item has been waiting."""
+        if not self.items:
+            return 0.0
+        return time.time() - min(entry[2].enqueued_at for entry in self.items)
+
+def get_tenant_alias(key_token: str) -> str:
+    """Short hash of a key token, to tell tenants apart in stats without exposing their credentials."""
+    return hashlib.sha256(key_token.encode("utf-8")).hexdigest()[:12]
 
 class QueueManager:
-    def __init__(self):
-        self.queues = []
-        self.current_queue = -1
+    """
+    Thread-safe scheduler of the items to score, by priority class and fair across tenants.
+
+    Priority classes (PRIORITY_CLASSES, e.g. interactive, bulk, background) are served
+    strictly in order, with failed items retried in a separate lane between bulk and
+    background work (SCHEDULER_LANES), up to MAX_ITEM_RETRIES times. Within a class, items are queued per key token and tenants are
+    served with deficit round-robin: every time a tenant's turn comes, its deficit grows
+    by `quantum * weight` and it can take one item per unit of deficit. A tenant's own
+    items are served earliest deadline first. A tenant never has more than
+    `max_in_flight_per_tenant` items being scored at once.
+
+    Items that can no longer be scored before their deadline are dropped, and their
+    batch failed, before any inference is spent on them.
+
+    New queries are only admitted if the queue stays within MAX_QUEUED_ITEMS and
+    MAX_QUEUED_BYTES, and if the backlog ahead of them drains, at the measured latency
+    per item, in time for them to be scored within their deadline or the SLA of their
+    class (ADMISSION_SLA_SECONDS).
+
+    Args:
+        quantum (float): Deficit added to a tenant per round, scaled by its weight.
+        max_in_flight_per_tenant (int): Max items of one tenant being scored at once.
+        weights (dict, optional): Weights by key token, DEFAULT_TENANT_WEIGHT otherwise.
+    """
+    def __init__(self, quantum: float = SCHEDULER_QUANTUM, max_in_flight_per_tenant: int = MAX_IN_FLIGHT_PER_TENANT, weights: dict = None):
+        self.quantum = quantum
+        self.max_in_flight_per_tenant = max_in_flight_per_tenant
+        self.weights = dict(weights or {})
+        self.tenants = {priority: {} for priority in SCHEDULER_LANES}
+        self.rings = {priority: deque() for priority in SCHEDULER_LANES}  # key tokens with queued items, in serving order
+        self.in_flight = defaultdict(int)
+        self.in_flight_items = set()
+        self.sequence = itertools.count()
+        self.avg_item_latency = DEFAULT_ITEM_LATENCY
+        self.dropped_items = 0
+        self.retried_items = 0
+        self.cancelled_items = 0  # queued items dropped because their batch was cancelled
+        self.aborted_items = 0  # items whose scoring was aborted because their batch was cancelled
+        self.saved_inference_seconds = 0.0
+        self.current_model = None
+        self.draining = False
         self.lock = threading.Lock()
 
     def display_all_items(self) -> None:
         """Display all items in all queues."""
-        if self.queues:
-            for queue in self.queues:
-                queue_data = list(queue.queue)
+        with self.lock:
+            if not self.get_total_items_locked():
+                print("No queues available.")
+                return
+
+            for priority, ring in self.rings.items():
+                for key_token in ring:
+                    tenant = self.tenants[priority][key_token]
+                    print(f"\nQueue Data ({priority}, {key_token}): ")
+                    for entry in sorted(tenant.items):
+                        print(entry[2].query_id)
 
-                print("\nQueue Data: ")
-                for item in queue_data:
-                    print(item.keys())
-        else:
-            print("No queues available.")
-            
     def get_total_queues(self) -> int:
-        """Get the total number of queues."""
-        return len(self.queues)
-    
-    def get_n_items_from_queue(self, queue: Queue, n: int = 2):
-            """Get n items from a queue."""
-            print("\nGetting items from queue")
-
-            items = []
-            while(len(items) < n and not queue.empty()):
-                items.append(queue.get())
-
-            print("Items retrieved")
-            print([list(item.keys()) for item in items])
-            return items
-    
-    def get_items_to_process(self) -> list[dict]:
-        """Get items to process from the queue manager."""
-        # print("\nCurrent Queue: ", self.current_queue)
-        # print("Number of Queues: ", len(self.queues))
+        """Get the number of tenant queues with queued items, across priority classes."""
+        with self.lock:
+            return sum(len(ring) for ring in self.rings.values())
 
-        items = []
-        if len(self.queues) == 0:
-            return items
-        
-        elif len(self.queues) == 1:
-            q = self.queues[0]
-            items = self.get_n_items_from_queue(q)
-        
-        elif len(self.queues) > 1:
-            q = self.queues[self.current_queue]
-            items = self.get_n_items_from_queue(q)
-            self.current_queue = (self.current_queue + 1) % len(self.queues)
-        
-        # self.delete_empty_queues()
-        self.reset_counter()
-        return items
-    
-    def insert(self, queue: Queue):
-        """Insert a queue into the queue manager."""
-        self.queues.append(queue)
+    def get_total_items_locked(self) -> int:
+        """Get the number of queued items. Must be called with the lock held."""
+        return self.get_queued_locked()[0]
+
+    def get_total_items(self) -> int:
+        """Get the number of queued items across all tenants and priority classes."""
+        with self.lock:
+            return self.get_total_items_locked()
+
+    def set_weight(self, key_token: str, weight: float) -> None:
+        """Set the share of the judge a tenant gets relative to the others."""
+        if weight <= 0:
+            raise ValueError("Weight must be greater than 0.")
+
+        with self.lock:
+            self.weights[key_token] = weight
+            for tenants in self.tenants.values():
+                if key_token in tenants:
+                    tenants[key_token].weight = weight
+
+    def get_tenant_queue(self, priority: str, key_token: str) -> TenantQueue:
+        """Get the queue of a tenant in a class, created on first use. Must be called with the lock held."""
+        tenants = self.tenants[priority]
+        if key_token not in tenants:
+            weight = self.weights.get(key_token, DEFAULT_TENANT_WEIGHT)
+            tenants[key_token] = TenantQueue(key_token, weight)
+        return tenants[key_token]
+
+    def get_queued_locked(self, priorities: list = SCHEDULER_LANES) -> tuple:
+        """Get the number and bytes of the items queued in the classes. Must be called with the lock held."""
+        total_items = 0
+        total_bytes = 0
+        for priority in priorities:
+            for key_token in self.rings[priority]:
+                tenant = self.tenants[priority][key_token]
+                total_items += len(tenant)
+                total_bytes += tenant.size
+        return total_items, total_bytes
+
+    def get_item_drain_time(self) -> float:
+        """Seconds the queue takes to drain by one item, at the measured latency."""
+        return self.avg_item_latency / JUDGE_CONCURRENCY
+
+    def estimate_drain_time_locked(self, priority: str) -> float:
+        """
+        Estimate the seconds until the items queued ahead of a new item of the class are scored.
+        Must be called with the lock held.
+        """
+        higher_classes = SCHEDULER_LANES[:SCHEDULER_LANES.index(priority) + 1]
+        queued_items, _ = self.get_queued_locked(higher_classes)
+        return (queued_items + sum(self.in_flight.values())) * self.get_item_drain_time()
+
+    def estimate_drain_time(self, priority: str) -> float:
+        """Estimate the seconds until the items queued ahead of a new item of the class are scored."""
+        with self.lock:
+            return self.estimate_drain_time_locked(priority)
+
+    def check_admission_locked(self, queue_items: list[QueueItem], priority: str, deadline: float = None) -> None:
+        """
+        Check that queries can be queued and scored in time. Must be called with the lock held.
+
+        Args:
+            queue_items (list[QueueItem]): The items to queue.
+            priority (str): Their priority class.
+            deadline (float, optional): Epoch time they must be scored by.
+
+        Raises:
+            AdmissionRejected: If the queries are not admitted. `retry_after` is None
+                when they would never be, e.g. more queries than the queue can hold.
+            ServerDraining: If the server is draining.
+        """
+        if self.draining:
+            raise ServerDraining("Server is draining for a restart.")
+
+        new_items = len(queue_items)
+        new_bytes = sum(queue_item.size for queue_item in queue_items)
+        item_drain_time = self.get_item_drain_time()
+
+        if new_items > MAX_QUEUED_ITEMS or new_bytes > MAX_QUEUED_BYTES:
+            raise AdmissionRejected(
+                f"Request too large, at most {MAX_QUEUED_ITEMS} queries and {MAX_QUEUED_BYTES} bytes can be queued.", None
+            )
 
-    def create_and_insert_queries(self, items: dict, summary_accepted: bool = True) -> None:
-        queue = Queue()
+        queued_items, queued_bytes = self.get_queued_locked()
 
-        # item -> {"query_id" : {"question": "question string", "baseline": "baseline string", "current": "current string", "summary_accepted": true}}
+        if queued_items + new_items > MAX_QUEUED_ITEMS:
+            excess_items = queued_items + new_items - MAX_QUEUED_ITEMS
+            raise AdmissionRejected("Queue is full.", max(1, math.ceil(excess_items * item_drain_time)))
+
+        if queued_bytes + new_bytes > MAX_QUEUED_BYTES:
+            # Items to drain to free the missing bytes, at the average size of the queued items
+            excess_items = (queued_bytes + new_bytes - MAX_QUEUED_BYTES) / (queued_bytes / queued_items)
+            raise AdmissionRejected("Queue is full.", max(1, math.ceil(excess_items * item_drain_time)))
+
+        sla = deadline - time.time() if deadline is not None else ADMISSION_SLA_SECONDS.get(priority)
+        if sla is None:
+            return
+
+        own_time = new_items * item_drain_time
+        if own_time > sla:
+            raise AdmissionRejected(
+                f"{new_items} queries cannot be scored within {round(sla)} seconds, even with an empty queue.", None
+            )
+
+        finish_time = self.estimate_drain_time_locked(priority) + own_time
+        if finish_time > sla:
+            raise AdmissionRejected(
+                f"Queries cannot be scored within {round(sla)} seconds with the current backlog.",
+                max(1, math.ceil(finish_time - sla))
+            )
+
+    def create_and_insert_queries(self, items: dict, summary_accepted: bool = True, judge_profile: str = None, key_token: str = None, priority: str = "bulk", deadline: float = None, checkpoint: Callable[[str, dict], None] = None) -> ScoringBatch:
+        """
+        Queue the queries of a submission for a tenant.
+
+        Args:
+            items (dict): The queries keyed by query ID.
+            summary_accepted (bool): Whether summaries are accepted.
+            judge_profile (str, optional): Name of the judge profile to score with.
+            key_token (str, optional): The tenant submitting the queries.
+            priority (str): One of PRIORITY_CLASSES.
+            deadline (float, optional): Epoch time the queries must be scored by.
+            checkpoint (Callable, optional): Called with the query ID and score of every scored item.
+
+        Returns:
+            ScoringBatch: The batch collecting the scores of the queries.
+
+        Raises:
+            ValueError: If the priority class does not exist.
+            AdmissionRejected: If the queries are not admitted.
+        """
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Priority must be one of: {', '.join(PRIORITY_CLASSES)}")
+
+        batch = ScoringBatch(key_token, list(items.keys()), priority=priority, deadline=deadline, checkpoint=checkpoint)
+
+        # item -> {"query_id" : {"question": "question string", "baseline": "baseline string", "current": "current string", "summary_accepted": true, "judge_profile": "default"}}
+        queue_items = []
         for query_id, value in items.items():
             value["summary_accepted"] = summary_accepted
-            queue.put({query_id: value})
-            # print(f"{query_id} : {value}")
-        self.insert(queue)
-    
-    def reset_counter(self) -> None:
-        """Reset the current queue counter to 0 if it exceeds the number of queues."""
-        if self.current_queue >= len(self.queues):
-            self.current_queue = 0
-
-    def delete_empty_queues(self) -> None:
-        """Delete empty queues from the queue manager."""
-        self.queues = [q for q in self.queues if not q.empty()]
-        if self.current_queue >= len(self.queues):
-            self.current_queue = 0 if self.queues else -1  # Adjust for empty list
-
-    def delete_queue(self, queue_object: Queue):
-        self.queues.remove(queue_object)
-
-
-queue_manager = QueueManager()
\ No newline at end of file
+            value["judge_profile"] = judge_profile
+            queue_items.append(QueueItem(query_id, value, batch))
+
+        with self.lock:
+            self.check_admission_locked(queue_items, priority, deadline)
+
+            tenant = self.get_tenant_queue(priority, key_token)
+            for queue_item in queue_items:
+                tenant.push(queue_item, next(self.sequence))
+
+            ring = self.rings[priority]
+            if queue_items and key_token not in ring:
+                ring.append(key_token)
+
+        return batch
+
+    def is_eligible(self, tenant: TenantQueue) -> bool:
+        """Whether a tenant can be served now. Must be called with the lock held."""
+        return bool(tenant.items) and self.in_flight[tenant.key_token] < self.max_in_flight_per_tenant
+
+    def drop_unservable_items(self, tenant: TenantQueue) -> None:
+        """
+        Drop the items at the head of a tenant queue whose batch has already failed, or
+        that can no longer be scored before their deadline. Must be called with the lock held.
+        """
+        now = time.time()
+        while tenant.items:
+            queue_item = tenant.peek()
+
+            if queue_item.batch.is_done():
+                tenant.pop()
+                self.dropped_items += 1
+            elif queue_item.deadline is not None and now + self.avg_item_latency > queue_item.deadline:
+                tenant.pop()
+                self.dropped_items += 1
+                queue_item.batch.set_error(DeadlineExceeded("Deadline exceeded before the query could be scored."))
+            else:
+                return
+
+    def prefer_current_model(self, ring: deque, tenants: dict) -> None:
+        """
+        Move a tenant that already earned a turn and is waiting on the model served last
+        to the front of the ring. Must be called with the lock held.
+
+        Serving the same model back to back keeps backends from swapping models in and out,
+        without taking a turn from any other tenant.
+        """
+        if self.current_model is None:
+            return
+
+        for key_token in ring:
+            tenant = tenants[key_token]
+            if self.is_eligible(tenant) and tenant.deficit >= 1 and tenant.peek().model == self.current_model:
+                ring.remove(key_token)
+                ring.appendleft(key_token)
+                return
+
+    def take_items_from_class(self, priority: str, items: list, n: int, batch_model: str) -> str:
+        """
+        Take items of one priority class with deficit round-robin. Must be called with the lock held.
+
+        Args:
+            priority (str): The priority class.
+            items (list): The items taken so far, extended in place.
+            n (int): Max number of items.
+            batch_model (str): Model all the items must be scored with, None if not set yet.
+
+        Returns:
+            str: The model of the taken items.
+        """
+        ring = self.rings[priority]
+        tenants = self.tenants[priority]
+        self.prefer_current_model(ring, tenants)
+
+        # Lower classes only get the slots this class cannot fill, so keep going round
+        # the ring while it hands out items
+        taken = None
+        while len(items) < n and taken != len(items):
+            taken = len(items)
+            batch_model = self.take_items_from_ring(ring, tenants, items, n, batch_model)
+
+        return batch_model
+
+    def take_items_from_ring(self, ring: deque, tenants: dict, items: list, n: int, batch_model: str) -> str:
+        """
+        Go once round the ring of a priority class, giving every eligible tenant one turn.
+        Must be called with the lock held.
+        """
+        visited = set()
+        index = 0
+
+        while len(items) < n and index < len(ring):
+            key_token = ring[index]
+            tenant = tenants[key_token]
+            self.drop_unservable_items(tenant)
+
+            if not tenant.items:
+                tenant.deficit = 0.0
+                del ring[index]
+                continue
+
+            if (
+                key_token in visited or not self.is_eligible(tenant)
+                or (batch_model and tenant.peek().model != batch_model)
+            ):
+                index += 1
+                continue
+
+            visited.add(key_token)
+            if tenant.deficit < 1:
+                tenant.deficit += self.quantum * tenant.weight
+
+            while (
+                tenant.deficit >= 1 and len(items) < n and self.is_eligible(tenant)
+                and (batch_model is None or tenant.peek().model == batch_model)
+            ):
+                queue_item = tenant.pop()
+                queue_item.started_at = time.time()
+                batch_model = queue_item.model
+                tenant.deficit -= 1
+                self.in_flight[key_token] += 1
+                self.in_flight_items.add(queue_item)
+                items.append(queue_item)
+                self.drop_unservable_items(tenant)
+
+            if not tenant.items:
+                # Idle tenants do not keep their deficit
+                tenant.deficit = 0.0
+                del ring[index]
+            elif tenant.deficit < 1 or not self.is_eligible(tenant):
+                # Turn used up, go to the back of the ring
+                del ring[index]
+                ring.append(key_token)
+            else:
+                # Turn still open, kept for the next call
+                index += 1
+
+        return batch_model
+
+    def get_items_to_process(self, n: int = 2) -> list[QueueItem]:
+        """
+        Get up to n items to score, highest priority class first, chosen with deficit
+        round-robin across the tenants of a class.
+
+        All the returned items are scored with the same model, the model of the tenant
+        whose turn it is. Tenants waiting on another model keep their place in the ring.
+
+        Args:
+            n (int): Max number of items.
+
+        Returns:
+            list[QueueItem]: The items to score, empty if none can be served now.
+        """
+        items = []
+
+        with self.lock:
+            if self.draining:
+                # Queued items are handed off, only the items in flight are still scored
+                return items
+
+            batch_model = None
+            for priority in SCHEDULER_LANES:
+                if len(items) >= n:
+                    break
+                batch_model = self.take_items_from_class(priority, items, n, batch_model)
+
+            if batch_model:
+                self.current_model = batch_model
+
+        if items:
+            print("\nItems retrieved")
+            print([(queue_item.priority, queue_item.key_token, queue_item.query_id) for queue_item in items])
+        return items
+
+    def drop_batch(self, batch: ScoringBatch, error: Exception) -> int:
+        """
+        Fail a batch and remove its queued items.
+
+        Args:
+            batch (ScoringBatch): The batch to drop.
+            error (Exception): The error the batch fails with.
+
+        Returns:
+            int: The number of removed items.
+        """
+        batch.set_error(error)
+
+        removed = 0
+        with self.lock:
+            for priority in (batch.priority, RETRY_LANE):
+                tenant = self.tenants[priority].get(batch.key_token)
+                if tenant:
+                    removed += tenant.remove_batch(batch)
+            self.dropped_items += removed
+
+        return removed
+
+    def cancel_batch(self, batch: ScoringBatch, reason: str = "Cancelled.") -> None:
+        """
+        Cancel a batch, its queued items are dropped and those being streamed are aborted.
+
+        Args:
+            batch (ScoringBatch): The batch to cancel.
+            reason (str): Why the batch is cancelled.
+        """
+        if batch.is_done():
+            return
+
+        removed = self.drop_batch(batch, Cancelled(reason))
+
+        with self.lock:
+            self.cancelled_items += removed
+            self.saved_inference_seconds += removed * self.avg_item_latency
+
+    def complete_item(self, queue_item: QueueItem, score_data: dict = None, processing_time: float = 0.0, error: Exception = None) -> None:
+        """
+        Release an item being scored and hand its score to its batch.
+
+        An item that could not be scored is queued again in the retry lane, until it used
+        up MAX_ITEM_RETRIES. Then it is handed to its batch with the "failed" status, the
+        other items of the batch are not affected.
+
+        Args:
+            queue_item (QueueItem): The item returned by get_items_to_process.
+            score_data (dict, optional): The score of the item.
+            processing_time (float): Seconds spent scoring the item.
+            error (Exception, optional): The error if the item could not be scored.
+        """
+        with self.lock:
+            self.in_flight[queue_item.key_token] = max(self.in_flight[queue_item.key_token] - 1, 0)
+            self.in_flight_items.discard(queue_item)
+            if not error and processing_time > 0:
+                # Exponentially weighted moving average of the latency of one item
+                self.avg_item_latency = 0.8 * self.avg_item_latency + 0.2 * processing_time
+
+            if isinstance(error, Cancelled):
+                # Aborted while being scored, about half of the inference is saved
+                self.aborted_items += 1
+                self.saved_inference_seconds += self.avg_item_latency / 2
+
+            if error and queue_item.attempts < MAX_ITEM_RETRIES and not queue_item.batch.is_done():
+                print(f"Retrying '{queue_item.query_id}' after error: {error}")
+                queue_item.attempts += 1
+                queue_item.priority = RETRY_LANE
+                self.retried_items += 1
+
+                tenant = self.get_tenant_queue(RETRY_LANE, queue_item.key_token)
+                tenant.push(queue_item, next(self.sequence))
+                if queue_item.key_token not in self.rings[RETRY_LANE]:
+                    self.rings[RETRY_LANE].append(queue_item.key_token)
+                return
+
+        if error:
+            score_data = {"status": "failed", "error": str(error)}
+        else:
+            score_data = {**score_data, "status": "retried" if queue_item.attempts else "ok"}
+
+        queue_item.batch.set_result(queue_item.query_id, score_data, processing_time)
+
+    def start_drain(self) -> None:
+        """Stop admitting new queries and handing out queued items, the items in flight are still scored."""
+        with self.lock:
+            self.draining = True
+
+    def stop_drain(self) -> None:
+        with self.lock:
+            self.draining = False
+
+    def take_queued_items(self) -> dict:
+        """
+        Remove every queued item, e.g. to hand them off while draining.
+
+        Returns:
+            dict: The removed items of every batch, {ScoringBatch: [QueueItem, ...]}.
+        """
+        batches = defaultdict(list)
+
+        with self.lock:
+            for priority in SCHEDULER_LANES:
+                for tenant in self.tenants[priority].values():
+                    while tenant.items:
+                        queue_item = tenant.pop()
+                        if not queue_item.batch.is_done():
+                            batches[queue_item.batch].append(queue_item)
+                    tenant.deficit = 0.0
+                self.rings[priority].clear()
+
+        return dict(batches)
+
+    def get_in_flight_count(self) -> int:
+        with self.lock:
+            return len(self.in_flight_items)
+
+    def abort_in_flight(self, error: Exception) -> int:
+        """
+        Fail the batches of the items in flight, their scoring is aborted.
+
+        Returns:
+            int: The number of aborted items.
+        """
+        with self.lock:
+            queue_items = list(self.in_flight_items)
+
+        for batch in {queue_item.batch for queue_item in queue_items}:
+            batch.set_error(error)
+
+        return len(queue_items)
+
+    def get_stats(self) -> dict:
+        """
+        Get the queue depth, oldest item age and in-flight count per tenant and priority class.
+
+        Returns:
+            dict: The stats of every tenant with queued or in-flight items, keyed by `get_tenant_alias`.
+        """
+        with self.lock:
+            tenants_stats = {}
+            for priority, tenants in self.tenants.items():
+                for key_token, tenant in tenants.items():
+                    if not tenant.items and not self.in_flight[key_token]:
+                        continue
+
+                    tenant_stats = tenants_stats.setdefault(get_tenant_alias(key_token), {
+                        "queued": {},
+                        "in_flight": self.in_flight[key_token],
+                        "oldest_age": 0.0,
+                        "weight": tenant.weight,
+                    })
+                    if tenant.items:
+                        tenant_stats["queued"][priority] = len(tenant)
+                        tenant_stats["oldest_age"] = max(tenant_stats["oldest_age"], round(tenant.get_oldest_age(), 2))
+
+            return {
+                "total_queued": sum(sum(stats["queued"].values()) for stats in tenants_stats.values()),
+                "total_in_flight": sum(self.in_flight.values()),
+                "draining": self.draining,
+                "avg_item_latency": round(self.avg_item_latency, 2),
+                "dropped_items": self.dropped_items,
+                "retried_items": self.retried_items,
+                "cancelled_items": self.cancelled_items,
+                "aborted_items": self.aborted_items,
+                "saved_inference_seconds": round(self.saved_inference_seconds, 2),
+                "tenants": tenants_stats,
+            }
+
+
+queue_manager = QueueManager()
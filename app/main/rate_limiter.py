@@ -0,0 +1,186 @@
+import datetime
+import math
+import threading
+import time
+
+from pymongo import ReturnDocument
+
+from app import mongo
+from .constants import (
+    DEFAULT_REQUESTS_PER_MINUTE,
+    DEFAULT_TOKENS_PER_MINUTE,
+    RATE_LIMIT_SYNC_WITH_MONGO,
+)
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a request is over the rate limits of its key token.
+
+    Attributes:
+        retry_after (int): Seconds after which the request would be allowed, None if it never would.
+    """
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """
+    A bucket holding up to `capacity` tokens, refilled continuously at `refill_rate` tokens per second.
+
+    Args:
+        capacity (float): Max tokens in the bucket, the allowed burst.
+        refill_rate (float): Tokens added per second.
+    """
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    def get_wait_time(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available, inf if the bucket can never hold them."""
+        self.refill()
+        if amount > self.capacity:
+            return math.inf
+        return max(0.0, (amount - self.tokens) / self.refill_rate)
+
+    def consume(self, amount: float) -> None:
+        self.tokens -= amount
+
+    def refund(self, amount: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+class RateLimiter:
+    """
+    Short-window rate limits per key token, on top of the monthly token quota.
+
+    Every key token has a bucket of requests and a bucket of tokens, each refilled over a
+    minute. A request is allowed only if both buckets hold enough, then it takes from both.
+
+    With `sync_with_mongo`, requests are also counted in one-minute windows in the
+    `rate_limits` collection, so the limits hold across several server processes.
+
+    Args:
+        requests_per_minute (int): Default requests allowed per minute.
+        tokens_per_minute (int): Default tokens allowed per minute.
+        sync_with_mongo (bool): Whether to also count requests in Mongo.
+    """
+    def __init__(self, requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute: int = DEFAULT_TOKENS_PER_MINUTE, sync_with_mongo: bool = RATE_LIMIT_SYNC_WITH_MONGO):
+        self.default_limits = {
+            "requests_per_minute": requests_per_minute,
+            "tokens_per_minute": tokens_per_minute,
+        }
+        self.sync_with_mongo = sync_with_mongo
+        self.limits = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_limits(self, key_token: str) -> dict:
+        """Get the rate limits of a key token."""
+        return self.limits.get(key_token, self.default_limits)
+
+    def set_limits(self, key_token: str, requests_per_minute: int = None, tokens_per_minute: int = None) -> None:
+        """
+        Set the rate limits of a key token, None keeps the default limit.
+
+        Raises:
+            ValueError: If a limit is not greater than 0.
+        """
+        limits = {
+            "requests_per_minute": requests_per_minute or self.default_limits["requests_per_minute"],
+            "tokens_per_minute": tokens_per_minute or self.default_limits["tokens_per_minute"],
+        }
+        if min(limits.values()) <= 0:
+            raise ValueError("Rate limits must be greater than 0.")
+
+        with self.lock:
+            if self.limits.get(key_token, self.default_limits) == limits:
+                return
+
+            self.limits[key_token] = limits
+            # Rebuilt with the new limits on the next request
+            self.buckets.pop(key_token, None)
+
+    def get_buckets(self, key_token: str) -> tuple:
+        """Get the request and token buckets of a key token. Must be called with the lock held."""
+        if key_token not in self.buckets:
+            limits = self.get_limits(key_token)
+            self.buckets[key_token] = (
+                TokenBucket(limits["requests_per_minute"], limits["requests_per_minute"] / 60),
+                TokenBucket(limits["tokens_per_minute"], limits["tokens_per_minute"] / 60),
+            )
+        return self.buckets[key_token]
+
+    def check(self, key_token: str, tokens: int) -> None:
+        """
+        Count a request of a key token against its rate limits.
+
+        Args:
+            key_token (str): The key token making the request.
+            tokens (int): Number of input tokens of the request.
+
+        Raises:
+            RateLimitExceeded: If the request is over the limits.
+        """
+        with self.lock:
+            request_bucket, token_bucket = self.get_buckets(key_token)
+            wait_time = max(request_bucket.get_wait_time(1), token_bucket.get_wait_time(tokens))
+
+            if wait_time == math.inf:
+                raise RateLimitExceeded(
+                    f"Request of {tokens} tokens is over the limit of {token_bucket.capacity} tokens per minute.", None
+                )
+            if wait_time > 0:
+                raise RateLimitExceeded("Rate limit exceeded.", max(1, math.ceil(wait_time)))
+
+            request_bucket.consume(1)
+            token_bucket.consume(tokens)
+
+        if not self.sync_with_mongo:
+            return
+
+        try:
+            self.check_shared(key_token, tokens)
+        except RateLimitExceeded:
+            with self.lock:
+                request_bucket.refund(1)
+                token_bucket.refund(tokens)
+            raise
+
+    def check_shared(self, key_token: str, tokens: int) -> None:
+        """
+        Count a request in the current one-minute window shared by all server processes.
+
+        Raises:
+            RateLimitExceeded: If the window is over the limits.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        window_start = now.replace(second=0, microsecond=0)
+        window_end = window_start + datetime.timedelta(minutes=1)
+
+        window = mongo.db.rate_limits.find_one_and_update(
+            {"key_token": key_token, "window_start": window_start},
+            {
+                "$inc": {"requests": 1, "tokens": tokens},
+                "$setOnInsert": {"expires_at": window_end + datetime.timedelta(minutes=1)},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+
+        limits = self.get_limits(key_token)
+        if window["requests"] > limits["requests_per_minute"] or window["tokens"] > limits["tokens_per_minute"]:
+            # Rejected requests do not count
+            mongo.db.rate_limits.update_one(
+                {"_id": window["_id"]},
+                {"$inc": {"requests": -1, "tokens": -tokens}}
+            )
+            raise RateLimitExceeded("Rate limit exceeded.", max(1, math.ceil((window_end - now).total_seconds())))
+
+
+rate_limiter = RateLimiter()
@@ -1,3 +1,6 @@
+import datetime
+import uuid
+
 from flask import request
 from flask_restx import Namespace, Resource
   
@@ -14,11 +17,18 @@ from app.main.swagger_models.db import (
     input_create_project_model, output_create_project_model,
     output_delete_project_model, 
     output_update_project_name_model,
+    output_update_project_judge_profile_model,
     output_delete_qa_set_model,
     compare_qa_sets_model, response_compare_qa_sets_model,
+    compare_multiple_qa_sets_model, response_compare_multiple_qa_sets_model,
     input_save_qa_scores_model, response_save_qa_scores_model,
-    response_get_set_score
+    response_get_set_score,
+    output_get_cache_stats_model
 )
+from app.main.cache import credits_cache, metadata_cache
+from app.main.constants import DEFAULT_USAGE_PERCENTILES
+from app.main.cancellation import cancellable_request, cancellation_registry
+from app.main.utils import ScoringRequestFailed
 from app.main.db_utils import (
     add_qa, update_qa, delete_qa_set,
     update_key_token,
@@ -28,7 +38,9 @@ from app.main.db_utils import (
     get_specific_project_details,
     create_project, delete_project,
     update_project_name,
+    update_project_judge_profile,
     compare_qa_sets,
+    compare_multiple_qa_sets,
     save_qa_scores,
     get_set_scores
 )
@@ -39,6 +51,15 @@ db_ns = Namespace(
     path='/'
 )
 
+def get_scoring_error_response(error: ScoringRequestFailed) -> tuple:
+    """
+    Build the response to a comparison whose scoring request failed, with the status code
+    and body of the scoring response, e.g. its run ID, and its Retry-After header.
+    """
+    if error.retry_after is None:
+        return error.body, error.status_code
+    return error.body, error.status_code, {"Retry-After": error.retry_after}
+
 @db_ns.route("/create-key-token")
 class CreateKeyToken(Resource):
     @db_ns.expect(input_create_key_token_model)
@@ -322,6 +343,16 @@ class DeleteQaSet(Resource):
 
         return {"message": "QA set deleted"}, 200
 
+def parse_usage_date(value: str) -> datetime.datetime:
+    """Parse an ISO 8601 date of a usage range, naive dates are UTC."""
+    if not value:
+        return None
+
+    date = datetime.datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date
+
 @db_ns.route("/get-usage-details")
 class GetUsageDetails(Resource):
     @db_ns.doc(
@@ -332,7 +363,22 @@ class GetUsageDetails(Resource):
                 "in": "header",
                 "type": "string",
                 "required": True,
-            }
+            },
+            "start": {
+                "description": "Start of the date range, ISO 8601, UTC if no offset. Defaults to the start of the current month.",
+                "in": "query",
+                "type": "string",
+            },
+            "end": {
+                "description": "End of the date range, excluded, ISO 8601, UTC if no offset. Defaults to now.",
+                "in": "query",
+                "type": "string",
+            },
+            "percentiles": {
+                "description": "Comma separated percentiles of the processing time, e.g. 50,90,99.",
+                "in": "query",
+                "type": "string",
+            },
         },
     )
     @db_ns.response(200, "Success", output_get_usage_model)
@@ -346,9 +392,20 @@ class GetUsageDetails(Resource):
         if not key_token:
             return {"error": "Missing key token."}, 400
 
+        try:
+            start, end = (parse_usage_date(request.args.get(name)) for name in ("start", "end"))
+            percentiles = [float(value) for value in request.args.get("percentiles", "").split(",") if value.strip()]
+        except ValueError as e:
+            return {"error": f"Invalid date range or percentiles: {e}"}, 400
+
+        if start and end and start >= end:
+            return {"error": "start must be before end."}, 400
+        if any(not 0 < percentile <= 100 for percentile in percentiles):
+            return {"error": "Percentiles must be between 0 and 100."}, 400
+
         try:
             # Call your function to fetch usage details (the result would be dynamic based on the DB)
-            result = get_usage_details(key_token=key_token)
+            result = get_usage_details(key_token=key_token, start=start, end=end, percentiles=percentiles or DEFAULT_USAGE_PERCENTILES)
         except Exception as e:
             print("Error in /get-usage-details:", e)
             return {"error": f"{str(e)}"}, 500
@@ -585,6 +642,62 @@ class UpdateProjectName(Resource):
 
         return {"message": "Project name updated to " + project_name}
     
+@db_ns.route("/update-project-judge-profile")
+class UpdateProjectJudgeProfile(Resource):
+    @db_ns.response(200, "Success", output_update_project_judge_profile_model)
+    @db_ns.response(400, "Invalid input / Not found", error_response_model)
+    @db_ns.response(500, "Internal Server Error", error_response_model)
+    @db_ns.doc(
+        description="Select the judge profile used to score the QA sets of a project.",
+        params={
+            "key-token": {
+                "description": "User identification token",
+                "in": "header",
+                "type": "string",
+                "required": True,
+            },
+            "project_id": {
+                "description": "Project ID",
+                "in": "query",
+                "type": "string",
+                "required": True,
+            },
+            "judge_profile": {
+                "description": "Judge profile name",
+                "in": "query",
+                "type": "string",
+                "required": True,
+            },
+        },
+    )
+    def put(self):
+        """
+        Select the judge profile used to score the QA sets of a project.
+        """
+        key_token = request.headers.get("key-token")
+        if not key_token:
+            return {"error": "Missing key token."}, 400
+
+        project_id = request.args.get("project_id")
+        if not project_id:
+            return {"error": "Missing project id."}, 400
+
+        judge_profile = request.args.get("judge_profile")
+        if not judge_profile:
+            return {"error": "Missing judge profile."}, 400
+
+        try:
+            update_project_judge_profile(
+                key_token=key_token, project_id=project_id, judge_profile=judge_profile
+            )
+        except ValueError as e:
+            return {"error": f"{str(e)}"}, 400
+        except Exception as e:
+            print("Error in /update-project-judge-profile:", e)
+            return {"error": f"{str(e)}"}, 500
+
+        return {"message": "Judge profile updated to " + judge_profile}, 200
+
 @db_ns.route("/compare-qna-sets")
 class CompareQnASets(Resource):
     @db_ns.expect(compare_qa_sets_model)
@@ -596,11 +709,19 @@ class CompareQnASets(Resource):
                 "in": "header",
                 "type": "string",
                 "required": True,
-            }
+            },
+            "Idempotency-Key": {
+                "description": "Unique key of the comparison, repeats within 24 hours return the original scores instead of scoring again",
+                "in": "header",
+                "type": "string",
+                "required": False,
+            },
         },
     )
     @db_ns.response(200, "Success", response_compare_qa_sets_model)
     @db_ns.response(400, "Invalid input / Not found", error_response_model)
+    @db_ns.response(429, "Scoring rate limited / Queue full, retry after the Retry-After header", error_response_model)
+    @db_ns.response(503, "Server draining for a restart, retry after the Retry-After header", error_response_model)
     @db_ns.response(500, "Internal Server Error", error_response_model)
     def post(self):
         """
@@ -608,6 +729,9 @@ class CompareQnASets(Resource):
         - **current_set_id**: ID of the current QA set
         - **baseline_set_id**: (optional) ID of the baseline QA set
         - **project_id**: ID of the project
+        - **use_key_facts**: (optional) Score against the precomputed key facts of the baseline, default true
+
+        With an Idempotency-Key header, a repeat of the comparison reuses or resumes the scoring of the original.
         """
         key_token = request.headers.get("key-token")
         if not key_token:
@@ -623,23 +747,102 @@ class CompareQnASets(Resource):
         project_id = data["project_id"]
         current_set_id = data["current_set_id"]
         baseline_set_id = data.get("baseline_set_id", None)
+        use_key_facts = data.get("use_key_facts", True)
+
+        # Scoring runs in a request to /calculate-score-for-queries, cancelled through
+        # this key if the client of this request disconnects
+        cancel_key = str(uuid.uuid4())
 
         try:
-            result = compare_qa_sets(
+            with cancellable_request(request.environ) as cancel_token:
+                cancel_token.add_callback(lambda reason: cancellation_registry.cancel(cancel_key, reason))
+                result = compare_qa_sets(
+                    key_token=key_token,
+                    current_set_id=current_set_id,
+                    baseline_set_id=baseline_set_id,
+                    project_identifier=project_id,
+                    use_key_facts=use_key_facts,
+                    cancel_key=cancel_key,
+                    idempotency_key=request.headers.get("Idempotency-Key"),
+                )
+        except ScoringRequestFailed as e:
+            print("Error in /compare-qa-sets:", e)
+            return get_scoring_error_response(e)
+        except Exception as e:
+            print("Error in /compare-qa-sets:", e)
+            return {"error": f"{str(e)}"}, 400
+
+        failed = [question_id for question_id, score_data in result["scores"].items() if score_data["status"] == "failed"]
+        return {
+            "response": result["scores"],
+            "failed": failed,
+            "key_facts": result["key_facts"],
+            "message": f"Scores calculated for the current set, {len(failed)} questions failed." if failed else "Scores calculated for the current set.",
+        }, 200  
+    
+@db_ns.route("/compare-multiple-qna-sets")
+class CompareMultipleQnASets(Resource):
+    @db_ns.expect(compare_multiple_qa_sets_model)
+    @db_ns.doc(
+        description="Compare several QA sets against the same baseline for a user.",
+        params={
+            "key-token": {
+                "description": "User identification token",
+                "in": "header",
+                "type": "string",
+                "required": True,
+            }
+        },
+    )
+    @db_ns.response(200, "Success", response_compare_multiple_qa_sets_model)
+    @db_ns.response(400, "Invalid input / Not found", error_response_model)
+    @db_ns.response(429, "Scoring rate limited / Queue full, retry after the Retry-After header", error_response_model)
+    @db_ns.response(503, "Server draining for a restart, retry after the Retry-After header", error_response_model)
+    @db_ns.response(500, "Internal Server Error", error_response_model)
+    def post(self):
+        """
+        Compare several QA sets against the same baseline for a user.
+        - **current_set_ids**: IDs of the current QA sets
+        - **baseline_set_id**: (optional) ID of the baseline QA set
+        - **project_id**: ID of the project
+        """
+        key_token = request.headers.get("key-token")
+        if not key_token:
+            return {"error": "Missing key token."}, 400
+
+        # Get JSON data from the request
+        data = request.get_json()
+
+        # Input parameter validation
+        if not data or "current_set_ids" not in data or "project_id" not in data:
+            return {"error": "Invalid input, required parameter is missing"}, 400
+
+        project_id = data["project_id"]
+        current_set_ids = data["current_set_ids"]
+        baseline_set_id = data.get("baseline_set_id", None)
+
+        if not isinstance(current_set_ids, list):
+            return {"error": "'current_set_ids' must be a list."}, 400
+
+        try:
+            result = compare_multiple_qa_sets(
                 key_token=key_token,
-                current_set_id=current_set_id,
+                current_set_ids=current_set_ids,
                 baseline_set_id=baseline_set_id,
                 project_identifier=project_id,
             )
+        except ScoringRequestFailed as e:
+            print("Error in /compare-multiple-qna-sets:", e)
+            return get_scoring_error_response(e)
         except Exception as e:
-            print("Error in /compare-qa-sets:", e)
+            print("Error in /compare-multiple-qna-sets:", e)
             return {"error": f"{str(e)}"}, 400
 
         return {
             "response": result,
-            "message": "Scores calculated for the current set.",
-        }, 200  
-    
+            "message": "Scores calculated for the current sets.",
+        }, 200
+
 @db_ns.route("/save-qna-scores")
 class SaveQnAScores(Resource):
     @db_ns.expect(input_save_qa_scores_model)
@@ -760,3 +963,16 @@ class GetSetScores(Resource):
             "scores_data" : scores_data,
             "message": "Scores retrieved sucessfully.", 
         }, 200
+
+@db_ns.route("/get-cache-stats")
+class GetCacheStats(Resource):
+    @db_ns.doc(description="Get the hit rates of the in-process caches.")
+    @db_ns.response(200, "Success", output_get_cache_stats_model)
+    def get(self):
+        """
+        Get the hit rates of the in-process caches of this server process.
+        """
+        return {
+            "stats": {cache.name: cache.get_stats() for cache in (credits_cache, metadata_cache)},
+            "message": "Cache stats retrieved.",
+        }, 200
@@ -1,22 +1,49 @@
+import hmac
 import time
 
-from flask import request
+from flask import request, current_app
 from flask_restx import Namespace, Resource
 
 from app.main.swagger_models.judge import (
     error_response_model,
     calculate_score_model, output_score_model,
     cal_score_for_queries_model, response_cal_scores_for_queries,
+    cal_score_for_candidates_model, response_cal_scores_for_candidates,
     input_get_answer_from_rag, response_get_answer_from_rag_model, 
+    output_get_judge_profiles_model,
+    output_get_queue_stats_model,
+    output_submit_score_job_model,
+    resume_run_model,
+    output_cancel_model,
+    output_get_score_job_status_model,
+    output_drain_status_model,
 )
 from app.main.judge_utilities import (
-    get_score_data, 
     get_scores_for_queries, 
+    get_scores_for_candidates,
     get_score_from_rag
 )
-from app.main.db_utils import update_usage, check_token_limit
-from app.main.utils import get_input_str_for_queries, get_output_str_for_queries
-from app.main.queues import queue_manager
+from app.main.db_utils import reserve_tokens, get_queue_weight, get_rate_limits
+from app.main.constants import PRIORITY_CLASSES
+from app.main.utils import (
+    get_estimated_tokens,
+    get_charged_scores,
+    get_token_usage
+)
+from app.main.queues import queue_manager, get_tenant_alias, DeadlineExceeded, AdmissionRejected, ServerDraining
+from app.main.cancellation import Cancelled, cancellable_request, cancellation_registry
+from app.main.profiles import JUDGE_PROFILES, get_profile
+from app.main.rate_limiter import rate_limiter, RateLimitExceeded
+from app.main.durable_queue import durable_queue
+from app.main.lifecycle import drain_controller
+from app.main.checkpoints import (
+    create_run, save_item_result, finish_run,
+    get_run, get_pending_queries, get_run_scores, mark_run_resumed
+)
+from app.main.idempotency import (
+    get_request_hash, claim_idempotency_key, attach_run,
+    save_idempotent_response, release_idempotency_key, wait_for_original_request
+)
 
 judge_ns = Namespace(
     name="Judge",
@@ -24,6 +51,306 @@ judge_ns = Namespace(
     path='/'
 )
 
+def get_deadline(deadline_seconds) -> float:
+    """
+    Convert the deadline of a request, in seconds from now, to an epoch time.
+
+    Raises:
+        ValueError: If the deadline is not a positive number.
+    """
+    if deadline_seconds is None:
+        return None
+
+    if isinstance(deadline_seconds, bool) or not isinstance(deadline_seconds, (int, float)) or deadline_seconds <= 0:
+        raise ValueError("deadline_seconds must be a positive number.")
+
+    return time.time() + deadline_seconds
+
+def get_retry_response(error: Exception, **fields) -> tuple:
+    """
+    Build the response to a request rejected by admission control or rate limits,
+    429 with a Retry-After header if it can be retried, 400 if it would never be allowed.
+    Requests rejected or handed off while the server drains get 503 instead of 429.
+    `fields` are added to the body, e.g. the run ID.
+    """
+    if error.retry_after is None:
+        return {"error": str(error), **fields}, 400
+
+    if isinstance(error, ServerDraining):
+        if error.job_id:
+            fields["job_id"] = error.job_id
+        return {"error": str(error), "retry_after": error.retry_after, **fields}, 503, {"Retry-After": str(error.retry_after)}
+
+    return {"error": str(error), "retry_after": error.retry_after, **fields}, 429, {"Retry-After": str(error.retry_after)}
+
+def score_queries(key_token: str, queries_data: dict, summary_accepted: bool, judge_profile: str, priority: str, deadline_seconds, idempotency_key: str = None):
+    """
+    Score queries in a new run, checkpointing every scored item so a failed run can be resumed.
+
+    Returns:
+        The response of /calculate-score-for-queries.
+    """
+    try:
+        get_profile(judge_profile)
+        deadline = get_deadline(deadline_seconds)
+        estimated_tokens = get_estimated_tokens(queries_data)
+
+        rate_limiter.set_limits(key_token, **get_rate_limits(key_token))
+        rate_limiter.check(key_token, estimated_tokens)
+
+        reservation = reserve_tokens(
+            estimated_tokens=estimated_tokens,
+            key_token=key_token,
+        )
+    except RateLimitExceeded as e:
+        return get_retry_response(e)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    if not reservation:
+        return {
+            "error": "You have used the max number of tokens allowed this month. Please try again later."
+        }, 400
+
+    try:
+        run_id = create_run(
+            key_token, queries_data, summary_accepted=summary_accepted,
+            judge_profile=judge_profile, priority=priority
+        )
+        if idempotency_key:
+            # Repeats of the request wait for the run while it is active, and resume it once abandoned
+            attach_run(key_token, "calculate-score-for-queries", idempotency_key, run_id)
+    except Exception as e:
+        print("Error in /calculate-score-for-queries route", e)
+        reservation.release()
+        return {"error": str(e)}, 500
+
+    try:
+        queue_manager.set_weight(key_token, get_queue_weight(key_token))
+
+        start_time = time.time()
+        with cancellable_request(request.environ, [run_id, request.headers.get("cancel-key")]) as cancel_token:
+            scores_data = get_scores_for_queries(
+                queries_data=queries_data,
+                queue_manager=queue_manager,
+                key_token=key_token,
+                summary_accepted=summary_accepted,
+                judge_profile=judge_profile,
+                priority=priority,
+                deadline=deadline,
+                checkpoint=lambda query_id, score_data: save_item_result(run_id, query_id, score_data),
+                cancel_token=cancel_token,
+            )
+        end_time = time.time()
+        processing_time = end_time - start_time
+        print(f"processing_time: {processing_time}")
+
+        failed = [query_id for query_id, score_data in scores_data["scores"].items() if score_data["status"] == "failed"]
+        finish_run(run_id, error=f"Failed queries: {', '.join(failed)}" if failed else None)
+
+        # Only the queries scored by the LLM are charged, the tokens counted by the backend
+        input_tokens, output_tokens = get_token_usage(get_charged_scores(scores_data))
+
+        reservation.commit(
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            processing_time=processing_time,
+            avg_queue_time=scores_data["avg_queue_time"],
+        )
+        return {"scores": scores_data.get("scores"), "run_id": run_id}
+    except AdmissionRejected as e:
+        finish_run(run_id, error=str(e))
+        return get_retry_response(e, run_id=run_id)
+    except DeadlineExceeded as e:
+        finish_run(run_id, error=str(e))
+        return {"error": str(e), "run_id": run_id}, 504
+    except Cancelled as e:
+        finish_run(run_id, error=str(e))
+        return {"error": str(e), "run_id": run_id}, 499
+    except Exception as e:
+        print("Error in /calculate-score-for-queries route", e)
+        finish_run(run_id, error=str(e))
+        return {"error": str(e), "run_id": run_id}, 500
+    finally:
+        # The tokens of a failed request are given back
+        reservation.release()
+
+def resume_run(key_token: str, run_id: str):
+    """
+    Score the queries of a failed or abandoned run that were not scored, saved scores are never computed again.
+
+    Returns:
+        The response of /resume-run.
+    """
+    try:
+        run = get_run(key_token, run_id)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    if run["status"] == "done":
+        return {"scores": get_run_scores(run_id), "run_id": run_id}
+
+    if not mark_run_resumed(run_id):
+        return {"error": "Run is still running."}, 409
+
+    queries_data = get_pending_queries(run_id)
+    # Estimated when the run was created
+    estimated_tokens = get_estimated_tokens(queries_data, stored=True)
+
+    try:
+        rate_limiter.set_limits(key_token, **get_rate_limits(key_token))
+        rate_limiter.check(key_token, estimated_tokens)
+
+        reservation = reserve_tokens(
+            estimated_tokens=estimated_tokens,
+            key_token=key_token,
+        )
+    except RateLimitExceeded as e:
+        finish_run(run_id, error=str(e))
+        return get_retry_response(e)
+    except ValueError as e:
+        finish_run(run_id, error=str(e))
+        return {"error": str(e)}, 400
+
+    if not reservation:
+        finish_run(run_id, error="Token limit reached.")
+        return {
+            "error": "You have used the max number of tokens allowed this month. Please try again later."
+        }, 400
+
+    try:
+        queue_manager.set_weight(key_token, get_queue_weight(key_token))
+
+        start_time = time.time()
+        with cancellable_request(request.environ, [run_id, request.headers.get("cancel-key")]) as cancel_token:
+            scores_data = get_scores_for_queries(
+                queries_data=queries_data,
+                queue_manager=queue_manager,
+                key_token=key_token,
+                summary_accepted=run["summary_accepted"],
+                judge_profile=run["judge_profile"],
+                priority=run["priority"],
+                checkpoint=lambda query_id, score_data: save_item_result(run_id, query_id, score_data),
+                cancel_token=cancel_token,
+            )
+        end_time = time.time()
+        processing_time = end_time - start_time
+        print(f"processing_time: {processing_time}")
+
+        failed = [query_id for query_id, score_data in scores_data["scores"].items() if score_data["status"] == "failed"]
+        finish_run(run_id, error=f"Failed queries: {', '.join(failed)}" if failed else None)
+
+        # Only the resumed queries scored by the LLM are charged
+        input_tokens, output_tokens = get_token_usage(get_charged_scores(scores_data))
+
+        reservation.commit(
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            processing_time=processing_time,
+            avg_queue_time=scores_data["avg_queue_time"],
+        )
+        return {"scores": {**scores_data["scores"], **get_run_scores(run_id)}, "run_id": run_id}
+    except AdmissionRejected as e:
+        finish_run(run_id, error=str(e))
+        return get_retry_response(e, run_id=run_id)
+    except Cancelled as e:
+        finish_run(run_id, error=str(e))
+        return {"error": str(e), "run_id": run_id}, 499
+    except Exception as e:
+        print("Error in /resume-run route", e)
+        finish_run(run_id, error=str(e))
+        return {"error": str(e), "run_id": run_id}, 500
+    finally:
+        reservation.release()
+
+def submit_score_job(key_token: str, queries_data: dict, summary_accepted: bool, judge_profile: str, priority: str):
+    """
+    Queue queries as a job of the durable queue.
+
+    Returns:
+        The response of /submit-score-job.
+    """
+    try:
+        get_profile(judge_profile)
+        estimated_tokens = get_estimated_tokens(queries_data)
+
+        rate_limiter.set_limits(key_token, **get_rate_limits(key_token))
+        rate_limiter.check(key_token, estimated_tokens)
+
+        reservation = reserve_tokens(
+            estimated_tokens=estimated_tokens,
+            key_token=key_token,
+        )
+    except RateLimitExceeded as e:
+        return get_retry_response(e)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    if not reservation:
+        return {
+            "error": "You have used the max number of tokens allowed this month. Please try again later."
+        }, 400
+
+    try:
+        # The reservation is committed by the worker recording the usage of the job
+        job_id = durable_queue.enqueue_job(
+            key_token=key_token,
+            queries_data=queries_data,
+            summary_accepted=summary_accepted,
+            judge_profile=judge_profile,
+            priority=priority,
+            reserved_tokens=reservation.tokens,
+        )
+        return {"job_id": job_id, "message": "Job submitted."}, 202
+    except Exception as e:
+        print("Error in /submit-score-job route", e)
+        reservation.release()
+        return {"error": str(e)}, 500
+
+def get_response_parts(response) -> tuple:
+    """Split a route response into its body and status code."""
+    if isinstance(response, tuple):
+        return response[0], response[1]
+    return response, 200
+
+def complete_idempotent_request(key_token: str, endpoint: str, idempotency_key: str, response, run_id: str = None) -> None:
+    """
+    Store the response of a request with an Idempotency-Key for its repeats. Requests rejected
+    before starting a run release the key instead, so a repeat executes them again.
+    """
+    body, status_code = get_response_parts(response)
+    run_id = run_id or body.get("run_id")
+
+    if status_code == 409:
+        # Another request is running the same run, it stores the response
+        return
+
+    if status_code < 400 or run_id:
+        save_idempotent_response(key_token, endpoint, idempotency_key, body, status_code, run_id=run_id)
+    else:
+        release_idempotency_key(key_token, endpoint, idempotency_key)
+
+def replay_idempotent_request(key_token: str, endpoint: str, record: dict, request_hash: str):
+    """
+    Answer a repeat of a request with an Idempotency-Key: the stored response if the original
+    finished, otherwise wait for its run and resume the run if it failed or was abandoned.
+    """
+    if record["request_hash"] != request_hash:
+        return {"error": "Idempotency-Key was already used with a different request."}, 422
+
+    if record["status"] == "in_progress":
+        record = wait_for_original_request(record)
+
+    if record["status"] == "done":
+        return record["response"], record["status_code"]
+
+    if record.get("run_id"):
+        response = resume_run(key_token, record["run_id"])
+        complete_idempotent_request(key_token, endpoint, record["idempotency_key"], response, run_id=record["run_id"])
+        return response
+
+    return {"error": "The original request with this Idempotency-Key is still in progress."}, 409
+
 @judge_ns.route("/calculate-score")
 class CalculateScore(Resource):
     @judge_ns.expect(calculate_score_model)
@@ -42,12 +369,20 @@ class CalculateScore(Resource):
     @judge_ns.response(
         400, "Quota exceeded / Invalid input / Not found", error_response_model
     )
+    @judge_ns.response(429, "Rate limited / Queue full / Backlog too long, retry after the Retry-After header", error_response_model)
+    @judge_ns.response(503, "Server draining for a restart, retry after the Retry-After header", error_response_model)
+    @judge_ns.response(499, "Cancelled / Client disconnected", error_response_model)
+    @judge_ns.response(504, "Deadline exceeded", error_response_model)
     @judge_ns.response(500, "Internal Server Error", error_response_model)
     def post(self):
         """
         Calculate the score for a given question, baseline, and current text.
         - **query_data**: Object containing the question, baseline, and current text.
         - **summary_accepted (Optional)**: Whether the summary is accepted or not.
+        - **judge_profile (Optional)**: Name of the judge profile to score with.
+        - **deadline_seconds (Optional)**: Seconds within which the score is needed, otherwise 504.
+
+        Scored through the shared scheduler in the interactive class, ahead of bulk work.
         """
         key_token = request.headers.get("key-token")
         if not key_token:
@@ -67,55 +402,86 @@ class CalculateScore(Resource):
         baseline = query_data.get("baseline", "")
         current = query_data.get("current", "")
         summary_accepted = data.get("summary_accepted", False)
+        judge_profile = data.get("judge_profile")
+        deadline_seconds = data.get("deadline_seconds")
 
         if not baseline or not current or not question:
             return {"error": "Baseline or Current missing."}, 400
 
         try:
-            input_usage_str = f"{question}\n{baseline}\n{current}"
+            get_profile(judge_profile)
+            deadline = get_deadline(deadline_seconds)
+        except ValueError as e:
+            return {"error": str(e)}, 400
+
+        reservation = None
+        try:
+            queries_data = {"query": {"question": question, "baseline": baseline, "current": current}}
+            estimated_tokens = get_estimated_tokens(queries_data)
             try:
-                is_under_limit = check_token_limit(
-                    input_usage_str=input_usage_str, key_token=key_token
+                rate_limiter.set_limits(key_token, **get_rate_limits(key_token))
+                rate_limiter.check(key_token, estimated_tokens)
+
+                reservation = reserve_tokens(
+                    estimated_tokens=estimated_tokens, key_token=key_token
                 )
+            except RateLimitExceeded as e:
+                return get_retry_response(e)
             except Exception as e:
                 return {"error": str(e)}, 400
 
-            if not is_under_limit:
+            if not reservation:
                 return {
                     "error": "You have used the max number of tokens allowed this month. Please try again later."
                 }, 400
 
             start_time = time.time()
-            score_data = get_score_data(
-                question=question,
-                baseline=baseline,
-                current=current,
-                summary_accepted=summary_accepted,
-            )
+            with cancellable_request(request.environ, [request.headers.get("cancel-key")]) as cancel_token:
+                scores_data = get_scores_for_queries(
+                    queries_data=queries_data,
+                    queue_manager=queue_manager,
+                    key_token=key_token,
+                    summary_accepted=summary_accepted,
+                    judge_profile=judge_profile,
+                    priority="interactive",
+                    deadline=deadline,
+                    cancel_token=cancel_token,
+                )
+            score_data = scores_data["scores"]["query"]
             end_time = time.time()
             processing_time = end_time - start_time
             print(f"processing_time: {processing_time}")
 
-            input_usage_str = f"{question}\n{baseline}\n{current}"
+            if score_data["status"] == "failed":
+                return {"error": score_data["error"]}, 500
 
-            output_usage_str = (
-                f"{score_data.get('score', 0)} + {score_data.get('reason', '')}"
-            )
-            update_usage(
-                input_str=input_usage_str,
-                output_str=output_usage_str,
+            # Scored without the LLM on the fast path, nothing to charge
+            input_tokens, output_tokens = get_token_usage(get_charged_scores(scores_data))
+            reservation.commit(
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
                 processing_time=processing_time,
-                key_token=key_token,
             )
 
             return {
                 "score": score_data.get("score", 0),
                 "reason": score_data.get("reason", ""),
+                "prompt_version": score_data.get("prompt_version"),
+                "status": score_data["status"],
                 "message": "Score Calculated Successfully",
             }, 200
+        except AdmissionRejected as e:
+            return get_retry_response(e)
+        except DeadlineExceeded as e:
+            return {"error": str(e)}, 504
+        except Cancelled as e:
+            return {"error": str(e)}, 499
         except Exception as e:
             print("Error: ", e)
             return {"error": str(e)}, 500
+        finally:
+            if reservation:
+                reservation.release()
 
 @judge_ns.route("/calculate-score-for-queries")
 class CalculateScoreForQueries(Resource):
@@ -128,19 +494,37 @@ class CalculateScoreForQueries(Resource):
                 "in": "header",
                 "type": "string",
                 "required": True,
-            }
+            },
+            "Idempotency-Key": {
+                "description": "Unique key of the submission, repeats within 24 hours return the original result instead of scoring again",
+                "in": "header",
+                "type": "string",
+                "required": False,
+            },
         },
     )
     @judge_ns.response(200, "Success", response_cal_scores_for_queries)
     @judge_ns.response(
         400, "Quota exceeded / Invalid input / Not found", error_response_model
     )
+    @judge_ns.response(409, "Original request with the Idempotency-Key still in progress", error_response_model)
+    @judge_ns.response(422, "Idempotency-Key already used with a different request", error_response_model)
+    @judge_ns.response(429, "Rate limited / Queue full / Backlog too long, retry after the Retry-After header", error_response_model)
+    @judge_ns.response(503, "Server draining for a restart, retry after the Retry-After header", error_response_model)
+    @judge_ns.response(499, "Cancelled / Client disconnected", error_response_model)
+    @judge_ns.response(504, "Deadline exceeded", error_response_model)
     @judge_ns.response(500, "Internal Server Error", error_response_model)
     def post(self):
         """
         Calculate scores for multiple queries.
         - **queries_data**: Object containing the question, baseline, and current text.
         - **summary_accepted** (Optional bool) : If want to discard summaries set to false, default true.
+        - **judge_profile** (Optional str) : Name of the judge profile to score with.
+        - **priority** (Optional str) : Priority class of the queries, interactive, bulk (default) or background.
+        - **deadline_seconds** (Optional number) : Seconds within which the scores are needed, otherwise 504.
+
+        With an Idempotency-Key header, a repeat of the request waits for the original run,
+        resumes it if it failed, or returns its stored scores without charging again.
         """
         key_token = request.headers.get("key-token")
         if not key_token:
@@ -156,51 +540,388 @@ class CalculateScoreForQueries(Resource):
 
         queries_data = data.get("queries_data")
         summary_accepted = data.get("summary_accepted", True)
+        judge_profile = data.get("judge_profile")
+        priority = data.get("priority", "bulk")
+
+        if priority not in PRIORITY_CLASSES:
+            return {"error": f"Priority must be one of: {', '.join(PRIORITY_CLASSES)}"}, 400
+
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if idempotency_key:
+            request_hash = get_request_hash(data)
+            record = claim_idempotency_key(key_token, "calculate-score-for-queries", idempotency_key, request_hash)
+            if record:
+                return replay_idempotent_request(key_token, "calculate-score-for-queries", record, request_hash)
+
+        response = score_queries(
+            key_token, queries_data, summary_accepted, judge_profile, priority,
+            data.get("deadline_seconds"), idempotency_key=idempotency_key
+        )
+        if idempotency_key:
+            complete_idempotent_request(key_token, "calculate-score-for-queries", idempotency_key, response)
+        return response
+
+@judge_ns.route("/resume-run")
+class ResumeRun(Resource):
+    @judge_ns.expect(resume_run_model)
+    @judge_ns.doc(
+        description="Score the queries of a failed run that were not scored, and return all its scores.",
+        params={
+            "key-token": {
+                "description": "User identification token",
+                "in": "header",
+                "type": "string",
+                "required": True,
+            }
+        },
+    )
+    @judge_ns.response(200, "Success", response_cal_scores_for_queries)
+    @judge_ns.response(
+        400, "Quota exceeded / Invalid input / Not found", error_response_model
+    )
+    @judge_ns.response(409, "Run still running", error_response_model)
+    @judge_ns.response(499, "Cancelled / Client disconnected", error_response_model)
+    @judge_ns.response(429, "Rate limited / Queue full / Backlog too long, retry after the Retry-After header", error_response_model)
+    @judge_ns.response(503, "Server draining for a restart, retry after the Retry-After header", error_response_model)
+    @judge_ns.response(500, "Internal Server Error", error_response_model)
+    def post(self):
+        """
+        Score the queries of a failed run that were not scored, and return all its scores.
+        Saved scores are never computed again. The run_id is returned by /calculate-score-for-queries.
+        - **run_id**: ID of the run to resume.
+        """
+        key_token = request.headers.get("key-token")
+        if not key_token:
+            return {"error": "Missing key token."}, 400
+
+        data = request.get_json()
+
+        if data is None or "run_id" not in data:
+            return {"error": "Invalid, input parameters missing."}, 400
+
+        run_id = data.get("run_id")
+
+        return resume_run(key_token, run_id)
+
+@judge_ns.route("/cancel-run")
+class CancelRun(Resource):
+    @judge_ns.expect(resume_run_model)
+    @judge_ns.doc(
+        description="Cancel a running run, its queued queries are dropped and saved scores kept.",
+        params={
+            "key-token": {
+                "description": "User identification token",
+                "in": "header",
+                "type": "string",
+                "required": True,
+            }
+        },
+    )
+    @judge_ns.response(200, "Success", output_cancel_model)
+    @judge_ns.response(400, "Invalid input / Not found / Not running", error_response_model)
+    def post(self):
+        """
+        Cancel a running run, its queued queries are dropped and saved scores kept.
+        The run can be resumed later with /resume-run.
+        - **run_id**: ID of the run to cancel.
+        """
+        key_token = request.headers.get("key-token")
+        if not key_token:
+            return {"error": "Missing key token."}, 400
+
+        data = request.get_json()
+
+        if data is None or "run_id" not in data:
+            return {"error": "Invalid, input parameters missing."}, 400
+
+        run_id = data.get("run_id")
 
         try:
-            input_usage_str = get_input_str_for_queries(queries_data)
-            is_under_limit = check_token_limit(
-                input_usage_str=input_usage_str,
+            get_run(key_token, run_id)
+        except ValueError as e:
+            return {"error": str(e)}, 400
+
+        if not cancellation_registry.cancel(run_id, "Cancelled by the user."):
+            return {"error": f"Run '{run_id}' is not running."}, 400
+
+        return {"message": "Run cancelled."}, 200
+
+@judge_ns.route("/submit-score-job")
+class SubmitScoreJob(Resource):
+    @judge_ns.expect(cal_score_for_queries_model)
+    @judge_ns.doc(
+        description="Queue queries in the durable queue, scored by the worker processes.",
+        params={
+            "key-token": {
+                "description": "User identification token",
+                "in": "header",
+                "type": "string",
+                "required": True,
+            },
+            "Idempotency-Key": {
+                "description": "Unique key of the submission, repeats within 24 hours return the original result instead of scoring again",
+                "in": "header",
+                "type": "string",
+                "required": False,
+            },
+        },
+    )
+    @judge_ns.response(202, "Accepted", output_submit_score_job_model)
+    @judge_ns.response(
+        400, "Quota exceeded / Invalid input / Not found", error_response_model
+    )
+    @judge_ns.response(409, "Original request with the Idempotency-Key still in progress", error_response_model)
+    @judge_ns.response(422, "Idempotency-Key already used with a different request", error_response_model)
+    @judge_ns.response(429, "Rate limited, retry after the Retry-After header", error_response_model)
+    @judge_ns.response(500, "Internal Server Error", error_response_model)
+    def post(self):
+        """
+        Queue queries in the durable queue, scored by the worker processes.
+        Queued queries survive restarts, poll /get-score-job-status for the scores.
+        With an Idempotency-Key header, a repeat of the request returns the job_id of the original.
+        - **queries_data**: Object containing the question, baseline, and current text.
+        - **summary_accepted** (Optional bool) : If want to discard summaries set to false, default true.
+        - **judge_profile** (Optional str) : Name of the judge profile to score with.
+        - **priority** (Optional str) : Priority class of the queries, interactive, bulk (default) or background.
+        """
+        key_token = request.headers.get("key-token")
+        if not key_token:
+            return {"error": "Missing key token."}, 400
+
+        data = request.get_json()
+
+        if data is None:
+            return {"error": "No queries data found in the request."}, 400
+
+        if "queries_data" not in data:
+            return {"error": "Invalid, input parameters missing."}, 400
+
+        queries_data = data.get("queries_data")
+        summary_accepted = data.get("summary_accepted", True)
+        judge_profile = data.get("judge_profile")
+        priority = data.get("priority", "bulk")
+
+        if priority not in PRIORITY_CLASSES:
+            return {"error": f"Priority must be one of: {', '.join(PRIORITY_CLASSES)}"}, 400
+
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if idempotency_key:
+            request_hash = get_request_hash(data)
+            record = claim_idempotency_key(key_token, "submit-score-job", idempotency_key, request_hash)
+            if record:
+                return replay_idempotent_request(key_token, "submit-score-job", record, request_hash)
+
+        response = submit_score_job(key_token, queries_data, summary_accepted, judge_profile, priority)
+        if idempotency_key:
+            complete_idempotent_request(key_token, "submit-score-job", idempotency_key, response)
+        return response
+
+@judge_ns.route("/get-score-job-status")
+class GetScoreJobStatus(Resource):
+    @judge_ns.doc(
+        description="Get the progress and scores of a job of the durable queue.",
+        params={
+            "key-token": {
+                "description": "User identification token",
+                "in": "header",
+                "type": "string",
+                "required": True,
+            },
+            "job_id": {
+                "description": "ID of the job",
+                "in": "query",
+                "type": "string",
+                "required": True,
+            },
+        },
+    )
+    @judge_ns.response(200, "Success", output_get_score_job_status_model)
+    @judge_ns.response(400, "Invalid input / Not found", error_response_model)
+    @judge_ns.response(500, "Internal Server Error", error_response_model)
+    def get(self):
+        """
+        Get the progress and scores of a job of the durable queue.
+        """
+        key_token = request.headers.get("key-token")
+        if not key_token:
+            return {"error": "Missing key token."}, 400
+
+        job_id = request.args.get("job_id")
+        if not job_id:
+            return {"error": "Missing job_id."}, 400
+
+        try:
+            return durable_queue.get_job_status(key_token, job_id), 200
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        except Exception as e:
+            print("Error in /get-score-job-status route", e)
+            return {"error": str(e)}, 500
+
+@judge_ns.route("/cancel-score-job")
+class CancelScoreJob(Resource):
+    @judge_ns.doc(
+        description="Cancel a job of the durable queue, its items not scored yet are dropped.",
+        params={
+            "key-token": {
+                "description": "User identification token",
+                "in": "header",
+                "type": "string",
+                "required": True,
+            },
+            "job_id": {
+                "description": "ID of the job",
+                "in": "query",
+                "type": "string",
+                "required": True,
+            },
+        },
+    )
+    @judge_ns.response(200, "Success", output_cancel_model)
+    @judge_ns.response(400, "Invalid input / Not found", error_response_model)
+    @judge_ns.response(500, "Internal Server Error", error_response_model)
+    def post(self):
+        """
+        Cancel a job of the durable queue, its items not scored yet are dropped.
+        Items being scored are aborted by their worker at its next heartbeat.
+        """
+        key_token = request.headers.get("key-token")
+        if not key_token:
+            return {"error": "Missing key token."}, 400
+
+        job_id = request.args.get("job_id")
+        if not job_id:
+            return {"error": "Missing job_id."}, 400
+
+        try:
+            cancelled = durable_queue.cancel_job(key_token, job_id)
+            return {"message": f"Job cancelled, {cancelled} items dropped."}, 200
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        except Exception as e:
+            print("Error in /cancel-score-job route", e)
+            return {"error": str(e)}, 500
+
+@judge_ns.route("/calculate-score-for-candidates")
+class CalculateScoreForCandidates(Resource):
+    @judge_ns.expect(cal_score_for_candidates_model)
+    @judge_ns.doc(
+        description="Calculate scores for several candidate answers against one baseline per query.",
+        params={
+            "key-token": {
+                "description": "User identification token",
+                "in": "header",
+                "type": "string",
+                "required": True,
+            }
+        },
+    )
+    @judge_ns.response(200, "Success", response_cal_scores_for_candidates)
+    @judge_ns.response(
+        400, "Quota exceeded / Invalid input / Not found", error_response_model
+    )
+    @judge_ns.response(429, "Rate limited / Queue full / Backlog too long, retry after the Retry-After header", error_response_model)
+    @judge_ns.response(503, "Server draining for a restart, retry after the Retry-After header", error_response_model)
+    @judge_ns.response(499, "Cancelled / Client disconnected", error_response_model)
+    @judge_ns.response(504, "Deadline exceeded", error_response_model)
+    @judge_ns.response(500, "Internal Server Error", error_response_model)
+    def post(self):
+        """
+        Calculate scores for several candidate answers against one baseline per query.
+        All candidates of a query are scored in a single LLM call, scheduled with the other scoring work.
+        - **queries_data**: Object containing the question, baseline, and candidates (answers indexed by candidate IDs).
+        - **judge_profile** (Optional str) : Name of the judge profile to score with.
+        - **priority** (Optional str) : Priority class of the queries, interactive, bulk (default) or background.
+        - **deadline_seconds** (Optional number) : Seconds within which the scores are needed, otherwise 504.
+        """
+        key_token = request.headers.get("key-token")
+        if not key_token:
+            return {"error": "Missing key token."}, 400
+
+        data = request.get_json()
+
+        if data is None:
+            return {"error": "No queries data found in the request."}, 400
+
+        if "queries_data" not in data:
+            return {"error": "Invalid, input parameters missing."}, 400
+
+        queries_data = data.get("queries_data")
+        judge_profile = data.get("judge_profile")
+        priority = data.get("priority", "bulk")
+
+        if priority not in PRIORITY_CLASSES:
+            return {"error": f"Priority must be one of: {', '.join(PRIORITY_CLASSES)}"}, 400
+
+        try:
+            get_profile(judge_profile)
+            deadline = get_deadline(data.get("deadline_seconds"))
+        except ValueError as e:
+            return {"error": str(e)}, 400
+
+        for query_id, query in queries_data.items():
+            if not query.get("question") or not query.get("baseline") or not query.get("candidates"):
+                return {"error": f"Question, baseline or candidates missing for query '{query_id}'."}, 400
+
+        try:
+            estimated_tokens = get_estimated_tokens(queries_data)
+
+            rate_limiter.set_limits(key_token, **get_rate_limits(key_token))
+            rate_limiter.check(key_token, estimated_tokens)
+
+            reservation = reserve_tokens(
+                estimated_tokens=estimated_tokens,
                 key_token=key_token,
             )
+        except RateLimitExceeded as e:
+            return get_retry_response(e)
         except ValueError as e:
             return {"error": str(e)}, 400
 
-        if not is_under_limit:
+        if not reservation:
             return {
                 "error": "You have used the max number of tokens allowed this month. Please try again later."
             }, 400
 
-        if queue_manager.get_total_queues() > 1:
-            return {"error": "Queue Full"}, 400
-
         try:
-            queue_manager.create_and_insert_queries(
-                queries_data, summary_accepted=summary_accepted
-            )
+            queue_manager.set_weight(key_token, get_queue_weight(key_token))
 
             start_time = time.time()
-            scores_data = get_scores_for_queries(
-                queries_data=queries_data, queue_manager=queue_manager
-            )
+            with cancellable_request(request.environ, [request.headers.get("cancel-key")]) as cancel_token:
+                scores_data = get_scores_for_candidates(
+                    queries_data=queries_data,
+                    queue_manager=queue_manager,
+                    key_token=key_token,
+                    judge_profile=judge_profile,
+                    priority=priority,
+                    deadline=deadline,
+                    cancel_token=cancel_token,
+                )
             end_time = time.time()
             processing_time = end_time - start_time
             print(f"processing_time: {processing_time}")
 
-            output_usage_str = get_output_str_for_queries(scores_data)
+            input_tokens, output_tokens = get_token_usage(scores_data)
 
-            update_usage(
-                input_str=input_usage_str,
-                output_str=output_usage_str,
+            reservation.commit(
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
                 processing_time=processing_time,
                 avg_queue_time=scores_data["avg_queue_time"],
-                key_token=key_token,
             )
-            return {"scores": scores_data.get("scores")}
+            return {"scores": scores_data["scores"], "failed": scores_data["failed"]}
+        except AdmissionRejected as e:
+            return get_retry_response(e)
+        except DeadlineExceeded as e:
+            return {"error": str(e)}, 504
+        except Cancelled as e:
+            return {"error": str(e)}, 499
         except Exception as e:
-            print("Error in /calculate-score-for-queries route", e)
+            print("Error in /calculate-score-for-candidates route", e)
             return {"error": str(e)}, 500
-        
+        finally:
+            reservation.release()
+
 @judge_ns.route("/retrieve-answer-from-rag")
 class RetrieveAnswersFromRag(Resource):
     @judge_ns.expect(input_get_answer_from_rag, validate=True)  # Validates the input payload
@@ -246,4 +967,99 @@ class RetrieveAnswersFromRag(Resource):
             return {"error": "Internal server error."}, 500
 
         # Return the answers
-        return {"answer": result}, 200
\ No newline at end of file
+        return {"answer": result}, 200
+
+@judge_ns.route("/get-judge-profiles")
+class GetJudgeProfiles(Resource):
+    @judge_ns.doc(description="Get the judge profiles projects can select.")
+    @judge_ns.response(200, "Success", output_get_judge_profiles_model)
+    def get(self):
+        """
+        Get the judge profiles projects can select.
+        """
+        return {
+            "profiles": [profile.to_dict() for profile in JUDGE_PROFILES.values()],
+            "message": "Judge profiles retrieved.",
+        }, 200
+
+@judge_ns.route("/get-queue-stats")
+class GetQueueStats(Resource):
+    @judge_ns.doc(
+        description="Get the queue depth, oldest item age and in-flight items per tenant.",
+        params={
+            "key-token": {
+                "description": "User identification token, to get the alias of its own tenant in the stats",
+                "in": "header",
+                "type": "string",
+                "required": False,
+            }
+        },
+    )
+    @judge_ns.response(200, "Success", output_get_queue_stats_model)
+    def get(self):
+        """
+        Get the queue depth, oldest item age and in-flight items per tenant.
+        Tenants are keyed by a short hash of their key token, never by the key token itself.
+        """
+        response = {
+            "stats": queue_manager.get_stats(),
+            "message": "Queue stats retrieved.",
+        }
+
+        key_token = request.headers.get("key-token")
+        if key_token:
+            response["tenant_alias"] = get_tenant_alias(key_token)
+
+        return response, 200
+
+def is_admin_request() -> bool:
+    """
+    Whether a request may call the admin endpoints: with the ADMIN_TOKEN of the config in
+    its admin-token header, or from the loopback interface when no ADMIN_TOKEN is set.
+    """
+    admin_token = current_app.config.get("ADMIN_TOKEN")
+    if admin_token:
+        return hmac.compare_digest(request.headers.get("admin-token", ""), admin_token)
+
+    return request.remote_addr in ("127.0.0.1", "::1")
+
+@judge_ns.route("/drain")
+class Drain(Resource):
+    @judge_ns.doc(
+        description="Drain the server before a restart.",
+        params={
+            "admin-token": {
+                "description": "ADMIN_TOKEN of the server config, only loopback requests are accepted when it is not set",
+                "in": "header",
+                "type": "string",
+                "required": False,
+            }
+        },
+    )
+    @judge_ns.response(202, "Draining", output_drain_status_model)
+    @judge_ns.response(403, "Not an admin request", error_response_model)
+    @judge_ns.response(409, "Already draining or drained", output_drain_status_model)
+    def post(self):
+        """
+        Drain the server before a restart, as on SIGTERM but without exiting.
+        New queries are rejected with 503, queued queries of runs are left to /resume-run and
+        other queued queries are handed to the durable queue, queries in flight are scored
+        until the drain timeout.
+        """
+        if not is_admin_request():
+            return {"error": "Draining requires the admin token."}, 403
+
+        if not drain_controller.start(current_app._get_current_object(), reason="Drain requested through /drain."):
+            return {"status": drain_controller.get_status(), "message": "Server is already draining."}, 409
+
+        return {"status": drain_controller.get_status(), "message": "Draining."}, 202
+
+@judge_ns.route("/get-drain-status")
+class GetDrainStatus(Resource):
+    @judge_ns.doc(description="Get the drain state of the server.")
+    @judge_ns.response(200, "Success", output_drain_status_model)
+    def get(self):
+        """
+        Get the drain state of the server, "serving", "draining" or "drained", and the handed off items.
+        """
+        return {"status": drain_controller.get_status(), "message": "Drain status retrieved."}, 200
@@ -146,6 +146,11 @@ compare_qa_sets_model = api.model(
             example=786,
             required=False,
         ),
+        "use_key_facts": fields.Boolean(
+            description="Score against the precomputed key facts of the baseline (optional)",
+            example=True,
+            required=False,
+        ),
     },
 )
 
@@ -158,6 +163,7 @@ response_compare_qa_sets_model = api.model(
             description="Response containing dynamic IDs with their details",
             example={
                 12: {
+                    "status": "ok",
                     "reason": "No reason",
                     "score": 0,
                     "question": "",
@@ -165,20 +171,81 @@ response_compare_qa_sets_model = api.model(
                     "current": "",
                 },
                 34: {
-                    "reason": "No reason",
-                    "score": 0,
+                    "status": "failed",
+                    "error": "Failed to get response from LLM: Request failed",
                     "question": "",
                     "baseline": "",
                     "current": "",
                 },
             },
         ),
+        "failed": fields.List(fields.String, description="IDs of the questions that could not be scored, not to be saved as scores", example=["34"]),
+        "key_facts": fields.String(
+            description="Whether the key facts of the baseline were used, otherwise why not: disabled, pending, failed or missing",
+            example="used",
+        ),
         "message": fields.String(
             required=True, description="Response message", example="Update successful"
         ),
     },
 )
 
+# /compare-multiple-qna-sets
+# Input
+compare_multiple_qa_sets_model = api.model(
+    "CompareMultipleQnASets",
+    {
+        "project_id": fields.String(
+            required=True, description="The ID of the project", example=786
+        ),
+        "current_set_ids": fields.List(
+            fields.Integer,
+            required=True,
+            description="The IDs of the QA sets to compare against the baseline",
+            example=[79, 80],
+        ),
+        "baseline_set_id": fields.Integer(
+            description="The ID of the baseline QA set (optional)",
+            example=78,
+            required=False,
+        ),
+    },
+)
+
+# Output
+response_compare_multiple_qa_sets_model = api.model(
+    "OutputCompareMultipleQnASets",
+    {
+        "response": fields.Raw(
+            required=True,
+            description="Scores indexed by current set ID and then by question ID",
+            example={
+                79: {
+                    12: {
+                        "reason": "No reason",
+                        "score": 0,
+                        "question": "",
+                        "baseline": "",
+                        "current": "",
+                    },
+                },
+                80: {
+                    12: {
+                        "reason": "No reason",
+                        "score": 0,
+                        "question": "",
+                        "baseline": "",
+                        "current": "",
+                    },
+                },
+            },
+        ),
+        "message": fields.String(
+            required=True, description="Response message", example="Scores calculated for the current sets."
+        ),
+    },
+)
+
 # /get-usage-details
 # output
 output_get_usage_model = api.model(
@@ -186,8 +253,10 @@ output_get_usage_model = api.model(
     {
         "response": fields.Raw(
             required=True,
-            description="Usage details containing token, processing, and request data",
+            description="Usage details of the date range containing token, processing, and request data, with processing time percentiles and histogram",
             example={
+                "start": "2025-01-01T00:00:00+00:00",
+                "end": None,
                 "token_used": 710,
                 "avg_input_token": 95,
                 "avg_output_token": 141.67,
@@ -199,6 +268,12 @@ output_get_usage_model = api.model(
                 "total_output_token": 425,
                 "total_processing_time": 76.18,
                 "total_queue_time": 76.16,
+                "latency_percentiles": {"p50": 30, "p90": 30, "p99": 30},
+                "latency_histogram": [
+                    {"le": 0.5, "count": 0}, {"le": 1, "count": 0}, {"le": 2, "count": 0}, {"le": 5, "count": 0},
+                    {"le": 10, "count": 0}, {"le": 20, "count": 0}, {"le": 30, "count": 3}, {"le": 60, "count": 0},
+                    {"le": 120, "count": 0}, {"le": 300, "count": 0}, {"le": None, "count": 0},
+                ],
             },
         ),
         "message": fields.String(
@@ -329,6 +404,14 @@ output_update_project_name_model = api.model(
     }
 )
 
+# /update-project-judge-profile
+output_update_project_judge_profile_model = api.model(
+    "OutputUpdateProjectJudgeProfile",
+    {
+        "message": fields.Raw(example="Judge profile updated to default.",description="Judge profile updated successfully")
+    }
+)
+
 # /delete-qa-set
 output_delete_qa_set_model = api.model(
     "output_delete_qa_set_model",
@@ -395,4 +478,36 @@ response_get_set_score = api.model(
     "message": "Scores retrieved sucessfully."
     }),
 }
-)
\ No newline at end of file
+)
+# /get-cache-stats
+output_get_cache_stats_model = api.model(
+    "OutputGetCacheStats",
+    {
+        "stats": fields.Raw(
+            description="Entries, hits, hits of keys cached as not found, misses and hit rate per cache",
+            example={
+                "credits": {
+                    "entries": 42,
+                    "bytes": 0,
+                    "hits": 1280,
+                    "negative_hits": 35,
+                    "misses": 160,
+                    "hit_rate": 0.8915,
+                    "evictions": 0,
+                    "invalidations": 3,
+                },
+                "metadata": {
+                    "entries": 18,
+                    "bytes": 2480312,
+                    "hits": 930,
+                    "negative_hits": 0,
+                    "misses": 64,
+                    "hit_rate": 0.9356,
+                    "evictions": 0,
+                    "invalidations": 21,
+                },
+            },
+        ),
+        "message": fields.String(example="Cache stats retrieved."),
+    }
+)
@@ -38,6 +38,11 @@ calculate_score_model = api.model(
         "summary_accepted": fields.Boolean(
             required=False, description="Whether the summary is accepted", example=True
         ),
+        "judge_profile": fields.String(
+            required=False, description="Name of the judge profile to score with", example="default"
+        ),        "deadline_seconds": fields.Float(
+            required=False, description="Seconds within which the score is needed", example=30
+        ),
     },
 )
 
@@ -49,6 +54,8 @@ output_score_model = api.model(
             example={
                 "score": "Integer Score",
                 "reason": "Reason of score",
+                "prompt_version": "v1",
+                "status": "ok | retried | fast_path",
                 "message": "API message",
             },
         ),
@@ -109,6 +116,14 @@ cal_score_for_queries_model = api.model(
                 },
             )
         ),
+        "judge_profile": fields.String(
+            required=False, description="Name of the judge profile to score with", example="default"
+        ),        "priority": fields.String(
+            required=False, description="Priority class: interactive, bulk or background", example="bulk"
+        ),
+        "deadline_seconds": fields.Float(
+            required=False, description="Seconds within which the scores are needed", example=600
+        ),
     },
 )
 # output
@@ -126,9 +141,85 @@ response_cal_scores_for_queries = api.model(
                 "456": {
                     "score": 1,
                     "reason": "The response is completely irrelevant and does not provide any correct information.",
+                    "status": "retried",
+                },
+                "789": {
+                    "status": "failed",
+                    "error": "Invalid JSON in response",
                 },
             },
-        )
+        ),
+        "run_id": fields.String(
+            description="ID of the run, to resume it with /resume-run if it fails",
+            example="0f8e4c1a-5b2d-4c1e-9a3f-7d6b2e1c9a40",
+        ),
+    },
+)
+
+# /resume-run
+resume_run_model = api.model(
+    "ResumeRun",
+    {
+        "run_id": fields.String(
+            required=True, description="ID of the run to resume", example="0f8e4c1a-5b2d-4c1e-9a3f-7d6b2e1c9a40"
+        ),
+    },
+)
+
+# /calculate-score-for-candidates
+# input
+cal_score_for_candidates_model = api.model(
+    "CalculateScoreForCandidates",
+    {
+        "queries_data": fields.Raw(
+            required=True,
+            description="Queries indexed by IDs, each with one baseline and several candidate answers indexed by candidate IDs",
+            example={
+                "123": {
+                    "question": "What is capital of france?",
+                    "baseline": "Paris",
+                    "candidates": {
+                        "78": "I don't know",
+                        "79": "Paris is the capital of France.",
+                    },
+                },
+            },
+        ),
+        "judge_profile": fields.String(
+            required=False, description="Name of the judge profile to score with", example="default"
+        ),
+        "priority": fields.String(
+            required=False, description="Priority class: interactive, bulk or background", example="bulk"
+        ),
+        "deadline_seconds": fields.Float(
+            required=False, description="Seconds within which the scores are needed", example=600
+        ),
+    },
+)
+# output
+response_cal_scores_for_candidates = api.model(
+    "OutputCalculateScoreForCandidates",
+    {
+        "scores": fields.Raw(
+            required=True,
+            description="A dictionary of query IDs containing score objects indexed by candidate IDs",
+            example={
+                "123": {
+                    "78": {
+                        "score": 1,
+                        "reason": "The response does not provide the correct information.",
+                    },
+                    "79": {
+                        "score": 5,
+                        "reason": "The response provides the correct capital.",
+                    },
+                },
+            },
+        ),
+        "failed": fields.Raw(
+            description="Errors of the queries that could not be scored, indexed by query ID",
+            example={"124": "Failed to get response from LLM: Request failed"},
+        ),
     },
 )
 
@@ -168,4 +259,107 @@ response_get_answer_from_rag_model = api.model(
             example={"1": "It's answer", "2": "It's answer"},
         )
     },
-)
\ No newline at end of file
+)
+
+# /get-judge-profiles
+output_get_judge_profiles_model = api.model(
+    "OutputGetJudgeProfiles",
+    {
+        "profiles": fields.Raw(
+            description="Judge profiles",
+            example=[
+                {
+                    "name": "default",
+                    "model": "qwen2.5:14b",
+                    "prompt_version": "v1",
+                    "options": {},
+                    "backend_pool": ["default"],
+                }
+            ],
+        ),
+        "message": fields.String(example="Judge profiles retrieved."),
+    },
+)
+
+# /get-queue-stats
+output_get_queue_stats_model = api.model(
+    "OutputGetQueueStats",
+    {
+        "stats": fields.Raw(
+            description="Queue stats per tenant, keyed by a short hash of its key token, and priority class, ages and latency in seconds",
+            example={
+                "total_queued": 12,
+                "total_in_flight": 2,
+                "draining": False,
+                "avg_item_latency": 4.8,
+                "dropped_items": 0,
+                "tenants": {
+                    "3f9a1c0b7e2d": {
+                        "queued": {"interactive": 1, "bulk": 11},
+                        "in_flight": 2,
+                        "oldest_age": 4.52,
+                        "weight": 1,
+                    }
+                },
+            },
+        ),
+        "tenant_alias": fields.String(description="Key of the caller's tenant in the stats, with a key-token header", example="3f9a1c0b7e2d"),
+        "message": fields.String(example="Queue stats retrieved."),
+    },
+)
+
+# /submit-score-job
+output_submit_score_job_model = api.model(
+    "OutputSubmitScoreJob",
+    {
+        "job_id": fields.String(description="ID of the job", example="0f8e4c1a-5b2d-4c1e-9a3f-7d6b2e1c9a40"),
+        "message": fields.String(example="Job submitted."),
+    },
+)
+
+# /get-score-job-status
+output_get_score_job_status_model = api.model(
+    "OutputGetScoreJobStatus",
+    {
+        "job_id": fields.String(example="0f8e4c1a-5b2d-4c1e-9a3f-7d6b2e1c9a40"),
+        "status": fields.String(description="running, done or failed", example="running"),
+        "total": fields.Integer(example=2),
+        "counts": fields.Raw(
+            description="Number of items by status",
+            example={"queued": 0, "leased": 1, "done": 1, "failed": 0},
+        ),
+        "scores": fields.Raw(
+            description="Scores of the done items indexed by query IDs",
+            example={"123": {"score": 1, "reason": "The response is not relevant."}},
+        ),
+        "errors": fields.Raw(description="Errors of the failed items indexed by query IDs", example={}),
+    },
+)
+
+# /cancel-run, /cancel-score-job
+output_cancel_model = api.model(
+    "OutputCancel",
+    {
+        "message": fields.String(example="Run cancelled."),
+    },
+)
+
+# /drain, /get-drain-status
+output_drain_status_model = api.model(
+    "OutputDrainStatus",
+    {
+        "status": fields.Raw(
+            description="Drain state, seconds since the drain started, and queued items handed off by destination",
+            example={
+                "state": "draining",
+                "reason": "Received signal 15.",
+                "elapsed": 12.4,
+                "in_flight": 2,
+                "handed_off": {"checkpoint": 40, "durable_queue": 3, "failed": 0},
+                "aborted_items": 0,
+                "usage": {"pending_buckets": 4, "pending_events": 12, "events": 5120, "flushed_events": 5108, "last_flush_age": 0.8},
+            },
+        ),
+        "message": fields.String(example="Draining."),
+    },
+)
@@ -0,0 +1,190 @@
+"""
+Usage of the users, in the usage collection, bucketed by user and time:
+    {"key_token", "granularity": "hour", "bucket_start", "requests", "input_tokens", "output_tokens",
+     "processing_time", "queue_time", "last_request_processing_time", "latency_histogram": {"0": 3, "4": 1}}
+    {"key_token", "granularity": "month", "bucket_start", "token_used"}
+
+Hour buckets hold the counters of the requests, and a histogram of their processing times
+whose buckets are bounded by LATENCY_HISTOGRAM_BOUNDS. Month buckets hold the tokens
+counted against the monthly limit, including the tokens reserved by requests being scored.
+Buckets start at UTC hours and months.
+"""
+import atexit
+import bisect
+import datetime
+import threading
+import time
+
+from flask import Flask
+from pymongo import UpdateOne
+
+from app import mongo
+from .constants import USAGE_FLUSH_INTERVAL_SECONDS, LATENCY_HISTOGRAM_BOUNDS
+
+USAGE_COUNTERS = ("requests", "input_tokens", "output_tokens", "processing_time", "queue_time")
+
+def get_utc_now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def get_hour_start(moment: datetime.datetime) -> datetime.datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+def get_month_start(moment: datetime.datetime) -> datetime.datetime:
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def get_latency_bucket(latency: float) -> int:
+    """Index of the histogram bucket of a processing time, len(LATENCY_HISTOGRAM_BOUNDS) above the last bound."""
+    return bisect.bisect_left(LATENCY_HISTOGRAM_BOUNDS, latency)
+
+def get_bucket_filter(key_token: str, granularity: str, bucket_start: datetime.datetime) -> dict:
+    return {"key_token": key_token, "granularity": granularity, "bucket_start": bucket_start}
+
+class UsageAggregator:
+    """
+    Buffers the usage of requests in memory and writes it behind, as one batch of `$inc`
+    updates of the usage buckets per flush, so requests do no usage I/O.
+
+    Usage is summed per bucket until flushed every `flush_interval` seconds, when
+    the server drains, or when the process exits. A flush that fails is merged back and
+    retried at the next one. Until `start` is called, e.g. in scripts, usage is written
+    as it is added.
+
+    Args:
+        flush_interval (float): Seconds between flushes.
+    """
+    def __init__(self, flush_interval: float = USAGE_FLUSH_INTERVAL_SECONDS):
+        self.flush_interval = flush_interval
+        self.pending = {}  # (granularity, key_token, bucket_start): {"increments": {...}, "set": {...}}
+        self.pending_events = 0
+        self.app = None
+        self.stopping = threading.Event()
+        self.flushed_events = 0
+        self.events = 0
+        self.last_flush_at = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def add(self, key_token: str, tokens: int = 0, counters: dict = None, latency: float = None) -> None:
+        """
+        Add usage of a user to the current buckets.
+
+        Args:
+            key_token (str): User identifier.
+            tokens (int): Tokens added to the monthly limit, negative to give reserved tokens back.
+            counters (dict, optional): Amounts added to USAGE_COUNTERS, e.g. {"requests": 1, "input_tokens": 10}.
+            latency (float, optional): Processing time of the request, counted in the histogram.
+        """
+        now = get_utc_now()
+        with self.lock:
+            if tokens:
+                self.increment(("month", key_token, get_month_start(now)), {"token_used": tokens})
+
+            if counters or latency is not None:
+                increments = dict(counters or {})
+                fields = {}
+                if latency is not None:
+                    increments[f"latency_histogram.{get_latency_bucket(latency)}"] = 1
+                    fields["last_request_processing_time"] = round(latency, 2)
+                self.increment(("hour", key_token, get_hour_start(now)), increments, fields)
+
+            self.pending_events += 1
+            self.events += 1
+
+        # Without the background flush, e.g. once stopped, usage is written right away
+        if self.app is None or self.stopping.is_set():
+            self.flush()
+
+    def increment(self, bucket: tuple, increments: dict, fields: dict = None) -> None:
+        """Add to a pending bucket, the lock must be held."""
+        usage = self.pending.setdefault(bucket, {"increments": {}, "set": {}})
+        for field, value in increments.items():
+            usage["increments"][field] = usage["increments"].get(field, 0) + value
+        usage["set"].update(fields or {})
+
+    def get_pending(self, key_token: str, start: datetime.datetime, end: datetime.datetime = None) -> dict:
+        """The hourly usage of a user not written yet, to add to the usage read from Mongo."""
+        totals = {}
+        with self.lock:
+            for (granularity, bucket_key_token, bucket_start), usage in self.pending.items():
+                if granularity != "hour" or bucket_key_token != key_token or bucket_start < start or (end and bucket_start >= end):
+                    continue
+                for field, value in usage["increments"].items():
+                    totals[field] = totals.get(field, 0) + value
+        return totals
+
+    def flush(self) -> int:
+        """
+        Write the buffered usage in one bulk write.
+
+        Returns:
+            int: The number of usage events written.
+        """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                events, self.pending_events = self.pending_events, 0
+            if not pending:
+                return 0
+
+            updates = []
+            for (granularity, key_token, bucket_start), usage in pending.items():
+                update = {"$inc": usage["increments"]}
+                if usage["set"]:
+                    update["$set"] = usage["set"]
+                updates.append(UpdateOne(get_bucket_filter(key_token, granularity, bucket_start), update, upsert=True))
+
+            try:
+                mongo.db.usage.bulk_write(updates, ordered=False)
+            except Exception as e:
+                print(f"An error occurred while writing the usage, retrying at the next flush: {e}")
+                self.merge(pending, events)
+                return 0
+
+            self.flushed_events += events
+            self.last_flush_at = time.time()
+            return events
+
+    def merge(self, pending: dict, events: int) -> None:
+        """Add usage that could not be written back to the buffer."""
+        with self.lock:
+            for bucket, usage in pending.items():
+                current = self.pending.setdefault(bucket, {"increments": {}, "set": {}})
+                for field, value in usage["increments"].items():
+                    current["increments"][field] = current["increments"].get(field, 0) + value
+                # Fields set since are more recent
+                current["set"] = {**usage["set"], **current["set"]}
+            self.pending_events += events
+
+    def start(self, app: Flask) -> None:
+        """Flush every `flush_interval` seconds in the background, and when the process exits."""
+        if self.app is not None:
+            return
+
+        self.app = app
+        threading.Thread(target=self.run, daemon=True).start()
+        atexit.register(self.stop)
+
+    def run(self) -> None:
+        with self.app.app_context():
+            while not self.stopping.wait(self.flush_interval):
+                self.flush()
+
+    def stop(self) -> None:
+        """Stop flushing in the background and write the buffered usage."""
+        self.stopping.set()
+        if self.app is not None:
+            with self.app.app_context():
+                self.flush()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "pending_buckets": len(self.pending),
+                "pending_events": self.pending_events,
+                "events": self.events,
+                "flushed_events": self.flushed_events,
+                "last_flush_age": round(time.time() - self.last_flush_at, 2) if self.last_flush_at else None,
+            }
+
+
+usage_aggregator = UsageAggregator()
@@ -1,9 +1,27 @@
 from datetime import datetime
+import math
 import random
 
 from flask import request
 import requests
 
+from .constants import ESTIMATED_CHARS_PER_TOKEN
+
+class ScoringRequestFailed(Exception):
+    """
+    Raised when a scoring request to this server does not succeed.
+
+    Attributes:
+        status_code (int): Status code of the response.
+        body (dict): JSON body of the response, e.g. its error and run ID.
+        retry_after (str): Retry-After header of the response, None if it has none.
+    """
+    def __init__(self, message: str, status_code: int, body: dict, retry_after: str = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+        self.retry_after = retry_after
+
 def get_current_month_year() -> str:
     """
     Returns the current month and year as a string in 'Month_Year' format.
@@ -16,77 +34,97 @@ def get_current_datetime() -> str:
     """
     return datetime.now().strftime("%d-%m-%Y_%H:%M:%S")  # Example: '21-01-2025_12:00'
 
-def get_number_of_tokens(input_str) -> int:
-    "Number of tokens in the input string."
-    return len(input_str)
+def estimate_tokens(text: str) -> int:
+    "Local estimate of the number of tokens of a string, without the backend's tokenizer."
+    return math.ceil(len(text) / ESTIMATED_CHARS_PER_TOKEN)
 
-def get_input_str_for_queries(queries_data: dict) -> str:
+def get_estimated_tokens(queries_data: dict, stored: bool = False) -> int:
     """
-    Constructs a single input string from a list of query dictionaries.
+    Estimate the input tokens of queries, to check limits before they are scored.
+
+    The estimate of each query is computed from its question, baseline, current response
+    and candidates, and kept in its "estimated_tokens", e.g. for resumed runs. An
+    "estimated_tokens" sent by the client is replaced, it would bypass the limits.
 
     Args:
-        queries_list (list[dict]): A list of dictionaries where each dictionary 
-            contains the query ID and associated data, including the question,
-            baseline, and current response.
+        queries_data (dict): Queries keyed by query ID.
+        stored (bool): The queries were saved by this server, e.g. the items of a resumed
+            run, so their estimates are reused.
 
     Returns:
-        str: A formatted string concatenating the question, baseline, and current response
-        for each query in the list, separated by newlines.
+        int: The estimated input tokens of all the queries.
     """
-    input_str = ""
-    for query_id, query in queries_data.items():
-        question = query.get("question", "")
-        baseline = query.get("baseline", "")
-        current = query.get("current", "")
+    total = 0
+    for query in queries_data.values():
+        if not stored or "estimated_tokens" not in query:
+            texts = [query.get("question", ""), query.get("baseline", ""), query.get("current", "")]
+            texts.extend(str(candidate) for candidate in query.get("candidates", {}).values())
+            query["estimated_tokens"] = sum(estimate_tokens(text) for text in texts)
 
-        # Concatenate the question, baseline, and current response with newline separators
-        input_str += f"{question}\n{baseline}\n{current}\n"
+        total += query["estimated_tokens"]
 
-    return input_str
+    return total
 
-def get_output_str_for_queries(scores_data: dict[dict]) -> str:
+def get_charged_scores(scores_data: dict) -> dict:
     """
-    Constructs a single output string from a dictionary of query results.
+    Keep only the scores of the queries the LLM actually scored, failed and fast path queries are not charged.
 
     Args:
-        scores_data (dict[dict]): A dictionary where each key is a query ID and
-            each value is another dictionary containing the query's score and reason.
+        scores_data (dict): The scores data, the scores keyed by query ID under "scores".
 
     Returns:
-        str: A formatted string concatenating the score and reason for each query
-        in the dictionary, separated by newlines.
+        dict: The scores data of the charged queries.
+    """
+    charged_scores = {
+        query_id: score_data
+        for query_id, score_data in scores_data.get("scores", {}).items()
+        if score_data.get("status", "ok") in ("ok", "retried")
+    }
+    return {**scores_data, "scores": charged_scores}
+
+def get_token_usage(scores_data: dict) -> tuple:
     """
-    output_str = ""
+    Sum the tokens counted by the backend for scores.
 
-    for query_id, query_output in scores_data.get("scores", {}).items():
-        # Each query_output is expected to be a dictionary with score and reason keys
-        reason = query_output.get("reason", "")
-        score = query_output.get("score", "")
+    Args:
+        scores_data (dict): The scores data, with the "token_usage" of every score, or of
+            all of them for the candidate scores.
 
-        # Concatenate the reason and score with newline separators
-        output_str += f"{reason}\n{score}\n"
+    Returns:
+        tuple: The input and output tokens.
+    """
+    if "token_usage" in scores_data:
+        usages = [scores_data["token_usage"]]
+    else:
+        usages = [score_data.get("token_usage", {}) for score_data in scores_data.get("scores", {}).values()]
 
-    return output_str
+    return (
+        sum(usage.get("input", 0) for usage in usages),
+        sum(usage.get("output", 0) for usage in usages),
+    )
 
-def post_score_for_queries(payload: dict, headers: dict = {}) -> dict:
+def post_score_for_queries(payload: dict, headers: dict = {}, endpoint: str = "calculate-score-for-queries") -> dict:
     """
     Makes a POST request to the server with the provided payload and returns the response.
 
     Args:
         payload (dict): The payload to be sent in the POST request.
+        headers (dict): Headers to be sent with the request.
+        endpoint (str): The scoring endpoint of this server to call.
 
     Returns:
         dict: The response from the server.
 
     Raises:
-        Exception: If an error occurs while making the request or if the request failed.
+        ScoringRequestFailed: If the server did not respond with 200, with its status code and body.
+        Exception: If an error occurs while making the request.
     """
     import inspect
 
     try:
         # Dynamically get the base URL
         base_url = request.host_url.rstrip('/')  # Removes the trailing slash from the host_url
-        url = f"{base_url}/calculate-score-for-queries"
+        url = f"{base_url}/{endpoint}"
         print("Making POST request to:", url)
 
         response = requests.post(url, json=payload, headers=headers)
@@ -97,7 +135,18 @@ def post_score_for_queries(payload: dict, headers: dict = {}) -> dict:
             return response.json()
         else:
             print(f"Request failed with status code {response.status_code}. ({inspect.currentframe().f_code.co_name})")
-            raise Exception(f"Request failed with status code {response.status_code}")
+            try:
+                body = response.json()
+            except ValueError:
+                body = {"error": response.text}
+            if not isinstance(body, dict):
+                body = {"error": str(body)}
+            body.setdefault("error", f"Request failed with status code {response.status_code}")
+            raise ScoringRequestFailed(
+                body["error"], response.status_code, body, retry_after=response.headers.get("Retry-After")
+            )
+    except ScoringRequestFailed:
+        raise
     except Exception as e:
         print(f"An error occurred while making the POST request: {e}")
         raise Exception(f"Failed to make the POST request: {e}")
@@ -0,0 +1,101 @@
+import os
+import signal
+import socket
+import threading
+import time
+
+from flask import Flask
+
+from .constants import JUDGE_CONCURRENCY, WORKER_POLL_INTERVAL
+from .durable_queue import DurableQueue, durable_queue
+from .judge_utilities import process_items
+from .usage import usage_aggregator
+
+class Worker:
+    """
+    Scores the items of the durable queue, any number of workers can run against the same database.
+
+    Args:
+        app (Flask): The app, used for its Mongo connection.
+        queue (DurableQueue, optional): The queue to work on.
+        batch_size (int): Max number of items claimed at once.
+        poll_interval (float): Seconds to wait when the queue is empty.
+    """
+    def __init__(self, app: Flask, queue: DurableQueue = durable_queue, batch_size: int = JUDGE_CONCURRENCY, poll_interval: float = WORKER_POLL_INTERVAL):
+        self.app = app
+        self.queue = queue
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.stopping = threading.Event()
+
+    def stop(self, *args) -> None:
+        """Stop once the items being scored are done."""
+        print(f"\nWorker {self.worker_id} stopping...")
+        self.stopping.set()
+
+    def heartbeat(self, items: list[dict], lost_ids: set, done: threading.Event) -> None:
+        """Extend the leases of the items until they are done, collecting the items no longer leased."""
+        item_ids = [item["_id"] for item in items]
+        with self.app.app_context():
+            while not done.wait(self.queue.lease_seconds / 3):
+                leased_ids = self.queue.heartbeat(self.worker_id, item_ids)
+                lost_ids.update(item_id for item_id in item_ids if item_id not in leased_ids)
+
+    def process(self, items: list[dict]) -> None:
+        """Score claimed items and store their results, items cancelled meanwhile are aborted."""
+        done = threading.Event()
+        lost_ids = set()
+        heartbeat_thread = threading.Thread(target=self.heartbeat, args=(items, lost_ids, done), daemon=True)
+        heartbeat_thread.start()
+
+        try:
+            results = process_items(
+                [{item["query_id"]: item["query_data"]} for item in items],
+                is_cancelled=lambda index: items[index]["_id"] in lost_ids
+            )
+        finally:
+            done.set()
+            heartbeat_thread.join()
+
+        for item, result in zip(items, results):
+            score_data = result[item["query_id"]]
+            if score_data.get("cancelled"):
+                continue
+            elif score_data.get("status") == "failed":
+                self.queue.fail(self.worker_id, item, score_data["error"])
+            else:
+                self.queue.complete(self.worker_id, item, {**score_data, "status": "retried" if item["attempts"] > 1 else "ok"})
+
+    def finish_jobs(self, job_ids: set) -> None:
+        """Record the usage of the jobs that are done."""
+        for job_id in job_ids:
+            job = self.queue.finish_job_if_done(job_id)
+            if job:
+                self.queue.record_job_usage(job)
+
+    def run(self) -> None:
+        """Claim and score items until stopped with SIGINT or SIGTERM."""
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        with self.app.app_context():
+            print(f"Worker {self.worker_id} started.")
+
+            while not self.stopping.is_set():
+                self.finish_jobs(self.queue.fail_exhausted_items())
+
+                items = self.queue.claim(self.worker_id, n=self.batch_size)
+                if not items:
+                    self.stopping.wait(self.poll_interval)
+                    continue
+
+                start_time = time.time()
+                self.process(items)
+                print(f"Scored {len(items)} items in {round(time.time() - start_time, 2)}s")
+
+                self.finish_jobs({item["job_id"] for item in items})
+
+        # Write the usage of the finished jobs before exiting
+        usage_aggregator.stop()
+        print(f"Worker {self.worker_id} stopped.")
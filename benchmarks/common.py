@@ -0,0 +1,59 @@
+import time
+from contextlib import contextmanager
+
+import bson
+from pymongo import monitoring
+
+class CommandBytesListener(monitoring.CommandListener):
+    """Count the commands sent to Mongo and the bytes of the commands and their replies."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.commands = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def started(self, event) -> None:
+        self.commands += 1
+        self.bytes_sent += len(bson.encode(event.command))
+
+    def succeeded(self, event) -> None:
+        self.bytes_received += len(bson.encode(event.reply))
+
+    def failed(self, event) -> None:
+        pass
+
+
+# Registered before the app creates its Mongo client, so every command is counted
+listener = CommandBytesListener()
+monitoring.register(listener)
+
+@contextmanager
+def measure(results: list, label: str, **fields):
+    """Append the round trips, bytes and milliseconds of the block to `results`."""
+    listener.reset()
+    start_time = time.perf_counter()
+    yield
+    results.append({
+        "label": label,
+        **fields,
+        "round_trips": listener.commands,
+        "bytes_sent": listener.bytes_sent,
+        "bytes_received": listener.bytes_received,
+        "ms": round((time.perf_counter() - start_time) * 1000, 2),
+    })
+
+def print_results(results: list) -> None:
+    columns = list(results[0].keys())
+    widths = {column: max(len(column), *(len(str(result[column])) for result in results)) for column in columns}
+
+    print("  ".join(column.ljust(widths[column]) for column in columns))
+    for result in results:
+        print("  ".join(str(result[column]).ljust(widths[column]) for column in columns))
+
+def make_qa_set(questions: int, answer_chars: int, seed: int = 0) -> list[dict]:
+    return [
+        {"id": question_id, "question": f"Question {question_id}?", "answer": f"{seed}-" + "a" * answer_chars}
+        for question_id in range(1, questions + 1)
+    ]
@@ -0,0 +1,110 @@
+"""
+Cost of the reads of a large tenant, in the normalized collections and in the version 1
+layout, where every read fetched the whole qa_data document of the user.
+
+Run from the repository root, against a test database:
+    python -m benchmarks.read_cost --projects 10 --sets 50 --questions 50
+"""
+import argparse
+import uuid
+
+from benchmarks.common import measure, print_results, make_qa_set
+from app import create_app, mongo
+from app.main import db_utils
+from app.main.migrations import migrate_tenant
+
+def make_tenant(key_token: str, projects: int, sets: int, questions: int, answer_chars: int) -> dict:
+    """A version 1 document, every set scored."""
+    tenant_projects = {}
+    for project_number in range(1, projects + 1):
+        qa_sets = []
+        for set_id in range(1, sets + 1):
+            qa_set = make_qa_set(questions, answer_chars, seed=set_id)
+            qa_sets.append({
+                "set_id": set_id,
+                "baseline": set_id == 1,
+                "last_updated": "2024-01-01 00:00:00",
+                "qa_set": qa_set,
+                "scores": {str(qa["id"]): {"score": 5, "reason": "Same facts."} for qa in qa_set},
+            })
+        tenant_projects[str(1000 + project_number)] = {"project_name": f"benchmark {project_number}", "qa_sets": qa_sets}
+
+    return {"key_token": key_token, "projects": tenant_projects}
+
+def run(projects: int, sets: int, questions: int, answer_chars: int, repeat: int) -> None:
+    key_token = f"benchmark-{uuid.uuid4()}"
+    results = []
+
+    tenant = make_tenant(key_token, projects, sets, questions, answer_chars)
+    project_id = next(iter(tenant["projects"]))
+    set_id = sets // 2 + 1
+
+    try:
+        mongo.db.benchmark_qa_data.insert_one(dict(tenant))
+        mongo.db.qa_data.insert_one(dict(tenant))
+        migrate_tenant(key_token)
+
+        def read_v1() -> dict:
+            return mongo.db.benchmark_qa_data.find_one({"key_token": key_token})
+
+        def get_sets_to_compare_v1() -> tuple:
+            qa_sets = read_v1()["projects"][project_id]["qa_sets"]
+            baseline_set = next(qa_set for qa_set in qa_sets if qa_set.get("baseline"))
+            return baseline_set, [qa_set for qa_set in qa_sets if qa_set["set_id"] == set_id]
+
+        read_paths = {
+            "get_set_scores": (
+                lambda: db_utils.get_set_scores(key_token, set_id, project_id),
+                lambda: read_v1()["projects"][project_id]["qa_sets"][set_id - 1].get("scores", {}),
+            ),
+            "get_specific_project_details": (
+                lambda: db_utils.get_specific_project_details(key_token, project_id),
+                lambda: read_v1()["projects"][project_id],
+            ),
+            "get_set_ids": (
+                lambda: db_utils.get_set_ids(key_token, project_id),
+                lambda: [{"set_id": qa_set["set_id"], "qa_set": qa_set["qa_set"]} for qa_set in read_v1()["projects"][project_id]["qa_sets"]],
+            ),
+            "get_project_ids": (
+                lambda: db_utils.get_project_ids(key_token),
+                lambda: list(read_v1()["projects"].items()),
+            ),
+            "get_sets_to_compare": (
+                lambda: db_utils.get_sets_to_compare(key_token, project_id, [set_id]),
+                get_sets_to_compare_v1,
+            ),
+        }
+
+        for label, (read_normalized, read_legacy) in read_paths.items():
+            for _ in range(repeat):
+                with measure(results, label, layout="normalized"):
+                    read_normalized()
+                with measure(results, label, layout="v1"):
+                    read_legacy()
+
+        # Keep the fastest run of every read, the first ones warm up the connection and the cache
+        fastest = {}
+        for result in results:
+            key = (result["label"], result["layout"])
+            if key not in fastest or result["ms"] < fastest[key]["ms"]:
+                fastest[key] = result
+
+        print_results([fastest[key] for key in sorted(fastest)])
+    finally:
+        mongo.db.qa_data.delete_one({"key_token": key_token})
+        mongo.db.benchmark_qa_data.delete_one({"key_token": key_token})
+        for collection in (mongo.db.projects, mongo.db.qa_sets, mongo.db.qa_items, mongo.db.scores):
+            collection.delete_many({"key_token": key_token})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--projects", type=int, default=10)
+    parser.add_argument("--sets", type=int, default=50)
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--answer-chars", type=int, default=300)  # the version 1 document must stay under 16MB
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        run(args.projects, args.sets, args.questions, args.answer_chars, args.repeat)
@@ -0,0 +1,67 @@
+"""
+Cost of the writes of a growing tenant, in the normalized collections and in the
+version 1 layout, where every write rewrote the qa_sets array of the project.
+
+Run from the repository root, against a test database:
+    python -m benchmarks.write_cost --sets 200 --questions 50
+"""
+import argparse
+import uuid
+
+from benchmarks.common import measure, print_results, make_qa_set
+from app import create_app, mongo
+from app.main import db_utils
+from app.main.constants import STORAGE_SCHEMA_VERSION
+
+def run(sets: int, questions: int, answer_chars: int, report_every: int) -> None:
+    key_token = f"benchmark-{uuid.uuid4()}"
+    results = []
+
+    # Key facts extraction needs the judge, it is not part of the write cost
+    db_utils.start_key_facts_extraction = lambda *args: None
+
+    try:
+        mongo.db.qa_data.insert_one({"key_token": key_token, "schema_version": STORAGE_SCHEMA_VERSION})
+        project_id = next(iter(db_utils.create_project(key_token, "benchmark")))
+        mongo.db.benchmark_qa_data.insert_one({"key_token": key_token, "projects": {project_id: {"project_name": "benchmark", "qa_sets": []}}})
+
+        for set_id in range(1, sets + 1):
+            qa_set = make_qa_set(questions, answer_chars, seed=set_id)
+            scores = {str(qa["id"]): {"score": 5, "reason": "Same facts."} for qa in qa_set}
+            report = set_id == 1 or set_id % report_every == 0
+
+            with measure(results if report else [], "add_qa", layout="normalized", sets=set_id):
+                db_utils.add_qa(key_token, project_id, {"set_id": set_id, "qa_set": qa_set})
+            with measure(results if report else [], "save_qa_scores", layout="normalized", sets=set_id):
+                db_utils.save_qa_scores(key_token, set_id, project_id, scores)
+
+            # The version 1 writes: read the user, rewrite the qa_sets array of the project
+            with measure(results if report else [], "add_qa", layout="v1", sets=set_id):
+                user_data = mongo.db.benchmark_qa_data.find_one({"key_token": key_token})
+                qa_sets = user_data["projects"][project_id]["qa_sets"]
+                qa_sets.append({"set_id": set_id, "qa_set": qa_set, "baseline": set_id == 1})
+                mongo.db.benchmark_qa_data.update_one({"key_token": key_token}, {"$set": {f"projects.{project_id}.qa_sets": qa_sets}})
+            with measure(results if report else [], "save_qa_scores", layout="v1", sets=set_id):
+                user_data = mongo.db.benchmark_qa_data.find_one({"key_token": key_token})
+                qa_sets = user_data["projects"][project_id]["qa_sets"]
+                qa_sets[-1]["scores"] = scores
+                mongo.db.benchmark_qa_data.update_one({"key_token": key_token}, {"$set": {f"projects.{project_id}.qa_sets": qa_sets}})
+
+        print_results(sorted(results, key=lambda result: (result["label"], result["layout"], result["sets"])))
+    finally:
+        mongo.db.qa_data.delete_one({"key_token": key_token})
+        mongo.db.benchmark_qa_data.delete_one({"key_token": key_token})
+        for collection in (mongo.db.projects, mongo.db.qa_sets, mongo.db.qa_items, mongo.db.scores):
+            collection.delete_many({"key_token": key_token})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sets", type=int, default=200)
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--answer-chars", type=int, default=500)
+    parser.add_argument("--report-every", type=int, default=50)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        run(args.sets, args.questions, args.answer_chars, args.report_every)
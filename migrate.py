@@ -0,0 +1,15 @@
+import argparse
+
+from app import create_app
+from app.main.migrations import migrate_all, migrate_all_usage
+
+app = create_app()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Move every user still stored in one qa_data document to the normalized collections, and their usage to the usage collection.")
+    parser.add_argument("--keep-legacy", action="store_true", help="Keep the old projects under 'legacy_projects' in qa_data.")
+    args = parser.parse_args()
+
+    with app.app_context():
+        print(f"Migrated {migrate_all(keep_legacy=args.keep_legacy)} users.")
+        print(f"Migrated the usage of {migrate_all_usage()} users.")
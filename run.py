@@ -1,7 +1,11 @@
 from app import create_app
+from app.main.lifecycle import install_drain_signal_handler
 
 app = create_app()
 
+# SIGTERM drains the server before exiting, so restarts lose no inference
+install_drain_signal_handler(app)
+
 if __name__ == '__main__':
     # app.run(debug=True, host='127.0.0.1', port=5000)
     app.run()
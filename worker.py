@@ -0,0 +1,7 @@
+from app import create_app
+from app.main.worker import Worker
+
+app = create_app()
+
+if __name__ == '__main__':
+    Worker(app).run()